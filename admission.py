@@ -0,0 +1,210 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+from collections import deque
+
+from outbox import TokenBucket
+
+# Priorities, lowest first; under load the lowest is shed first. Reminder delivery never comes through here.
+LISTING = 0
+REACTION = 1
+COMMAND = 2
+
+# Fraction of max_backlog queued across all guilds at which new work of a priority is shed
+_SHED_AT = {LISTING: 0.5, REACTION: 1.0}
+
+
+class Overloaded(Exception):
+    """Work was shed instead of queued"""
+
+
+class _Slot:
+    __slots__ = ('guild_id', 'held')
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.held = True
+
+
+# The slot held by the work running in the current task, if any
+_current = contextvars.ContextVar('admission_slot', default=None)
+
+
+class _GuildQueue:
+    __slots__ = ('jobs', 'running', 'ready', 'commands', 'reactions')
+
+    def __init__(self, commands, reactions):
+        # Heap of (-priority, sequence, cost, turn): highest priority first, then oldest
+        self.jobs = []
+        self.running = 0
+        self.ready = False
+        self.commands = commands
+        self.reactions = reactions
+
+
+class Admission:
+    """Per-guild admission in front of command and reaction handlers
+
+    Each guild gets a queue of at most `queue_size` commands and runs at most `guild_concurrency` at
+    once, out of `concurrency` across every guild. Free slots go round-robin to the guilds that have
+    work waiting, so one busy guild can't push the others to the back of a shared line; within a
+    guild, higher priority goes first. Commands spend `cost` tokens from the guild's bucket of `rate`
+    per `per` seconds, and reactions from a separate bucket. Once `max_backlog` commands are queued
+    overall, listings and then reactions are shed before anything else waits. Work that is about to
+    wait on a user, or on a slow upload or download, calls detach() so it doesn't hold a slot meanwhile.
+    """
+
+    def __init__(self, concurrency=8, guild_concurrency=2, queue_size=10, max_backlog=100, rate=20, per=60.0,
+                 reaction_rate=60, reaction_per=10.0):
+        self.concurrency = concurrency
+        self.guild_concurrency = guild_concurrency
+        self.queue_size = queue_size
+        self.max_backlog = max_backlog
+        self.rate = rate
+        self.per = per
+        self.reaction_rate = reaction_rate
+        self.reaction_per = reaction_per
+        self._guilds = {}
+        # Guilds with queued commands, in the order they next get a slot
+        self._ready = deque()
+        self._queued = 0
+        self._running = 0
+        self._sequence = itertools.count()
+        self._wakeup = None
+        # Work shed since startup, by priority
+        self.shed = {LISTING: 0, REACTION: 0, COMMAND: 0}
+
+    def depth(self):
+        """Number of commands waiting for a slot"""
+        return self._queued
+
+    def _guild(self, guild_id):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = _GuildQueue(TokenBucket(self.rate, self.per),
+                                                         TokenBucket(self.reaction_rate, self.reaction_per))
+        return guild
+
+    def _overloaded(self, priority):
+        return priority in _SHED_AT and self._queued >= self.max_backlog * _SHED_AT[priority]
+
+    def _purge(self, guild):
+        # Drop jobs whose callers gave up while queued
+        jobs = [job for job in guild.jobs if not job[3].done()]
+        if len(jobs) < len(guild.jobs):
+            self._queued -= len(guild.jobs) - len(jobs)
+            heapq.heapify(jobs)
+            guild.jobs = jobs
+
+    def admit_reaction(self, guild_id):
+        """Whether a reaction may be handled now; reactions never wait, so this doesn't queue anything"""
+        if self._overloaded(REACTION) or self._guild(guild_id).reactions.take():
+            self.shed[REACTION] += 1
+            return False
+        return True
+
+    async def run(self, guild_id, work, priority=COMMAND, cost=1, on_wait=None):
+        """Await work() once the guild's turn comes; raises Overloaded if it was shed instead
+
+        on_wait() is awaited first if the turn doesn't come at once, e.g. to acknowledge a slash command
+        before its deadline passes.
+        """
+        guild = self._guild(guild_id)
+        self._purge(guild)
+        if len(guild.jobs) >= self.queue_size:
+            # A full queue makes room for more important work by dropping its newest, least important job
+            lowest = max(guild.jobs)
+            if -lowest[0] >= priority:
+                self.shed[priority] += 1
+                raise Overloaded()
+            guild.jobs.remove(lowest)
+            heapq.heapify(guild.jobs)
+            self._queued -= 1
+            self.shed[-lowest[0]] += 1
+            lowest[3].set_exception(Overloaded())
+        elif self._overloaded(priority):
+            self.shed[priority] += 1
+            raise Overloaded()
+
+        turn = asyncio.get_running_loop().create_future()
+        heapq.heappush(guild.jobs, (-priority, next(self._sequence), min(cost, self.rate), turn))
+        self._queued += 1
+        if not guild.ready:
+            guild.ready = True
+            self._ready.append(guild_id)
+        self._dispatch()
+        try:
+            if on_wait is not None and not turn.done():
+                await on_wait()
+            await turn
+        except BaseException:
+            if turn.done() and not turn.cancelled() and turn.exception() is None:
+                self._release(guild_id)
+            else:
+                # Leaves the queue at the next purge
+                turn.cancel()
+            raise
+        slot = _Slot(guild_id)
+        token = _current.set(slot)
+        try:
+            return await work()
+        finally:
+            _current.reset(token)
+            self._free(slot)
+
+    def detach(self):
+        """Give up the slot of the work running in this task; the rest of it runs outside the limits"""
+        slot = _current.get()
+        if slot is not None:
+            self._free(slot)
+
+    def _free(self, slot):
+        if slot.held:
+            slot.held = False
+            self._release(slot.guild_id)
+
+    def _release(self, guild_id):
+        self._running -= 1
+        self._guilds[guild_id].running -= 1
+        self._dispatch()
+
+    def _wake(self):
+        self._wakeup = None
+        self._dispatch()
+
+    def _dispatch(self):
+        # Start one job per guild per pass until the slots run out or no guild can start anything
+        wait = None
+        started = True
+        while started and self._ready and self._running < self.concurrency:
+            started = False
+            for _ in range(len(self._ready)):
+                if self._running >= self.concurrency:
+                    break
+                guild_id = self._ready.popleft()
+                guild = self._guilds[guild_id]
+                self._purge(guild)
+                if guild.jobs and guild.running < self.guild_concurrency:
+                    delay = guild.commands.take(guild.jobs[0][2])
+                    if delay:
+                        wait = delay if wait is None else min(wait, delay)
+                    else:
+                        turn = heapq.heappop(guild.jobs)[3]
+                        self._queued -= 1
+                        self._running += 1
+                        guild.running += 1
+                        turn.set_result(None)
+                        started = True
+                if guild.jobs:
+                    self._ready.append(guild_id)
+                else:
+                    guild.ready = False
+        # Guilds out of tokens are retried once the soonest of them has enough again
+        if wait is not None:
+            loop = asyncio.get_running_loop()
+            if self._wakeup is not None and self._wakeup.when() > loop.time() + wait:
+                self._wakeup.cancel()
+                self._wakeup = None
+            if self._wakeup is None:
+                self._wakeup = loop.call_later(wait, self._wake)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+
+from sharding import owned
+
+log = logging.getLogger(__name__)
+
+EVENT_COLUMNS = ('id, guild_id, channel_id, creator_id, title, description, event_time, message_id, category, '
+                 'is_cancelled, attending_count, maybe_count, not_attending_count, duration, recurrence, '
+                 'recurrence_end, ics_uid')
+RSVP_COLUMNS = 'event_id, occurrence, user_id, status'
+REMINDER_COLUMNS = 'id, event_id, reminder_time, fire_at, notification_sent'
+
+
+def archive_batch(conn, cutoff, limit, leases=None):
+    """Move up to `limit` finished events, with their RSVPs, reminders and exceptions, to the archive
+
+    An event is finished once it is cancelled, or once it (or the last occurrence of its series)
+    ended before cutoff. Sent reminders of events that are still live are moved as well. Returns
+    (moved event IDs, their announcement message IDs, reminders moved).
+    """
+    # Take the write lock up front so the batch is one short, uncontended transaction
+    conn.execute('BEGIN IMMEDIATE')
+    # With shard leases, each process only archives its own guilds
+    ownership, params = owned(leases, 'guild_id', time.time())
+    # One query per way an event can be finished, each over its own partial index, so nothing is
+    # scanned while the write lock is held
+    rows = []
+    for condition, values in (
+            ("is_cancelled = 1", []),
+            ("recurrence IS NULL AND is_cancelled = 0 AND event_time < ? AND event_time + duration * 60 < ?",
+             [cutoff, cutoff]),
+            ("recurrence IS NOT NULL AND is_cancelled = 0 AND recurrence_end < ? "
+             "AND recurrence_end + duration * 60 < ?", [cutoff, cutoff])):
+        if len(rows) < limit:
+            rows += conn.execute(f"SELECT id, message_id FROM events WHERE {condition} AND {ownership} LIMIT ?",
+                                 values + params + [limit - len(rows)]).fetchall()
+    event_ids = [row[0] for row in rows]
+    now = int(time.time())
+
+    if event_ids:
+        placeholders = ','.join('?' * len(event_ids))
+        conn.execute(f"""
+            INSERT INTO archived_events ({EVENT_COLUMNS}, archived_at)
+            SELECT {EVENT_COLUMNS}, ? FROM events WHERE id IN ({placeholders})
+        """, [now] + event_ids)
+        conn.execute(f"""
+            INSERT OR REPLACE INTO archived_rsvp ({RSVP_COLUMNS})
+            SELECT {RSVP_COLUMNS} FROM rsvp WHERE event_id IN ({placeholders})
+        """, event_ids)
+        conn.execute(f"""
+            INSERT INTO archived_reminders ({REMINDER_COLUMNS})
+            SELECT {REMINDER_COLUMNS} FROM reminders WHERE event_id IN ({placeholders})
+        """, event_ids)
+        conn.execute(f"""
+            INSERT OR IGNORE INTO archived_event_exceptions (event_id, occurrence)
+            SELECT event_id, occurrence FROM event_exceptions WHERE event_id IN ({placeholders})
+        """, event_ids)
+        for table in ('rsvp', 'reminders', 'event_exceptions', 'reaction_users', 'reaction_checkpoints'):
+            conn.execute(f'DELETE FROM {table} WHERE event_id IN ({placeholders})', event_ids)
+        conn.execute(f'DELETE FROM events WHERE id IN ({placeholders})', event_ids)
+
+    # Delivered reminders of events still to come are only kept for the record
+    ownership, params = owned(leases, 'e.guild_id', time.time())
+    sent = [row[0] for row in conn.execute(f"""
+        SELECT r.id
+        FROM reminders r
+        JOIN events e ON e.id = r.event_id
+        WHERE r.notification_sent = 1
+        AND {ownership}
+        LIMIT ?
+    """, params + [limit])]
+    if sent:
+        placeholders = ','.join('?' * len(sent))
+        conn.execute(f"""
+            INSERT INTO archived_reminders ({REMINDER_COLUMNS})
+            SELECT {REMINDER_COLUMNS} FROM reminders WHERE id IN ({placeholders})
+        """, sent)
+        conn.execute(f'DELETE FROM reminders WHERE id IN ({placeholders})', sent)
+
+    return event_ids, [row[1] for row in rows if row[1] is not None], len(sent)
+
+
+class Archiver:
+    """Background compaction that keeps the hot tables down to live and recent events
+
+    Work is done in small batches with a pause between them, so the write lock is never held for
+    long and live commands interleave with a large backlog.
+    """
+
+    def __init__(self, db, retention_days=30, batch_size=200, pause=0.5, interval=3600, leases=None,
+                 on_archived=None):
+        self.db = db
+        self.retention = retention_days * 86400
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.leases = leases
+        # Called with (event_ids, message_ids) after each batch so in-memory caches can forget them
+        self.on_archived = on_archived
+        self._task = None
+
+    def cutoff(self):
+        """Events that ended before this epoch second are archived"""
+        return int(time.time()) - self.retention
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run_once(self):
+        """Archive everything currently eligible; returns (events, reminders) moved"""
+        events = reminders = 0
+        while True:
+            event_ids, message_ids, sent = await self.db.run(archive_batch, self.cutoff(), self.batch_size,
+                                                             self.leases)
+            events += len(event_ids)
+            reminders += sent
+            if event_ids and self.on_archived is not None:
+                self.on_archived(event_ids, message_ids)
+            if len(event_ids) < self.batch_size and sent < self.batch_size:
+                return events, reminders
+            await asyncio.sleep(self.pause)
+
+    async def _run(self):
+        while True:
+            try:
+                events, reminders = await self.run_once()
+                if events or reminders:
+                    log.info('Archived %d event(s) and %d sent reminder(s)', events, reminders)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Archiving failed')
+            await asyncio.sleep(self.interval)
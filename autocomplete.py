@@ -0,0 +1,145 @@
+import time
+from bisect import bisect_left, insort
+
+from database import from_timestamp
+from sharding import owned
+
+
+def _words(title):
+    """Every suffix of the title that starts a word, so 'Raid night' is found by 'raid' and 'night'"""
+    text = ' '.join(title.lower().split())
+    return [text[i:] for i in range(len(text)) if i == 0 or text[i - 1] == ' ']
+
+
+def _load_all(conn, now, ownership, params):
+    # Upcoming events of every guild in these shards; a series is upcoming until its last occurrence ends
+    return conn.execute(f"""
+        SELECT guild_id, id, title, category, event_time, duration, recurrence IS NOT NULL, recurrence_end
+        FROM events
+        WHERE is_cancelled = 0
+        AND CASE WHEN recurrence IS NULL THEN event_time ELSE COALESCE(recurrence_end, 1 << 62) END
+            + duration * 60 > ?
+        AND {ownership}
+    """, [now] + params).fetchall()
+
+
+class _GuildSuggestions:
+    __slots__ = ('keys', 'events', 'categories', 'category_counts')
+
+    def __init__(self):
+        # Sorted (word suffix, event_id) pairs; a prefix search is one bisect and a short scan
+        self.keys = []
+        # event_id -> (title, category, start, end, recurring)
+        self.events = {}
+        # Sorted (lowercased, as stored) pairs, so matching ignores case but suggests the exact name
+        self.categories = []
+        self.category_counts = {}
+
+
+class SuggestionIndex:
+    """Per-guild prefix index over upcoming event titles, IDs and categories, for autocomplete
+
+    Kept in memory and updated as events are created, cancelled and archived, so suggestions never
+    wait on the database while someone types.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._guilds = {}
+        self._guild_of = {}
+
+    async def hydrate(self, shards=None):
+        """Index every upcoming event in these shards with one read; returns how many were indexed"""
+        ownership, params = owned(shards, 'guild_id')
+        rows = await self.db.run(_load_all, int(time.time()), ownership, params)
+        for row in rows:
+            self.add(*row, keep_sorted=False)
+        # Sorting once is much cheaper than inserting every key in order
+        for guild in self._guilds.values():
+            guild.keys.sort()
+            guild.categories.sort()
+        return len(rows)
+
+    def add(self, guild_id, event_id, title, category, start, duration, recurring=False, recurrence_end=None,
+            keep_sorted=True):
+        if event_id in self._guild_of:
+            self.remove(event_id)
+        guild = self._guilds.setdefault(guild_id, _GuildSuggestions())
+        title = title or ''
+        category = category or 'general'
+        # A series stays suggested until its last occurrence ends, or for good if it has no end
+        end = (start if not recurring else recurrence_end if recurrence_end is not None else 1 << 62) + duration * 60
+        guild.events[event_id] = (title, category, start, end, recurring)
+        self._guild_of[event_id] = guild_id
+        add = insort if keep_sorted else list.append
+        for key in _words(title) + [str(event_id)]:
+            add(guild.keys, (key, event_id))
+        count = guild.category_counts.get(category, 0)
+        if not count:
+            add(guild.categories, (category.lower(), category))
+        guild.category_counts[category] = count + 1
+
+    def remove(self, event_id):
+        guild_id = self._guild_of.pop(event_id, None)
+        if guild_id is None:
+            return
+        guild = self._guilds[guild_id]
+        title, category = guild.events.pop(event_id)[:2]
+        for key in _words(title) + [str(event_id)]:
+            i = bisect_left(guild.keys, (key, event_id))
+            if i < len(guild.keys) and guild.keys[i] == (key, event_id):
+                del guild.keys[i]
+        guild.category_counts[category] -= 1
+        if not guild.category_counts[category]:
+            del guild.category_counts[category]
+            del guild.categories[bisect_left(guild.categories, (category.lower(), category))]
+
+    def category(self, event_id):
+        """The category of an indexed event, or None"""
+        guild_id = self._guild_of.get(event_id)
+        return self._guilds[guild_id].events[event_id][1] if guild_id is not None else None
+
+    def events(self, guild_id, prefix, limit=25):
+        """(event_id, title, start, recurring) of upcoming events whose ID or a title word starts with prefix"""
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            return []
+        prefix = ' '.join(prefix.lower().split())
+        now = time.time()
+        found, stale = {}, []
+        i = bisect_left(guild.keys, (prefix,))
+        while i < len(guild.keys) and len(found) < limit:
+            key, event_id = guild.keys[i]
+            if not key.startswith(prefix):
+                break
+            if event_id not in found:
+                title, _, start, end, recurring = guild.events[event_id]
+                if end <= now:
+                    stale.append(event_id)
+                else:
+                    found[event_id] = (event_id, title, start, recurring)
+            i += 1
+        # Events that finished since they were indexed are dropped the first time they turn up
+        for event_id in stale:
+            self.remove(event_id)
+        return sorted(found.values(), key=lambda event: event[2])
+
+    def categories(self, guild_id, prefix, limit=25):
+        """Categories of upcoming events that start with prefix"""
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            return []
+        prefix = prefix.lower()
+        i = bisect_left(guild.categories, (prefix,))
+        found = []
+        while i < len(guild.categories) and guild.categories[i][0].startswith(prefix) and len(found) < limit:
+            found.append(guild.categories[i][1])
+            i += 1
+        return found
+
+
+def event_label(event_id, title, start, recurring=False):
+    """Autocomplete choice name, within Discord's 100-character limit"""
+    when = 'repeats' if recurring else from_timestamp(start).strftime('%Y-%m-%d %H:%M')
+    label = f"{event_id} · {title} · {when}"
+    return label if len(label) <= 100 else f"{event_id} · {title[:100 - len(label) + len(title) - 1]}… · {when}"
@@ -0,0 +1,357 @@
+"""Synthetic load benchmark for the bot's command handlers, reaction listeners and reminder fan-out.
+
+Drives the real handlers in bot.py against a seeded database through stand-ins for the Discord
+objects they touch, so no connection or token is needed:
+
+    python benchmark.py --guilds 20 --events 500 --rsvps 30 --output results.json
+    python benchmark.py --compare results.json
+
+Results are written as JSON (throughput and p50/p95/p99 latency in milliseconds per operation) so
+runs from different commits can be compared.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f'user{user_id}'
+        self.display_name = self.name
+        self.mention = f'<@{user_id}>'
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    _next_id = 10 ** 12
+
+    def __init__(self, channel, content=None, embed=None):
+        FakeMessage._next_id += 1
+        self.id = FakeMessage._next_id
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeChannel:
+    """Records sends, optionally waiting `latency` seconds per call like a round trip to the API"""
+
+    def __init__(self, channel_id, latency=0.0):
+        self.id = channel_id
+        self.latency = latency
+        self.sent = 0
+        self.send_times = []
+
+    async def send(self, content=None, embed=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+        self.send_times.append(time.time())
+        return FakeMessage(self, content, embed)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self._members = {}
+
+    def get_member(self, user_id):
+        return self._members.setdefault(user_id, FakeUser(user_id))
+
+    async def fetch_member(self, user_id):
+        return self.get_member(user_id)
+
+
+class FakeContext:
+    def __init__(self, guild, channel, author):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        # The invoking message
+        self.message = FakeMessage(channel)
+        # Prefix invocations have no interaction
+        self.interaction = None
+
+    async def send(self, content=None, embed=None, **kwargs):
+        return await self.channel.send(content, embed=embed, **kwargs)
+
+
+class FakeReactionPayload:
+    """The fields of discord.RawReactionActionEvent the listeners read"""
+
+    def __init__(self, message_id, user_id, emoji, guild_id, channel_id):
+        self.message_id = message_id
+        self.user_id = user_id
+        self.emoji = emoji
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+
+
+def percentile(samples, fraction):
+    return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+
+def summarize(latencies, elapsed):
+    """Throughput and latency percentiles (ms) for one operation's samples (seconds)"""
+    samples = sorted(latencies)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'ops_per_sec': round(len(samples) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
+
+
+def seed(conn, args, now):
+    """Fill the database with args.guilds guilds of upcoming events, RSVPs and reminders"""
+    rng = random.Random(args.seed)
+    # Everything starts at least two days out so no seeded reminder falls due during the run
+    horizon = max(args.days, 3) * 86400
+    event_rows = []
+    for guild in range(args.guilds):
+        for _ in range(args.events):
+            event_rows.append((
+                guild + 1, channel_id(guild, rng.randrange(args.channels)), rng.randrange(1, args.users + 1),
+                f'Event {len(event_rows) + 1}', 'Seeded by benchmark.py', now + rng.randrange(2 * 86400, horizon),
+                rng.choice(('general', 'meeting', 'social', 'game')), FakeMessage._next_id + len(event_rows) + 1,
+                rng.choice((30, 60, 90, 120)),
+            ))
+    conn.executemany('''INSERT INTO events (guild_id, channel_id, creator_id, title, description, event_time,
+                                            category, message_id, duration)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', event_rows)
+    FakeMessage._next_id += len(event_rows)
+
+    events = conn.execute('SELECT id, event_time FROM events').fetchall()
+    statuses = ('attending', 'attending', 'maybe', 'not_attending')
+    rsvp_rows = []
+    reminder_rows = []
+    for event_id, event_time in events:
+        for user_id in rng.sample(range(1, args.users + 1), min(args.rsvps, args.users)):
+            rsvp_rows.append((event_id, user_id, rng.choice(statuses)))
+        for reminder in rng.sample((15, 30, 60, 1440), args.reminders):
+            reminder_rows.append((event_id, reminder, event_time - reminder * 60))
+    conn.executemany('INSERT INTO rsvp (event_id, user_id, status) VALUES (?, ?, ?)', rsvp_rows)
+    conn.executemany('INSERT INTO reminders (event_id, reminder_time, fire_at) VALUES (?, ?, ?)', reminder_rows)
+    return len(events), len(rsvp_rows), len(reminder_rows)
+
+
+def seed_due_reminders(conn, args, fire_at):
+    """Events across every guild and channel with a reminder due at fire_at, for the fan-out run"""
+    rng = random.Random(args.seed + 1)
+    created = []
+    for i in range(args.fanout):
+        guild = i % args.guilds
+        c = conn.execute('''INSERT INTO events (guild_id, channel_id, creator_id, title, description, event_time, category)
+                            VALUES (?, ?, ?, ?, ?, ?, 'general')''',
+                         (guild + 1, channel_id(guild, rng.randrange(args.channels)), 1, f'Fan-out {i}', '',
+                          fire_at + 15 * 60))
+        conn.executemany('INSERT INTO rsvp (event_id, user_id, status) VALUES (?, ?, ?)',
+                         [(c.lastrowid, user_id, 'attending')
+                          for user_id in rng.sample(range(1, args.users + 1), min(args.rsvps, args.users))])
+        conn.execute('INSERT INTO reminders (event_id, reminder_time, fire_at) VALUES (?, 15, ?)',
+                     (c.lastrowid, fire_at))
+        created.append(c.lastrowid)
+    return created
+
+
+def channel_id(guild, index):
+    return (guild + 1) * 1000 + index
+
+
+async def timed(latencies, coro):
+    start = time.perf_counter()
+    await coro
+    latencies.append(time.perf_counter() - start)
+
+
+async def run(args):
+    import bot as calendar_bot
+
+    channels = {channel_id(guild, i): FakeChannel(channel_id(guild, i), args.latency)
+                for guild in range(args.guilds) for i in range(args.channels)}
+    guilds = [FakeGuild(guild + 1) for guild in range(args.guilds)]
+    me = FakeUser(1)
+    # Stand in for the gateway: the handlers only need the bot's own user, channels and reaction waits
+    calendar_bot.bot._connection.user = me
+    calendar_bot.bot.get_channel = channels.get
+    calendar_bot.outbox.get_channel = channels.get
+
+    async def no_confirmation(*args, **kwargs):
+        raise asyncio.TimeoutError
+    calendar_bot.bot.wait_for = no_confirmation
+
+    await calendar_bot.db.run(calendar_bot.migrate)
+    now = int(time.time())
+    start = time.perf_counter()
+    counts = await calendar_bot.db.run(seed, args, now)
+    seed_time = time.perf_counter() - start
+    # The real startup sequence, hydrating every cache from the seeded database
+    await calendar_bot.bot.setup_hook()
+    await calendar_bot.on_ready()
+    # Seeded announcements don't exist on Discord, so there are no reactions to backfill
+    calendar_bot.reconciler.stop()
+
+    rng = random.Random(args.seed)
+    commands = {name: getattr(calendar_bot, name).callback for name in ('create_event', 'agenda', 'list_events', 'attendees')}
+    event_ids = [row for row in await calendar_bot.db.fetchall('SELECT id, guild_id, message_id FROM events')]
+    results = {}
+
+    def context(guild):
+        return FakeContext(guild, channels[channel_id(guild.id - 1, rng.randrange(args.channels))],
+                           FakeUser(rng.randrange(2, args.users + 1)))
+
+    async def measure(name, make_call):
+        latencies = []
+        begin = time.perf_counter()
+        for _ in range(args.iterations):
+            await timed(latencies, make_call())
+        results[name] = summarize(latencies, time.perf_counter() - begin)
+
+    # New events go into a guild of their own, minutes apart, so no conflict prompt is needed
+    bench_guild = FakeGuild(args.guilds + 1)
+    channels[channel_id(args.guilds, 0)] = FakeChannel(channel_id(args.guilds, 0), args.latency)
+    first_slot = datetime.now().replace(second=0, microsecond=0) + timedelta(days=1)
+    slots = iter(first_slot + timedelta(hours=2 * i) for i in range(args.iterations))
+
+    def create():
+        slot = next(slots)
+        ctx = FakeContext(bench_guild, channels[channel_id(args.guilds, 0)], FakeUser(2))
+        return commands['create_event'](ctx, 'Benchmark event', slot.strftime('%Y-%m-%d'), slot.strftime('%H:%M'),
+                                        args='--remind 30 --desc Created by benchmark.py')
+
+    await measure('create_event', create)
+
+    def uncached(command, *command_args):
+        # Time the query and render path rather than the rendered-page cache
+        guild = rng.choice(guilds)
+        calendar_bot.page_cache.invalidate(guild.id)
+        return command(context(guild), *command_args)
+
+    await measure('agenda', lambda: uncached(commands['agenda'], args.days))
+    await measure('list_events', lambda: uncached(commands['list_events']))
+
+    def show_attendees():
+        event_id, guild_id, _ = rng.choice(event_ids)
+        return commands['attendees'](context(guilds[guild_id - 1]), event_id)
+
+    await measure('attendees', show_attendees)
+
+    emoji = ('👍', '❓', '👎')
+
+    def reaction(listener):
+        event_id, guild_id, message_id = rng.choice(event_ids)
+        payload = FakeReactionPayload(message_id, rng.randrange(2, args.users + 1), rng.choice(emoji), guild_id,
+                                      channel_id(guild_id - 1, 0))
+        return listener(payload)
+
+    await measure('reaction_add', lambda: reaction(calendar_bot.on_raw_reaction_add))
+    await measure('reaction_remove', lambda: reaction(calendar_bot.on_raw_reaction_remove))
+    start = time.perf_counter()
+    await calendar_bot.rsvp_writer.flush()
+    results['rsvp_flush'] = summarize([time.perf_counter() - start], 0)
+
+    # Reminder fan-out: many reminders fall due together; lag is when the channel saw the message
+    # minus when it was due
+    fire_at = int(time.time()) + 3
+    await calendar_bot.db.run(seed_due_reminders, args, fire_at)
+    calendar_bot.reminder_scheduler.add_many(await calendar_bot.db.fetchall(
+        'SELECT fire_at, id, event_id FROM reminders WHERE fire_at = ? AND notification_sent = 0', (fire_at,)))
+    sent_before = {channel.id: len(channel.send_times) for channel in channels.values()}
+    await asyncio.sleep(max(fire_at - time.time(), 0) + 1.5)
+    await calendar_bot.outbox.join()
+    lag = [sent - fire_at for channel in channels.values() for sent in channel.send_times[sent_before[channel.id]:]]
+    results['reminder_fanout'] = summarize(lag, 0)
+    results['reminder_fanout']['reminders'] = args.fanout
+
+    calendar_bot.reminder_scheduler.stop()
+    calendar_bot.archiver.stop()
+    calendar_bot.db.close()
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'db')},
+        'seeded': {'events': counts[0], 'rsvps': counts[1], 'reminders': counts[2], 'seconds': round(seed_time, 3)},
+        'startup_ms': {name: round(seconds * 1000, 3) for name, seconds in calendar_bot.telemetry.startup.items()},
+        'results': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(baseline, current):
+    """Print p50/p95/p99 changes per operation against a previous run, to stderr"""
+    print(f"{'operation':<18}{'metric':<8}{'baseline':>12}{'current':>12}{'change':>10}", file=sys.stderr)
+    for name, stats in current['results'].items():
+        before = baseline['results'].get(name, {})
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if metric in stats and before.get(metric):
+                change = (stats[metric] - before[metric]) / before[metric] * 100
+                print(f"{name:<18}{metric[:3]:<8}{before[metric]:>12.3f}{stats[metric]:>12.3f}{change:>+9.1f}%",
+                      file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=3, help='channels per guild')
+    parser.add_argument('--events', type=int, default=200, help='events per guild')
+    parser.add_argument('--rsvps', type=int, default=20, help='RSVPs per event')
+    parser.add_argument('--reminders', type=int, default=2, choices=range(0, 5), help='reminders per event')
+    parser.add_argument('--users', type=int, default=500, help='distinct members across all guilds')
+    parser.add_argument('--days', type=int, default=30, help='how far ahead seeded events are spread')
+    parser.add_argument('--iterations', type=int, default=200, help='calls per measured operation')
+    parser.add_argument('--fanout', type=int, default=200, help='reminders falling due at once')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per channel send')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help='database file to seed (default: a fresh temporary file)')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    # Never seed the live calendar: bot.py opens DATABASE_PATH when it is imported
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix='calendar-bench-'), 'calendar_events.db')
+    if os.path.exists(path):
+        sys.exit(f"{path} already exists; pass a new file so the seeded volumes are exact")
+    os.environ['DATABASE_PATH'] = path
+    # Keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,83 +1,269 @@
+import asyncio
+import functools
+import sqlite3
+import tempfile
+import time
+import aiohttp
 import discord
-from discord.ext import commands, tasks
+from discord import app_commands
+from discord.ext import commands
 from datetime import datetime, timedelta
-import sqlite3
+from itertools import islice
+from typing import Optional
 from dotenv import load_dotenv
 import os
 
+from admission import COMMAND, LISTING, Admission, Overloaded
+from archive import Archiver
+from autocomplete import SuggestionIndex, event_label
+from database import RSVP_STATUSES, Database, from_timestamp, migrate, rebuild_rsvp_counts, to_timestamp
+from digest import Digests
+from ics import IcsParser, existing_uids, insert_events, parse_event, write_calendar
+from intervals import ConflictIndex, GuildIntervals, daily_windows, free_slots, merge_busy
+from outbox import Outbox
+from pagination import KeysetPages, PageCache, PageView
+from reconcile import Reconciler
+from recurrence import WEEKDAY_NAMES, Recurrence, parse_repeat
+from members import MemberNames
+from rsvp import STATUS_MAP, EventMessageCache, RsvpWriter, effective_rsvps, rsvp_counts, rsvp_page
+from scheduler import ReminderScheduler
+from search import search_events, search_expression
+from sharding import ShardLeases, Shards, parse_shard_ids
+from telemetry import Telemetry
+from upcoming import UpcomingIndex
+
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'calendar_events.db')
+AGENDA_PAGE_SIZE = 15
+LIST_PAGE_SIZE = 10
+# Names per attendees page; 25 display names of up to 32 characters fit in a 1024-character embed field
+ATTENDEES_PAGE_SIZE = 25
+# Prometheus text endpoint on localhost; disabled unless a port is set
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# Administrators can import .ics files from this folder on the bot's host
+ICS_IMPORT_DIR = os.getenv('ICS_IMPORT_DIR', 'imports')
+IMPORT_BATCH_SIZE = 500
+# Finished events move to the archive tables this many days after they end
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+# Upcoming events kept in memory for !agenda and !list_events, across the most recently read guilds
+UPCOMING_CACHE_EVENTS = int(os.getenv('UPCOMING_CACHE_EVENTS', '200000'))
+# Commands each server can start per minute, in token-bucket costs; bursts up to this many are allowed
+GUILD_COMMANDS_PER_MINUTE = int(os.getenv('GUILD_COMMANDS_PER_MINUTE', '20'))
+# Commands that only read; under load they are shed first
+LISTING_COMMANDS = {'agenda', 'list_events', 'search', 'attendees', 'free_slots', 'export_ics', 'help_calendar'}
+# Token costs of the commands that do more work than most
+COMMAND_COSTS = {'agenda': 2, 'free_slots': 2, 'import_ics': 5, 'export_ics': 5}
+MAX_AGENDA_DAYS = 90
+# Reactions shed under load are read back from their announcements this many seconds later
+RECONCILE_AFTER_SHED = 60
+# Local hour at which daily digests, and on Mondays weekly ones, go out
+DIGEST_HOUR = int(os.getenv('DIGEST_HOUR', '8'))
+# Multi-process deployments give every process the same SHARD_COUNT and its own SHARD_IDS (e.g. 0-3);
+# without them one process runs however many shards Discord recommends and owns every guild
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', '')) or None
+if SHARD_IDS and not SHARD_COUNT:
+    raise SystemExit('SHARD_IDS needs SHARD_COUNT')
 
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 intents.reactions = True
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-
-def setup_database():
-    conn = sqlite3.connect('calendar_events.db')
-    c = conn.cursor()
-
-    # Drop existing tables
-    c.execute('DROP TABLE IF EXISTS rsvp')
-    c.execute('DROP TABLE IF EXISTS reminders')
-    c.execute('DROP TABLE IF EXISTS events')
-
-    # Create tables with updated structure
-    c.execute('''CREATE TABLE IF NOT EXISTS events
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  guild_id INTEGER,
-                  channel_id INTEGER,
-                  creator_id INTEGER,
-                  title TEXT,
-                  description TEXT,
-                  event_time TIMESTAMP,
-                  message_id INTEGER,
-                  category TEXT DEFAULT 'general',
-                  is_cancelled BOOLEAN DEFAULT 0)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS rsvp
-                 (event_id INTEGER,
-                  user_id INTEGER,
-                  status TEXT,
-                  FOREIGN KEY(event_id) REFERENCES events(id))''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS reminders
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  event_id INTEGER,
-                  reminder_time INTEGER,
-                  notification_sent BOOLEAN DEFAULT 0,
-                  FOREIGN KEY(event_id) REFERENCES events(id))''')
-    conn.commit()
-    conn.close()
+
+
+class CalendarTree(app_commands.CommandTree):
+    # _call is private to discord.py, which is why requirements.txt pins its minor version
+    async def _call(self, interaction):
+        # Slash commands don't go through CalendarBot.invoke, so they are timed, profiled and admitted here
+        command = interaction.command
+        if command is None or interaction.type is not discord.InteractionType.application_command:
+            return await super()._call(interaction)
+        name = command.qualified_name
+        with telemetry.track(name):
+            if interaction.guild_id is None:
+                await super()._call(interaction)
+            else:
+                # A slash command must be answered within 3 seconds, so it is deferred if it has to wait
+                try:
+                    await admission.run(interaction.guild_id, functools.partial(super()._call, interaction),
+                                        LISTING if name in LISTING_COMMANDS else COMMAND, COMMAND_COSTS.get(name, 1),
+                                        on_wait=interaction.response.defer)
+                except Overloaded:
+                    if interaction.response.is_done():
+                        await interaction.followup.send(BUSY_MESSAGE, ephemeral=True)
+                    else:
+                        await interaction.response.send_message(BUSY_MESSAGE, ephemeral=True)
+                    return
+        if interaction.command_failed:
+            telemetry.failed(name)
+
+
+class CalendarBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        # Runs once per process, before the first gateway connection; on_ready fires again after
+        # every reconnect, so nothing that must happen once belongs there
+        with telemetry.phase('total'):
+            with telemetry.phase('migrate'):
+                # Upgrade the schema in place; existing events are kept
+                await db.run(migrate)
+            with telemetry.phase('shard_leases'):
+                await shard_leases.renew()
+            # Warm every in-memory cache with a few bulk reads, side by side on the pool
+            messages, (guilds, indexed), reminders, _ = await asyncio.gather(
+                startup_phase('message_cache', event_messages.load()),
+                startup_phase('conflict_index', conflict_index.hydrate(shards)),
+                startup_phase('reminder_queue', reminder_scheduler.hydrate()),
+                startup_phase('suggestions', suggestions.hydrate(shards)),
+            )
+        shard_leases.start()
+        reminder_scheduler.start()
+        archiver.start()
+        digests.start()
+        telemetry.start(METRICS_PORT)
+        # Slash commands are global, so one process registering them is enough
+        if self.application_id and 0 in shards.ids:
+            await self.tree.sync()
+        print(f"Started in {format_ms(telemetry.startup['total'])}: {messages} event messages, "
+              f"{indexed} upcoming events in {guilds} guilds, {reminders} queued reminders "
+              f"({', '.join(f'{name} {format_ms(seconds)}' for name, seconds in telemetry.startup.items() if name != 'total')})")
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        name = ctx.command.qualified_name
+        with telemetry.track(name):
+            if ctx.guild is None:
+                await super().invoke(ctx)
+            else:
+                # Waits its server's turn, so no one server can hold up everyone else's commands
+                try:
+                    await admission.run(ctx.guild.id, functools.partial(super().invoke, ctx),
+                                        LISTING if name in LISTING_COMMANDS else COMMAND, COMMAND_COSTS.get(name, 1))
+                except Overloaded:
+                    await ctx.send(BUSY_MESSAGE)
+                    return
+        if ctx.command_failed:
+            telemetry.failed(name)
+
+    async def close(self):
+        # Don't lose RSVPs still waiting in the write-behind queue, or queued notifications
+        reconciler.stop()
+        digests.stop()
+        await rsvp_writer.flush()
+        try:
+            await asyncio.wait_for(outbox.join(), timeout=10)
+        except asyncio.TimeoutError:
+            pass
+        # Hand our shards straight to a replacement process instead of letting the leases expire
+        reminder_scheduler.stop()
+        archiver.stop()
+        try:
+            await shard_leases.release()
+        finally:
+            await super().close()
+
+
+bot = CalendarBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+                  tree_cls=CalendarTree)
+telemetry = Telemetry()
+# Fair share of command slots per server, and what gets shed first when there are too many
+admission = Admission(rate=GUILD_COMMANDS_PER_MINUTE, per=60.0)
+BUSY_MESSAGE = "⏳ This server is sending commands faster than I can answer them. Please try again shortly."
+
+# Shared connection pool; every query runs on its worker threads, never on the event loop
+db = Database(DATABASE_PATH, pool_size=int(os.getenv('DATABASE_POOL_SIZE', '4')), observer=telemetry.observe_sql)
+# The guilds this process handles; reminders are sent only while it holds their shards' leases
+shards = Shards(SHARD_COUNT or 1, SHARD_IDS)
+shard_leases = ShardLeases(db, shards)
+event_messages = EventMessageCache(db, shards)
+conflict_index = ConflictIndex(db)
+# Upcoming events per guild, so agenda and list pages are sliced from memory
+upcoming = UpcomingIndex(db, UPCOMING_CACHE_EVENTS)
+rsvp_writer = RsvpWriter(db, on_flush=upcoming.refresh_rsvps)
+# Channel messages the bot sends on its own (reminders, cancellations) go through one paced queue
+outbox = Outbox(bot.get_channel, on_lag=telemetry.reminder_lag.observe)
+# Rendered agenda/list pages, dropped per guild whenever its events change
+page_cache = PageCache()
+# Upcoming event titles and categories for slash command autocomplete
+suggestions = SuggestionIndex(db)
+# Attendee pages are cached only for paging within one !attendees view
+attendee_pages = PageCache(max_entries=256)
+member_names = MemberNames()
+
+
+def forget_archived(event_ids, message_ids):
+    # Archived events are all in the past, so only their announcements and suggestions need dropping
+    for message_id in message_ids:
+        event_messages.discard(message_id)
+    for event_id in event_ids:
+        suggestions.remove(event_id)
+    upcoming.discard(event_ids)
+
+
+# Keeps the hot tables down to upcoming and recently finished events
+archiver = Archiver(db, ARCHIVE_AFTER_DAYS, leases=shard_leases, on_archived=forget_archived)
+# Catches up on RSVP reactions made while the bot was disconnected
+reconciler = Reconciler(bot, db, rsvp_writer, shards)
+# Opt-in daily and weekly digests, built for every subscribed guild in one pass
+digests = Digests(bot, db, outbox, leases=shard_leases, hour=DIGEST_HOUR)
+
+
+async def startup_phase(name, coro):
+    with telemetry.phase(name):
+        return await coro
 
 
 @bot.event
 async def on_ready():
+    # Everything is already loaded by setup_hook; this only records how long the first connection took
+    telemetry.startup.setdefault('ready', time.time() - telemetry.started_at)
     print(f'{bot.user} has connected to Discord!')
-    setup_database()
-    check_reminders.start()
-
+    # Reactions made while we were disconnected never arrive as events; backfill them in the background
+    reconciler.start()
+
+
+def conflict_slots(event_time, duration, rule=None):
+    """The (start, end) slots to check for conflicts: the event, or a series' next year of occurrences"""
+    if rule is None:
+        event_ts = to_timestamp(event_time)
+        return [(event_ts, event_ts + duration * 60)]
+    # At most 52 occurrences, so long-running daily series stay cheap to check
+    start = max(event_time, datetime.now())
+    occurrences = islice(rule.occurrences(event_time, start, start + timedelta(days=365)), 52)
+    return [(to_timestamp(o), to_timestamp(o) + duration * 60) for o in occurrences]
+
+
+async def check_time_conflicts(event_time, guild_id, duration=60, rule=None):
+    """Check for existing events overlapping the proposed time, or a series' first occurrences"""
+    if rule is None:
+        event_ts = to_timestamp(event_time)
+        conflicts = await conflict_index.overlapping(guild_id, event_ts, event_ts + duration * 60)
+    else:
+        # Check the series' occurrences in one batch
+        slots = conflict_slots(event_time, duration, rule)
+        seen = set()
+        conflicts = []
+        for slot_conflicts in await conflict_index.overlapping_many(guild_id, slots):
+            for conflict in slot_conflicts:
+                if conflict[:3] not in seen:
+                    seen.add(conflict[:3])
+                    conflicts.append(conflict)
 
-async def check_time_conflicts(event_time, guild_id, conn):
-    """Check for existing events at the same time"""
-    c = conn.cursor()
-    # Check for events within 1 hour before or after the proposed time
-    time_before = (datetime.strptime(event_time, "%Y-%m-%d %H:%M") - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M")
-    time_after = (datetime.strptime(event_time, "%Y-%m-%d %H:%M") + timedelta(hours=1)).strftime("%Y-%m-%d %H:%M")
+    return [(title, from_timestamp(start).strftime("%Y-%m-%d %H:%M")) for _, title, start, _ in conflicts]
 
-    c.execute("""
-        SELECT title, event_time
-        FROM events
-        WHERE guild_id = ?
-        AND event_time BETWEEN ? AND ?
-        AND is_cancelled = 0
-    """, (guild_id, time_before, time_after))
 
-    return c.fetchall()
+def occurrence_time(event_time, recurrence, date):
+    """Resolve a YYYY-MM-DD date to the timestamp of that day's occurrence of a series"""
+    dtstart = from_timestamp(event_time)
+    day = datetime.strptime(date, "%Y-%m-%d")
+    occurrence = dtstart.replace(year=day.year, month=day.month, day=day.day)
+    if Recurrence.parse(recurrence).first(dtstart, occurrence) != occurrence:
+        raise ValueError(f"The event doesn't occur on {date}")
+    return to_timestamp(occurrence)
 
 
 @bot.command()
@@ -88,6 +274,9 @@ async def create_event(ctx, title: str, date: str, time: str, *, args: str = "")
         description = "No description provided"
         category = "general"
         reminders = [30]  # Default 30-minute reminder
+        duration = 60  # Default one-hour event
+        repeat = {}  # Recurrence options, if this is a series
+        exceptions = []
 
         if args:
             if args.startswith('"') and args.endswith('"'):
@@ -106,17 +295,62 @@ async def create_event(ctx, title: str, date: str, time: str, *, args: str = "")
                         except ValueError:
                             await ctx.send("Invalid reminder format. Using default 30-minute reminder.")
                             reminders = [30]
+                    elif part.startswith('dur '):
+                        try:
+                            duration = int(part[4:])
+                            if duration <= 0:
+                                raise ValueError
+                        except ValueError:
+                            await ctx.send("Invalid duration format. Using default 60-minute duration.")
+                            duration = 60
+                    elif part.startswith('repeat '):
+                        repeat['freq'] = part[7:]
+                    elif part.startswith('every '):
+                        repeat['every'] = part[6:]
+                    elif part.startswith('on '):
+                        repeat['on'] = part[3:]
+                    elif part.startswith('until '):
+                        repeat['until'] = part[6:].strip()
+                    elif part.startswith('count '):
+                        repeat['count'] = part[6:]
+                    elif part.startswith('except '):
+                        exceptions = [x.strip() for x in part[7:].split(',')]
 
         event_datetime = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
 
-        # Check for conflicts
-        conn = sqlite3.connect('calendar_events.db')
-        conflicts = await check_time_conflicts(f"{date} {time}", ctx.guild.id, conn)
+        # Recurring series
+        rule = None
+        if repeat:
+            try:
+                rule = parse_repeat(repeat.get('freq', 'weekly'), every=int(repeat.get('every', 1)),
+                                    on=repeat.get('on'), until=repeat.get('until'),
+                                    count=int(repeat['count']) if 'count' in repeat else None)
+                exception_times = [
+                    to_timestamp(datetime.strptime(f"{x} {time}", "%Y-%m-%d %H:%M")) for x in exceptions
+                ]
+            except (ValueError, KeyError):
+                await ctx.send("Invalid repeat options. Use --repeat daily|weekly|weekdays|monthly "
+                               "[--every N] [--on mon,wed] [--until YYYY-MM-DD] [--count N] "
+                               "[--except YYYY-MM-DD,...]")
+                return
+            # Reminders and the announcement start from the next occurrence, not a start date in the past
+            first_occurrence = rule.first(event_datetime, max(event_datetime, datetime.now()))
+            if first_occurrence is None:
+                await ctx.send("That repeat rule has no upcoming occurrences.")
+                return
+            last_occurrence = rule.last(event_datetime)
+        else:
+            first_occurrence = event_datetime
+
+        # Check for conflicts (no connection is held while waiting for confirmation)
+        conflicts = await check_time_conflicts(event_datetime, ctx.guild.id, duration, rule)
 
         if conflicts:
             conflict_msg = "⚠️ There are existing events around this time:\n"
-            for event in conflicts:
+            for event in conflicts[:10]:
                 conflict_msg += f"- {event[0]} at {event[1]}\n"
+            if len(conflicts) > 10:
+                conflict_msg += f"...and {len(conflicts) - 10} more\n"
             conflict_msg += "\nWould you like to schedule anyway?"
 
             confirm_msg = await ctx.send(conflict_msg)
@@ -127,47 +361,84 @@ async def create_event(ctx, title: str, date: str, time: str, *, args: str = "")
                 return user == ctx.author and str(reaction.emoji) in ['✅',
                                                                       '❌'] and reaction.message.id == confirm_msg.id
 
+            # Don't hold up the server's other commands while waiting for an answer
+            admission.detach()
             try:
                 reaction, user = await bot.wait_for('reaction_add', timeout=30.0, check=check)
                 if str(reaction.emoji) == '❌':
                     await ctx.send("Event creation cancelled.")
-                    conn.close()
                     return
             except TimeoutError:
                 await ctx.send("No confirmation received within 30 seconds. Event creation cancelled.")
-                conn.close()
                 return
 
-        conn = sqlite3.connect('calendar_events.db')
-        c = conn.cursor()
-
-        # Create event
-        c.execute('''INSERT INTO events (guild_id, channel_id, creator_id, title, description, event_time, category)
-                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                  (ctx.guild.id, ctx.channel.id, ctx.author.id, title, description, event_datetime, category))
-        event_id = c.lastrowid
-
-        # Add reminders
+        event_ts = to_timestamp(event_datetime)
+        # A reminder whose time has already passed would be dropped as overdue, so a series starts it from
+        # the first occurrence still far enough away, and a one-off event goes without it
+        now = datetime.now()
+        scheduled, too_late = [], []
         for reminder in reminders:
-            c.execute('INSERT INTO reminders (event_id, reminder_time) VALUES (?, ?)',
-                      (event_id, reminder))
-
-        conn.commit()
+            occurrence = first_occurrence
+            if occurrence - timedelta(minutes=reminder) <= now:
+                occurrence = rule.first(event_datetime, now + timedelta(minutes=reminder, seconds=1)) if rule else None
+            if occurrence is None:
+                too_late.append(reminder)
+            else:
+                scheduled.append((reminder, to_timestamp(occurrence) - reminder * 60))
+
+        def insert_event(conn):
+            # Create event
+            c = conn.execute('''INSERT INTO events (guild_id, channel_id, creator_id, title, description, event_time, category,
+                                                   duration, recurrence, recurrence_end)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             (ctx.guild.id, ctx.channel.id, ctx.author.id, title, description, event_ts, category,
+                              duration, str(rule) if rule else None,
+                              to_timestamp(last_occurrence) if rule and last_occurrence else None))
+            event_id = c.lastrowid
+            if rule:
+                conn.executemany('INSERT OR IGNORE INTO event_exceptions (event_id, occurrence) VALUES (?, ?)',
+                                 [(event_id, occurrence) for occurrence in exception_times])
+
+            # Add reminders; a series keeps one row per offset, pointed at its next occurrence
+            conn.executemany('INSERT INTO reminders (event_id, reminder_time, fire_at) VALUES (?, ?, ?)',
+                             [(event_id, reminder, fire_at) for reminder, fire_at in scheduled])
+            reminder_rows = conn.execute('SELECT id, fire_at FROM reminders WHERE event_id = ?', (event_id,)).fetchall()
+            return event_id, reminder_rows
+
+        event_id, reminder_rows = await db.run(insert_event)
+        reminder_scheduler.add(event_id, reminder_rows)
+        if rule:
+            conflict_index.add_series(ctx.guild.id, event_id, title, rule, event_datetime, duration * 60)
+            for occurrence in exception_times:
+                conflict_index.add_exception(ctx.guild.id, event_id, occurrence)
+        else:
+            conflict_index.add(ctx.guild.id, event_id, title, event_ts, event_ts + duration * 60)
+        suggestions.add(ctx.guild.id, event_id, title, category, event_ts, duration, bool(rule),
+                        to_timestamp(last_occurrence) if rule and last_occurrence else None)
+        upcoming.add(ctx.guild.id, event_id, title, event_ts, category, description, str(rule) if rule else None,
+                     to_timestamp(last_occurrence) if rule and last_occurrence else None,
+                     exception_times if rule else ())
+        page_cache.invalidate(ctx.guild.id)
 
         embed = discord.Embed(title="Event Created", color=discord.Color.green())
         embed.add_field(name="Title", value=title)
         embed.add_field(name="Category", value=category)
-        embed.add_field(name="Date & Time", value=event_datetime.strftime("%Y-%m-%d %H:%M"))
+        embed.add_field(name="Date & Time", value=first_occurrence.strftime("%Y-%m-%d %H:%M"))
+        embed.add_field(name="Duration", value=f"{duration} minutes")
+        if rule:
+            embed.add_field(name="Repeats", value=rule.describe())
         embed.add_field(name="Description", value=description)
         embed.add_field(name="Reminders", value=f"{', '.join(f'{r} minutes' for r in reminders)} before event")
+        if too_late:
+            embed.add_field(name="Skipped Reminders",
+                            value=f"{', '.join(f'{r} minutes' for r in too_late)}: the event starts sooner than that")
         embed.set_footer(text=f"Event ID: {event_id}\nReact with 👍 to attend, ❓ for maybe, 👎 for not attending")
 
         message = await ctx.send(embed=embed)
 
         # Save message ID
-        c.execute('UPDATE events SET message_id = ? WHERE id = ?', (message.id, event_id))
-        conn.commit()
-        conn.close()
+        await db.execute('UPDATE events SET message_id = ? WHERE id = ?', (message.id, event_id))
+        event_messages.add(message.id, event_id)
 
         # Add reaction options
         await message.add_reaction('👍')
@@ -205,7 +476,7 @@ def create_ascii_table(events):
         event_id, title, event_time, category, attending_count = event
 
         # Format the event time
-        event_time = datetime.strptime(event_time, "%Y-%m-%d %H:%M:%S")
+        event_time = from_timestamp(event_time)
         formatted_time = event_time.strftime("%Y-%m-%d %H:%M")
 
         # Truncate title if too long
@@ -228,114 +499,264 @@ def create_ascii_table(events):
 
 @bot.command()
 async def agenda(ctx, days: int = 7):
-    """Show upcoming events in an ASCII table format for the next X days (default 7)"""
-    conn = sqlite3.connect('calendar_events.db')
-    c = conn.cursor()
-
-    current_time = datetime.now()
-    end_time = current_time + timedelta(days=days)
-
-    # Get upcoming events within the specified time range
-    c.execute("""
-        SELECT e.id, e.title, e.event_time, e.category,
-               (SELECT COUNT(*) FROM rsvp 
-                WHERE event_id = e.id AND status = 'attending') as attending_count
-        FROM events e
-        WHERE e.guild_id = ?
-        AND datetime(e.event_time) >= datetime(?)
-        AND datetime(e.event_time) <= datetime(?)
-        AND e.is_cancelled = 0
-        ORDER BY e.event_time ASC
-    """, (ctx.guild.id, current_time, end_time))
-
-    events = c.fetchall()
-    conn.close()
-
-    # Create and send the ASCII table
-    table = create_ascii_table(events)
-
-    # Add header and footer messages
-    header_msg = f"📅 **Agenda for the next {days} days**\n"
-    if events:
-        footer_msg = f"\nShowing {len(events)} upcoming event(s)"
-    else:
-        footer_msg = "\nNo upcoming events found"
-
-    await ctx.send(f"{header_msg}{table}{footer_msg}")
-
-@bot.command()
-async def list_events(ctx, category: str = None):
-    """List all upcoming events, optionally filtered by category"""
-    conn = sqlite3.connect('calendar_events.db')
-    c = conn.cursor()
-
-    current_time = datetime.now()
+    """Show upcoming events in an ASCII table format for the next X days (default 7, at most 90)"""
+    days = min(max(days, 1), MAX_AGENDA_DAYS)
+    # Pages are cached per minute, so repeated calls within it reuse the rendered tables
+    current_time = datetime.now().replace(second=0, microsecond=0)
+    start = to_timestamp(current_time)
+    end = to_timestamp(current_time + timedelta(days=days))
+    await rsvp_writer.flush()
+
+    async def fetch(after, limit):
+        return await upcoming.upcoming(ctx.guild.id, start, end, None, None, after, limit)
+
+    def render(rows, page, has_next):
+        events = [(event_id, title, event_time, category, count) for event_id, title, event_time, category, _, count, _ in rows]
+
+        # Create the ASCII table
+        table = create_ascii_table(events)
+
+        # Add header and footer messages
+        header_msg = f"📅 **Agenda for the next {days} days**\n"
+        if not events:
+            footer_msg = "\nNo upcoming events found"
+        elif page or has_next:
+            footer_msg = f"\nPage {page + 1}, showing {len(events)} upcoming event(s)"
+        else:
+            footer_msg = f"\nShowing {len(events)} upcoming event(s)"
+        return f"{header_msg}{table}{footer_msg}", None
 
-    if category:
-        c.execute("""
-            SELECT id, title, event_time, category, description 
-            FROM events 
-            WHERE guild_id = ? 
-            AND datetime(event_time) >= datetime(?)
-            AND is_cancelled = 0 
-            AND category = ?
-            ORDER BY event_time
-        """, (ctx.guild.id, current_time, category))
-    else:
-        c.execute("""
-            SELECT id, title, event_time, category, description 
-            FROM events 
-            WHERE guild_id = ? 
-            AND datetime(event_time) >= datetime(?)
-            AND is_cancelled = 0
-            ORDER BY event_time
-        """, (ctx.guild.id, current_time))
+    pages = KeysetPages(fetch, render, lambda row: (row[2], row[0]), AGENDA_PAGE_SIZE,
+                        page_cache, (ctx.guild.id, 'agenda', days, start))
+    await send_pages(ctx, pages)
 
-    events = c.fetchall()
-
-    if not events:
-        await ctx.send("No upcoming events found!")
-        conn.close()
-        return
 
+def render_event_list(rows, page, has_next):
+    """One page of list_events as an embed"""
     embed = discord.Embed(
         title="📅 Upcoming Events",
         color=discord.Color.blue()
     )
 
-    for event in events:
-        event_id, title, event_time, event_category, description = event
-        # Get RSVP count
-        c.execute("""
-            SELECT COUNT(*) 
-            FROM rsvp 
-            WHERE event_id = ? AND status = 'attending'
-        """, (event_id,))
-        attending_count = c.fetchone()[0]
-
-        event_time = datetime.strptime(event_time, "%Y-%m-%d %H:%M:%S")
+    for event in rows:
+        event_id, title, event_time, event_category, description, attending_count, recurrence = event
+        event_time = from_timestamp(event_time)
         field_name = f"{title} (ID: {event_id})"
+        repeats = f"🔁 Repeats {Recurrence.parse(recurrence).describe()}\n" if recurrence else ""
         field_value = (
             f"📆 {event_time.strftime('%Y-%m-%d %H:%M')}\n"
+            f"{repeats}"
             f"📁 Category: {event_category}\n"
             f"👥 Attending: {attending_count}\n"
             f"📝 {description[:100]}{'...' if len(description) > 100 else ''}"
         )
         embed.add_field(name=field_name, value=field_value, inline=False)
 
-    conn.close()
+    if page or has_next:
+        embed.set_footer(text=f"Page {page + 1}")
+    return None, embed
+
+
+@bot.hybrid_command()
+@app_commands.describe(category="Only events in this category")
+async def list_events(ctx, category: str = None):
+    """List all upcoming events, optionally filtered by category"""
+    current_time = datetime.now().replace(second=0, microsecond=0)
+    start = to_timestamp(current_time)
+    await rsvp_writer.flush()
+
+    async def fetch(after, limit):
+        # Series show only their next occurrence here
+        return await upcoming.upcoming(ctx.guild.id, start, None, category, 1, after, limit)
+
+    def render(rows, page, has_next):
+        if not rows:
+            return "No upcoming events found!", None
+        return render_event_list(rows, page, has_next)
+
+    pages = KeysetPages(fetch, render, lambda row: (row[2], row[0]), LIST_PAGE_SIZE,
+                        page_cache, (ctx.guild.id, 'list', category, start))
+    await send_pages(ctx, pages)
+
+
+async def send_pages(ctx, pages):
+    """Send the first page, with buttons to page through the rest if there is more than one"""
+    (content, embed), has_next = await pages.page(0)
+    if has_next:
+        await ctx.send(content, embed=embed, view=PageView(pages, ctx.author.id, has_next))
+    else:
+        await ctx.send(content, embed=embed)
+
+
+def parse_length(text):
+    """Minutes in '90', '90m', '2h' or '1h30m'"""
+    text = text.strip().lower()
+    hours, _, minutes = text.partition('h') if 'h' in text else ('0', '', text)
+    minutes = minutes.removesuffix('m') or '0'
+    if not (hours.isdigit() and minutes.isdigit()) or int(hours) * 60 + int(minutes) <= 0:
+        raise ValueError(text)
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_clock(text):
+    """Minutes after midnight in 'HH:MM'"""
+    parsed = datetime.strptime(text.strip(), "%H:%M")
+    return parsed.hour * 60 + parsed.minute
+
+
+def load_attended(conn, guild_id, user_ids):
+    """IDs of the guild's events any of these users is attending"""
+    placeholders = ','.join('?' * len(user_ids))
+    return {row[0] for row in conn.execute(f"""
+        SELECT DISTINCT r.event_id
+        FROM rsvp r
+        JOIN events e ON e.id = r.event_id
+        WHERE e.guild_id = ? AND r.status = 'attending' AND r.user_id IN ({placeholders})
+    """, [guild_id] + list(user_ids))}
+
+
+@bot.command(name='free_slots')
+async def free_slots_command(ctx, duration: str, days: Optional[int] = 14, *, args: str = ""):
+    """Find the next open slots of at least a given length, optionally within daily hours"""
+    day_start = day_end = 0
+    between = None
+    weekdays = None
+    category = None
+    top = 5
+    try:
+        length = parse_length(duration)
+        for part in args.split('--'):
+            part = part.strip()
+            if part.startswith('between '):
+                between = part[8:].strip()
+                first, last = between.split('-')
+                day_start, day_end = parse_clock(first), parse_clock(last)
+            elif part.startswith('on '):
+                days_text = part[3:].strip().lower()
+                weekdays = ({0, 1, 2, 3, 4} if days_text == 'weekdays' else {5, 6} if days_text == 'weekends'
+                            else {WEEKDAY_NAMES[day.strip()[:3]] for day in days_text.split(',')})
+            elif part.startswith('cat '):
+                category = part[4:].strip()
+            elif part.startswith('top '):
+                top = min(max(int(part[4:]), 1), 25)
+    except (ValueError, KeyError):
+        await ctx.send("Usage: !free_slots <duration, e.g. 2h or 90m> [days ahead] [--between HH:MM-HH:MM] "
+                       "[--on weekdays|weekends|mon,wed] [--cat Category] [--with @members] [--top N]")
+        return
+    # A quarter at most, which keeps the sweep to milliseconds
+    days = min(max(days, 1), 92)
+
+    start = to_timestamp(datetime.now().replace(second=0, microsecond=0) + timedelta(minutes=1))
+    end = start + days * 86400
+    busy = await conflict_index.overlapping(ctx.guild.id, start, end)
+    if category:
+        busy = [event for event in busy if suggestions.category(event[0]) == category]
+    members = ctx.message.mentions if '--with' in args else []
+    if members:
+        # Only the events these members are going to count against them
+        await rsvp_writer.flush()
+        attended = await db.run(load_attended, ctx.guild.id, [member.id for member in members])
+        busy = [event for event in busy if event[0] in attended]
+
+    windows = daily_windows(start, end, day_start, day_end, weekdays)
+    slots = free_slots(merge_busy((event[2], event[3]) for event in busy), windows, length * 60, top)
+
+    embed = discord.Embed(title=f"🗓️ Open slots of {duration} or more", color=discord.Color.green())
+    constraints = [f"next {days} days"]
+    if between:
+        constraints.append(f"between {between}")
+    if category:
+        constraints.append(f"counting only {category} events")
+    if members:
+        constraints.append(f"around events of {', '.join(member.display_name for member in members)}")
+    embed.description = ', '.join(constraints)
+    for slot_start, slot_end in slots:
+        opens, closes = from_timestamp(slot_start), from_timestamp(slot_end)
+        hours, minutes = divmod((slot_end - slot_start) // 60, 60)
+        free_for = f"{hours}h{f' {minutes}m' if minutes else ''}" if hours else f"{minutes}m"
+        embed.add_field(
+            name=opens.strftime('%a %Y-%m-%d %H:%M'),
+            value=f"until {closes.strftime('%H:%M' if closes.date() == opens.date() else '%a %Y-%m-%d %H:%M')} "
+                  f"({free_for} free)",
+            inline=False
+        )
+    if not slots:
+        embed.description += "\nNo open slots found."
     await ctx.send(embed=embed)
 
 
+def render_search_results(rows, page, has_next, query, archived):
+    """One page of search results as an embed"""
+    embed = discord.Embed(
+        title=f"🔎 {'Past' if archived else 'Upcoming'} events matching \"{query}\"",
+        color=discord.Color.blue()
+    )
+    for _, event_id, title, event_time, event_category, snippet, recurrence in rows:
+        repeats = f"🔁 Repeats {Recurrence.parse(recurrence).describe()}\n" if recurrence else ""
+        field_value = (
+            f"📆 {from_timestamp(event_time).strftime('%Y-%m-%d %H:%M')}\n"
+            f"{repeats}"
+            f"📁 Category: {event_category}"
+        )
+        if snippet:
+            # Matched words in the description are in bold
+            field_value += f"\n📝 {snippet}"
+        embed.add_field(name=f"{title} (ID: {event_id})", value=field_value, inline=False)
+    if page or has_next:
+        embed.set_footer(text=f"Page {page + 1}")
+    return None, embed
+
+
 @bot.command()
-async def cancel_event(ctx, event_id: int):
-    """Cancel an event"""
-    conn = sqlite3.connect('calendar_events.db')
-    c = conn.cursor()
+async def search(ctx, *, args: str = ""):
+    """Search event titles and descriptions, best match first"""
+    query, *options = args.split('--')
+    query = query.strip()
+    category = start = end = None
+    archived = False
+    expression = search_expression(query)
+    try:
+        for part in options:
+            part = part.strip()
+            if part.startswith('cat '):
+                category = part[4:].strip()
+            elif part.startswith('from '):
+                start = to_timestamp(datetime.strptime(part[5:].strip(), "%Y-%m-%d"))
+            elif part.startswith('to '):
+                end = to_timestamp(datetime.strptime(part[3:].strip(), "%Y-%m-%d") + timedelta(days=1))
+            elif part == 'archived':
+                archived = True
+    except ValueError:
+        expression = None
+    if expression is None:
+        await ctx.send("Usage: !search <words> [--cat Category] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--archived]")
+        return
+
+    now = to_timestamp(datetime.now().replace(second=0, microsecond=0))
+
+    async def fetch(after, limit):
+        return await db.run(search_events, ctx.guild.id, expression, now, archived, category, start, end, after, limit)
+
+    def render(rows, page, has_next):
+        if not rows:
+            return f"No {'past' if archived else 'upcoming'} events match \"{query}\".", None
+        return render_search_results(rows, page, has_next, query, archived)
 
+    pages = KeysetPages(fetch, render, lambda row: (row[0], row[1]), LIST_PAGE_SIZE,
+                        page_cache, (ctx.guild.id, 'search', expression, category, start, end, archived, now))
+    await send_pages(ctx, pages)
+
+
+@bot.hybrid_command()
+@app_commands.describe(event_id="The event to cancel", date="For a recurring event, only this date (YYYY-MM-DD)")
+async def cancel_event(ctx, event_id: int, date: str = None):
+    """Cancel an event, or a single date of a recurring event"""
     # Check if user is the event creator
-    c.execute('SELECT creator_id, title, channel_id FROM events WHERE id = ?', (event_id,))
-    event = c.fetchone()
+    event = await db.fetchone("""
+        SELECT creator_id, title, channel_id, message_id, guild_id, event_time, recurrence
+        FROM events
+        WHERE id = ?
+    """, (event_id,))
 
     if not event:
         await ctx.send("Event not found!")
@@ -345,93 +766,546 @@ async def cancel_event(ctx, event_id: int):
         await ctx.send("Only the event creator can cancel this event!")
         return
 
-    # Mark event as cancelled
-    c.execute('UPDATE events SET is_cancelled = 1 WHERE id = ?', (event_id,))
-    conn.commit()
+    if date:
+        if not event[6]:
+            await ctx.send("Only recurring events can be cancelled for a single date.")
+            return
+        try:
+            occurrence = occurrence_time(event[5], event[6], date)
+        except ValueError as e:
+            await ctx.send(f"{e}. Please use: YYYY-MM-DD")
+            return
+
+        # Record the cancelled occurrence as a sparse exception to the series
+        await db.execute('INSERT OR IGNORE INTO event_exceptions (event_id, occurrence) VALUES (?, ?)',
+                         (event_id, occurrence))
+        conflict_index.add_exception(event[4], event_id, occurrence)
+        upcoming.add_exception(event[4], event_id, occurrence)
+        description = f"The {date} occurrence of '{event[1]}' has been cancelled."
+    else:
+        # Mark event as cancelled
+        await db.execute('UPDATE events SET is_cancelled = 1 WHERE id = ?', (event_id,))
+        reminder_scheduler.discard_event(event_id)
+        event_messages.discard(event[3])
+        conflict_index.remove(event[4], event_id)
+        suggestions.remove(event_id)
+        upcoming.remove(event[4], event_id)
+        occurrence = 0
+        description = f"The event '{event[1]}' has been cancelled."
+    page_cache.invalidate(event[4])
 
     # Send cancellation notification
     channel = bot.get_channel(event[2])
     if channel:
         # Get all attendees
-        c.execute('SELECT user_id FROM rsvp WHERE event_id = ? AND status = "attending"', (event_id,))
-        attendees = c.fetchall()
+        await rsvp_writer.flush()
+        rsvps = await db.run(effective_rsvps, event_id, occurrence)
+        attendees = [user_id for user_id, status in rsvps if status == 'attending']
 
         embed = discord.Embed(
             title="🚫 Event Cancelled",
-            description=f"The event '{event[1]}' has been cancelled.",
+            description=description,
             color=discord.Color.red()
         )
 
         # Notify attendees
-        mention_str = ' '.join([f"<@{uid[0]}>" for uid in attendees])
+        mention_str = ' '.join([f"<@{uid}>" for uid in attendees])
         if mention_str:
-            await channel.send(f"Attention {mention_str}, event cancelled:", embed=embed)
+            outbox.send(channel.id, f"Attention {mention_str}, event cancelled:", embed=embed)
         else:
-            await channel.send(embed=embed)
+            outbox.send(channel.id, embed=embed)
 
-    conn.close()
-    await ctx.send(f"Event {event_id} has been cancelled.")
+    if date:
+        await ctx.send(f"Event {event_id} on {date} has been cancelled.")
+    else:
+        await ctx.send(f"Event {event_id} has been cancelled.")
 
 
-@bot.command()
-async def attendees(ctx, event_id: int):
-    """Show who's attending an event"""
-    conn = sqlite3.connect('calendar_events.db')
-    c = conn.cursor()
-
-    # Get event details
-    c.execute("""
-        SELECT title, event_time, is_cancelled 
+STATUS_EMOJI = {status: emoji for emoji, status in STATUS_MAP.items()}
+
+
+@bot.hybrid_command()
+@app_commands.describe(event_id="The event", date="For a recurring event, this date (YYYY-MM-DD)")
+async def attendees(ctx, event_id: int, date: str = None):
+    """Show who's attending an event (for a series, its next occurrence or the given date)"""
+    # Looking up members can take longer than a slash command has to answer
+    if ctx.interaction is not None and not ctx.interaction.response.is_done():
+        await ctx.defer()
+    # Get event details, falling back to the archive for finished events
+    event = await db.fetchone("""
+        SELECT title, event_time, is_cancelled, recurrence
         FROM events 
         WHERE id = ? AND guild_id = ?
     """, (event_id, ctx.guild.id))
-    event = c.fetchone()
+    archived = event is None
+    if archived:
+        event = await db.fetchone("""
+            SELECT title, event_time, is_cancelled, recurrence
+            FROM archived_events
+            WHERE id = ? AND guild_id = ?
+        """, (event_id, ctx.guild.id))
 
     if not event:
         await ctx.send("Event not found!")
-        conn.close()
         return
 
-    title, event_time, is_cancelled = event
+    title, event_time, is_cancelled, recurrence = event
 
-    embed = discord.Embed(
-        title=f"Attendees for: {title}",
-        description=f"Event Time: {event_time}",
-        color=discord.Color.red() if is_cancelled else discord.Color.blue()
-    )
+    occurrence = 0
+    if recurrence:
+        try:
+            if date:
+                occurrence = occurrence_time(event_time, recurrence, date)
+            else:
+                rule = Recurrence.parse(recurrence)
+                dtstart = from_timestamp(event_time)
+                next_occurrence = rule.first(dtstart, datetime.now()) or rule.last(dtstart)
+                occurrence = to_timestamp(next_occurrence)
+        except ValueError as e:
+            await ctx.send(f"{e}. Please use: YYYY-MM-DD")
+            return
+        event_time = occurrence
+
+    # Counts come from one grouped query; names are only fetched for the page being shown
+    await rsvp_writer.flush()
+    counts = await db.run(rsvp_counts, event_id, occurrence, archived)
+    summary = ' · '.join(f"{STATUS_EMOJI[status]} {counts.get(status, 0)}" for status in RSVP_STATUSES)
+
+    async def fetch(after, limit):
+        rows = await db.run(rsvp_page, event_id, occurrence, archived, after, limit)
+        names = await member_names.resolve(ctx.guild, [user_id for _, user_id, _ in rows])
+        # Anyone whose name can't be looked up is still listed, as a mention
+        return [(rank, user_id, status, discord.utils.escape_markdown(names[user_id]) if user_id in names
+                 else f"<@{user_id}>") for rank, user_id, status in rows]
+
+    def render(rows, page, has_next):
+        embed = discord.Embed(
+            title=f"Attendees for: {title}",
+            description=f"Event Time: {from_timestamp(event_time).strftime('%Y-%m-%d %H:%M')}\n{summary}",
+            color=discord.Color.red() if is_cancelled else discord.Color.blue()
+        )
+        for status in RSVP_STATUSES:
+            names = [name for _, _, row_status, name in rows if row_status == status]
+            if names:
+                embed.add_field(
+                    name=f"{STATUS_EMOJI[status]} {status.replace('_', ' ').title()} ({counts.get(status, 0)})",
+                    value='\n'.join(names)[:1024],
+                    inline=False
+                )
+        if not rows:
+            embed.add_field(name="No RSVPs yet", value="React to the event announcement to RSVP.", inline=False)
+        footer = [f"Page {page + 1}"] if page or has_next else []
+        if archived:
+            footer.append("Archived event")
+        if footer:
+            embed.set_footer(text=' · '.join(footer))
+        return None, embed
+
+    # Pages are only reused while paging through this one view, since RSVPs change without notice
+    pages = KeysetPages(fetch, render, lambda row: (row[0], row[1]), ATTENDEES_PAGE_SIZE,
+                        attendee_pages, (ctx.guild.id, 'attendees', ctx.message.id))
+    await send_pages(ctx, pages)
+
+
+@attendees.autocomplete('event_id')
+@cancel_event.autocomplete('event_id')
+@telemetry.timed('autocomplete_event')
+async def event_autocomplete(interaction, current):
+    # Answered from memory; Discord drops suggestions that take longer than three seconds
+    return [app_commands.Choice(name=event_label(*event), value=event[0])
+            for event in suggestions.events(interaction.guild_id, current)]
+
+
+@list_events.autocomplete('category')
+@telemetry.timed('autocomplete_category')
+async def category_autocomplete(interaction, current):
+    return [app_commands.Choice(name=category, value=category)
+            for category in suggestions.categories(interaction.guild_id, current)]
 
-    # Get attendees by status
-    for status in ['attending', 'maybe', 'not_attending']:
-        c.execute("""
-            SELECT user_id 
-            FROM rsvp 
-            WHERE event_id = ? AND status = ?
-        """, (event_id, status))
-        users = c.fetchall()
-
-        # Convert user IDs to mentions
-        user_list = []
-        for user_id in users:
-            member = ctx.guild.get_member(user_id[0])
-            if member:
-                user_list.append(member.mention)
-
-        status_emoji = {
-            'attending': '👍',
-            'maybe': '❓',
-            'not_attending': '👎'
-        }
 
-        embed.add_field(
-            name=f"{status_emoji[status]} {status.replace('_', ' ').title()} ({len(user_list)})",
-            value='\n'.join(user_list) if user_list else "None",
-            inline=False
-        )
+@bot.command()
+async def digest(ctx, period: str = None, where: str = None):
+    """Get a daily or weekly digest of your events by DM, or of all events in this channel"""
+    period = (period or '').lower()
+    if period not in ('daily', 'weekly', 'off') or where not in (None, 'here'):
+        await ctx.send("Usage: !digest <daily|weekly|off> [here]")
+        return
+    if where == 'here':
+        if not ctx.author.guild_permissions.manage_guild:
+            await ctx.send("Only members who can manage the server can set up digests in a channel.")
+            return
+        kind, target_id = 'channel', ctx.channel.id
+    else:
+        kind, target_id = 'user', ctx.author.id
+
+    if period == 'off':
+        await db.execute('DELETE FROM digest_subscriptions WHERE guild_id = ? AND kind = ? AND target_id = ?',
+                         (ctx.guild.id, kind, target_id))
+        await ctx.send("Digest turned off.")
+        return
+
+    # Counted as already sent for the digest most recently due, so the first one is the next
+    await db.execute('''INSERT INTO digest_subscriptions (guild_id, kind, target_id, period, last_sent)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (guild_id, kind, target_id)
+                        DO UPDATE SET period = excluded.period, last_sent = excluded.last_sent''',
+                     (ctx.guild.id, kind, target_id, period, to_timestamp(digests.due(period, datetime.now()))))
+    when = f"every day at {DIGEST_HOUR:02d}:00" if period == 'daily' else f"every Monday at {DIGEST_HOUR:02d}:00"
+    if kind == 'channel':
+        await ctx.send(f"📬 This channel will get a digest of the server's events {when}.")
+    else:
+        await ctx.send(f"📬 You'll get a DM {when} with the events you're attending or might attend.")
 
-    conn.close()
+
+@bot.command(name='rsvp')
+async def rsvp_command(ctx, event_id: int, status: str, date: str = None):
+    """RSVP to an event, or to a single date of a recurring event"""
+    status = {'yes': 'attending', 'no': 'not_attending'}.get(status.lower(), status.lower())
+    if status not in RSVP_STATUSES and status != 'clear':
+        await ctx.send("Status must be one of: attending, maybe, not_attending, clear")
+        return
+
+    event = await db.fetchone("""
+        SELECT event_time, recurrence
+        FROM events
+        WHERE id = ? AND guild_id = ? AND is_cancelled = 0
+    """, (event_id, ctx.guild.id))
+
+    if not event:
+        await ctx.send("Event not found!")
+        return
+
+    occurrence = 0
+    if date:
+        if not event[1]:
+            await ctx.send("Dates can only be given for recurring events.")
+            return
+        try:
+            occurrence = occurrence_time(event[0], event[1], date)
+        except ValueError as e:
+            await ctx.send(f"{e}. Please use: YYYY-MM-DD")
+            return
+
+    if status == 'clear':
+        rsvp_writer.remove(event_id, ctx.author.id, occurrence)
+    else:
+        rsvp_writer.set(event_id, ctx.author.id, status, occurrence)
+    await ctx.send(f"RSVP updated for event {event_id}{f' on {date}' if date else ''}.")
+
+
+async def attachment_lines(attachment):
+    """Stream an attachment's lines as they download instead of reading the whole file"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                yield line.decode('utf-8', errors='replace')
+
+
+async def file_lines(path):
+    """Read a local file about a megabyte of lines at a time, off the event loop"""
+    with open(path, encoding='utf-8', errors='replace', newline='') as f:
+        while True:
+            lines = await asyncio.to_thread(f.readlines, 1 << 20)
+            if not lines:
+                return
+            for line in lines:
+                yield line
+
+
+class IcsImport:
+    """Validates and conflict-checks parsed VEVENTs in batches, collecting rows for one bulk insert"""
+
+    def __init__(self, guild_id, channel_id, creator_id, allow_conflicts=False):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.creator_id = creator_id
+        self.allow_conflicts = allow_conflicts
+        self.now = datetime.now()
+        self.rows = []
+        self.exceptions = []
+        self.reminders = []
+        self.events = []
+        self.skipped = {'invalid': 0, 'duplicate': 0, 'conflict': 0}
+        self.problems = []
+        self._uids = set()
+        # Events accepted earlier in this import, which don't reach the conflict index until the insert
+        self._accepted = GuildIntervals()
+
+    def _skip(self, reason, problem):
+        self.skipped[reason] += 1
+        if len(self.problems) < 10:
+            self.problems.append(problem)
+
+    async def add_batch(self, batch):
+        events = []
+        for props in batch:
+            try:
+                event = parse_event(props)
+            except (ValueError, KeyError) as e:
+                self._skip('invalid', str(e))
+                continue
+            if event.uid and event.uid in self._uids:
+                self._skip('duplicate', f"'{event.title}' appears twice")
+                continue
+            self._uids.add(event.uid)
+            events.append(event)
+
+        imported = await db.run(existing_uids, self.guild_id, [event.uid for event in events if event.uid])
+        slots = []
+        for event in events:
+            slots.append(conflict_slots(event.start, event.duration, event.rule))
+        if self.allow_conflicts:
+            existing = [[] for _ in slots]
+        else:
+            # One lookup for the whole batch
+            flat = await conflict_index.overlapping_many(self.guild_id, [slot for group in slots for slot in group])
+            existing, i = [], 0
+            for group in slots:
+                existing.append([conflict for found in flat[i:i + len(group)] for conflict in found])
+                i += len(group)
+
+        for event, event_slots, conflicts in zip(events, slots, existing):
+            if event.uid in imported:
+                self._skip('duplicate', f"'{event.title}' was already imported")
+                continue
+            if not self.allow_conflicts:
+                conflicts = conflicts or [c for start, end in event_slots for c in self._accepted.overlapping(start, end)]
+                if conflicts:
+                    self._skip('conflict', f"'{event.title}' conflicts with '{conflicts[0][1]}'")
+                    continue
+            self._accept(event)
+
+    def _accept(self, event):
+        index = len(self.rows)
+        event_ts = to_timestamp(event.start)
+        exception_times = [to_timestamp(exdate) for exdate in event.exdates]
+        if event.rule:
+            last = event.rule.last(event.start)
+            next_occurrence = event.rule.first(event.start, max(event.start, self.now))
+            self._accepted.add_series(index, event.title, event.rule, event.start, event.duration * 60, exception_times)
+            self.exceptions += [(index, occurrence) for occurrence in exception_times]
+        else:
+            last = None
+            next_occurrence = event.start
+            self._accepted.add(index, event.title, event_ts, event_ts + event.duration * 60)
+
+        self.rows.append((self.guild_id, self.channel_id, self.creator_id, event.title, event.description, event_ts,
+                          event.category, event.duration, str(event.rule) if event.rule else None,
+                          to_timestamp(last) if last else None, event.uid))
+        # Reminders from the calendar's alarms, or the usual 30 minutes; none for events already past
+        if next_occurrence is not None:
+            for reminder in event.reminders or [30]:
+                fire_at = to_timestamp(next_occurrence) - reminder * 60
+                if fire_at > to_timestamp(self.now):
+                    self.reminders.append((index, reminder, fire_at))
+        self.events.append((event, exception_times))
+
+
+@bot.command()
+@commands.has_permissions(manage_events=True)
+async def import_ics(ctx, *, args: str = ""):
+    """Import events from an attached .ics file, or (administrators) one in the import folder"""
+    allow_conflicts = '--allow-conflicts' in args
+    path = args.replace('--allow-conflicts', '').strip()
+
+    if ctx.message.attachments:
+        attachment = ctx.message.attachments[0]
+        source, lines = attachment.filename, attachment_lines(attachment)
+    elif path:
+        if not ctx.author.guild_permissions.administrator:
+            await ctx.send("Only administrators can import files from the bot's import folder.")
+            return
+        root = os.path.realpath(ICS_IMPORT_DIR)
+        full_path = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, full_path]) != root or not os.path.isfile(full_path):
+            await ctx.send(f"No file named {path} in the import folder.")
+            return
+        source, lines = path, file_lines(full_path)
+    else:
+        await ctx.send("Attach an .ics file to the command, or give the name of a file in the import folder.")
+        return
+
+    # Imports can take minutes, so they don't keep one of the server's command slots
+    admission.detach()
+    started = datetime.now()
+    ics_import = IcsImport(ctx.guild.id, ctx.channel.id, ctx.author.id, allow_conflicts)
+    parser = IcsParser()
+    batch = []
+    try:
+        async for line in lines:
+            batch += parser.feed(line)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await ics_import.add_batch(batch)
+                batch = []
+        await ics_import.add_batch(batch + parser.close())
+    except (aiohttp.ClientError, OSError, UnicodeError) as e:
+        await ctx.send(f"Couldn't read {source}: {e}")
+        return
+
+    if ics_import.rows:
+        try:
+            event_ids, reminder_rows = await db.run(insert_events, ics_import.rows, ics_import.exceptions,
+                                                    ics_import.reminders)
+        except sqlite3.IntegrityError:
+            await ctx.send("Some of these events were imported at the same time by someone else; nothing was imported.")
+            return
+
+        reminder_scheduler.add_many(reminder_rows)
+        for event_id, (event, exception_times) in zip(event_ids, ics_import.events):
+            if event.rule:
+                conflict_index.add_series(ctx.guild.id, event_id, event.title, event.rule, event.start,
+                                          event.duration * 60)
+                for occurrence in exception_times:
+                    conflict_index.add_exception(ctx.guild.id, event_id, occurrence)
+            else:
+                event_ts = to_timestamp(event.start)
+                conflict_index.add(ctx.guild.id, event_id, event.title, event_ts, event_ts + event.duration * 60)
+        for event_id, row in zip(event_ids, ics_import.rows):
+            # Rows are in events-table order; see ics.insert_events
+            suggestions.add(ctx.guild.id, event_id, row[3], row[6], row[5], row[7], row[8] is not None, row[9])
+        for event_id, row, (_, exception_times) in zip(event_ids, ics_import.rows, ics_import.events):
+            upcoming.add(ctx.guild.id, event_id, row[3], row[5], row[6], row[4], row[8], row[9], exception_times)
+        page_cache.invalidate(ctx.guild.id)
+
+    recurring = sum(1 for event, _ in ics_import.events if event.rule)
+    skipped = ics_import.skipped
+    embed = discord.Embed(title="📥 Import Finished", color=discord.Color.green())
+    embed.add_field(name="Source", value=source)
+    embed.add_field(name="Imported", value=f"{len(ics_import.rows)} event(s), {recurring} recurring")
+    embed.add_field(name="Skipped", value=(f"{skipped['conflict']} conflicting, {skipped['duplicate']} duplicate, "
+                                           f"{skipped['invalid']} invalid"), inline=False)
+    if ics_import.problems:
+        embed.add_field(name="Problems", value='\n'.join(ics_import.problems)[:1024], inline=False)
+    if skipped['conflict']:
+        embed.set_footer(text="Run again with --allow-conflicts to import conflicting events anyway.")
+    embed.description = f"Took {(datetime.now() - started).total_seconds():.1f}s"
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+async def export_ics(ctx, *args):
+    """Export this server's events as an .ics file, optionally for a category and a date range"""
+    category = None
+    start = end = None
+    archived = False
+    for arg in args:
+        if arg == '--archived':
+            archived = True
+        elif '..' in arg:
+            # YYYY-MM-DD..YYYY-MM-DD, either side optional
+            first, _, last = arg.partition('..')
+            try:
+                start = to_timestamp(datetime.strptime(first, "%Y-%m-%d")) if first else None
+                end = to_timestamp(datetime.strptime(last, "%Y-%m-%d") + timedelta(days=1)) - 1 if last else None
+            except ValueError:
+                await ctx.send("Invalid date range. Please use: YYYY-MM-DD..YYYY-MM-DD")
+                return
+        else:
+            category = arg
+
+    # Ranges reaching back past the retention window need the archive as well
+    archived = archived or (start is not None and start < archiver.cutoff())
+
+    with tempfile.TemporaryFile() as fp:
+        count = await db.run(write_calendar, fp, ctx.guild.id, category, start, end, archived)
+        if fp.tell() > ctx.guild.filesize_limit:
+            await ctx.send("That calendar is too large to upload here; try a category or a shorter date range.")
+            return
+        fp.seek(0)
+        # A large upload can be slow; the slot is only needed while the database is read
+        admission.detach()
+        filename = f"{ctx.guild.name or 'calendar'}{f'-{category}' if category else ''}.ics".replace(' ', '_')
+        await ctx.send(f"📤 Exported {count} event(s).", file=discord.File(fp, filename=filename))
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def check_rsvp_counts(ctx):
+    """Rebuild this server's RSVP counters from the rsvp table"""
+    await rsvp_writer.flush()
+    drifted = await db.run(rebuild_rsvp_counts, ctx.guild.id)
+    upcoming.invalidate(ctx.guild.id)
+    if drifted:
+        await ctx.send(f"Fixed RSVP counters for {len(drifted)} event(s): {', '.join(map(str, drifted[:20]))}")
+    else:
+        await ctx.send("RSVP counters are consistent.")
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:.1f}ms"
+
+
+def stats_lines(rows, limit=1000):
+    """Join lines for an embed field, stopping before Discord's 1024-character field limit"""
+    text = ""
+    for row in rows:
+        if len(text) + len(row) + 1 > limit:
+            break
+        text += row + "\n"
+    return text or "None"
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def bot_stats(ctx):
+    """Show latency, database and queue statistics for this bot process"""
+    embed = discord.Embed(title="📈 Bot Stats", color=discord.Color.blurple())
+
+    commands_by_calls = sorted(telemetry.commands.items(), key=lambda item: item[1].count, reverse=True)
+    embed.add_field(name="Commands (calls, p50/p95/p99)", value=stats_lines(
+        f"`{name}` {hist.count}, {format_ms(hist.quantile(0.5))}/{format_ms(hist.quantile(0.95))}/"
+        f"{format_ms(hist.quantile(0.99))}{f', {telemetry.command_failures[name]} failed' if name in telemetry.command_failures else ''}"
+        for name, hist in commands_by_calls
+    ), inline=False)
+
+    # Queries that cost the most in total are the ones worth looking at
+    queries = sorted(telemetry.sql.items(), key=lambda item: item[1].sum, reverse=True)[:8]
+    embed.add_field(name="Slowest queries by total time (calls, p95, rows)", value=stats_lines(
+        f"`{label[:40]}` {hist.count}, {format_ms(hist.quantile(0.95))}, {telemetry.sql_rows.get(label, 0)}"
+        for label, hist in queries
+    ), inline=False)
+
+    loop_lag = telemetry.loop_lag
+    reminder_lag = telemetry.reminder_lag
+    embed.add_field(name="Event loop lag", value=(
+        f"p50 {format_ms(loop_lag.quantile(0.5))}, p99 {format_ms(loop_lag.quantile(0.99))}, "
+        f"max {format_ms(loop_lag.max)}"
+    ), inline=False)
+    embed.add_field(name="Reminder send lag", value=(
+        f"{reminder_lag.count} sent, p50 {format_ms(reminder_lag.quantile(0.5))}, "
+        f"p99 {format_ms(reminder_lag.quantile(0.99))}, max {format_ms(reminder_lag.max)}"
+    ), inline=False)
+    embed.add_field(name="Startup", value=stats_lines(
+        f"{name.replace('_', ' ')}: {format_ms(seconds)}" for name, seconds in telemetry.startup.items()
+    ), inline=False)
+    embed.add_field(name="Queues", value=stats_lines(
+        f"{name.replace('_', ' ')}: {read()}" for name, read in sorted(telemetry.gauges.items())
+    ), inline=False)
     await ctx.send(embed=embed)
 
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def bot_profile(ctx, command: str, invocations: int = 10):
+    """Capture a cProfile of the next N invocations of a command"""
+    if bot.get_command(command) is None:
+        await ctx.send(f"Unknown command: {command}")
+        return
+
+    channel_id = ctx.channel.id
+
+    def done(path):
+        outbox.send(channel_id, f"Profile of `{command}` saved to `{path}`.")
+
+    try:
+        telemetry.profile(bot.get_command(command).qualified_name, max(invocations, 1), PROFILE_DIR, done)
+    except RuntimeError as e:
+        await ctx.send(f"{e}; try again once it finishes.")
+        return
+    await ctx.send(f"Profiling the next {max(invocations, 1)} invocation(s) of `{command}`.")
+
+
 @bot.command()
 async def help_calendar(ctx):
     """Show help information about calendar commands"""
@@ -447,6 +1321,8 @@ async def help_calendar(ctx):
               "--desc Description\n"
               "--cat Category\n"
               "--remind 30,60 (minutes before event)\n"
+              "--dur 90 (length in minutes, default 60)\n"
+              "--repeat daily|weekly|weekdays|monthly [--every 2] [--on mon,wed] [--until YYYY-MM-DD] [--count 10] [--except YYYY-MM-DD,...]\n"
               "Example: !create_event \"Team Meeting\" 2025-01-03 15:00 --desc \"Weekly sync\" --cat work --remind 15,30,60",
         inline=False
     )
@@ -458,133 +1334,180 @@ async def help_calendar(ctx):
     )
 
     embed.add_field(
-        name="!attendees <event_id>",
-        value="Show who's attending an event",
+        name="!search <words> [--cat C] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--archived]",
+        value="Find upcoming events by words in their title or description, best match first; "
+              "--archived searches finished and archived events instead",
         inline=False
     )
 
     embed.add_field(
-        name="!cancel_event <event_id>",
-        value="Cancel an event (only the creator can do this)",
+        name="!attendees <event_id> [YYYY-MM-DD]",
+        value="Show who's attending an event (or one date of a recurring event)",
         inline=False
     )
 
     embed.add_field(
-        name="RSVP System",
-        value="React to event messages with:\n👍 - Attending\n❓ - Maybe\n👎 - Not attending\n\nNote: You can also filter events by category using: !list_events [category]",
+        name="!cancel_event <event_id> [YYYY-MM-DD]",
+        value="Cancel an event, or one date of a recurring event (only the creator can do this)",
         inline=False
     )
 
-    await ctx.send(embed=embed)
+    embed.add_field(
+        name="!rsvp <event_id> <attending|maybe|not_attending|clear> [YYYY-MM-DD]",
+        value="RSVP without reacting, or for a single date of a recurring event",
+        inline=False
+    )
 
+    embed.add_field(
+        name="!digest <daily|weekly|off> [here]",
+        value="Get a daily or weekly DM with the events you're going to; with 'here', post a digest of all "
+              "the server's events in this channel instead (needs Manage Server)",
+        inline=False
+    )
 
-@tasks.loop(minutes=1)
-async def check_reminders():
-    """Check for upcoming events and send reminders"""
-    conn = sqlite3.connect('calendar_events.db')
-    c = conn.cursor()
-
-    current_time = datetime.now()
-
-    # Get all active reminders
-    c.execute("""
-        SELECT e.id, e.title, e.channel_id, e.event_time, r.reminder_time, r.id
-        FROM events e
-        JOIN reminders r ON e.id = r.event_id
-        WHERE e.is_cancelled = 0
-        AND r.notification_sent = 0
-        AND datetime(e.event_time, '-' || r.reminder_time || ' minutes') <= ?
-    """, (current_time.strftime("%Y-%m-%d %H:%M:%S"),))
-
-    reminders = c.fetchall()
-
-    for event_id, title, channel_id, event_time, reminder_time, reminder_id in reminders:
-        channel = bot.get_channel(channel_id)
-        if channel:
-            # Get attendees
-            c.execute('SELECT user_id FROM rsvp WHERE event_id = ? AND status = "attending"', (event_id,))
-            attendees = c.fetchall()
-
-            embed = discord.Embed(
-                title=f"⏰ Reminder: {title}",
-                description=f"Event starting in {reminder_time} minutes!",
-                color=discord.Color.orange()
-            )
+    embed.add_field(
+        name="!free_slots <2h|90m> [days] [--between 18:00-22:00] [--on weekdays] [--cat C] [--with @user] [--top N]",
+        value="Find the next open slots of at least that length in this server's calendar",
+        inline=False
+    )
 
-            # Ping attendees
-            mention_str = ' '.join([f"<@{uid[0]}>" for uid in attendees])
-            if mention_str:
-                await channel.send(f"🔔 {mention_str}", embed=embed)
-            else:
-                await channel.send(embed=embed)
+    embed.add_field(
+        name="!import_ics [--allow-conflicts] / !export_ics [category] [YYYY-MM-DD..YYYY-MM-DD] [--archived]",
+        value="Import events from an attached .ics file, or download this server's events as one",
+        inline=False
+    )
 
-            # Mark reminder as sent
-            c.execute("UPDATE reminders SET notification_sent = 1 WHERE id = ?", (reminder_id,))
-            conn.commit()
+    embed.add_field(
+        name="RSVP System",
+        value="React to event messages with:\n👍 - Attending\n❓ - Maybe\n👎 - Not attending\n\nNote: You can also filter events by category using: !list_events [category]",
+        inline=False
+    )
 
-    conn.close()
+    await ctx.send(embed=embed)
+
+
+def load_reminder_attendees(conn, due):
+    """Attending user IDs for each due reminder's occurrence, keyed by (event_id, occurrence)"""
+    attendees = {}
+    for reminder_id, event_id, title, channel_id, reminder_time, fire_at in due:
+        occurrence = fire_at + reminder_time * 60
+        if (event_id, occurrence) not in attendees:
+            rsvps = effective_rsvps(conn, event_id, occurrence)
+            attendees[(event_id, occurrence)] = [user_id for user_id, status in rsvps if status == 'attending']
+    return attendees
+
+
+def render_reminders(reminders, attendees):
+    """Build the (content, embed) messages for one channel's batch of reminders"""
+    mentioned = []
+    for reminder_id, event_id, title, channel_id, reminder_time, fire_at in reminders:
+        for user_id in attendees[(event_id, fire_at + reminder_time * 60)]:
+            if user_id not in mentioned:
+                mentioned.append(user_id)
+
+    if len(reminders) == 1:
+        _, _, title, _, reminder_time, _ = reminders[0]
+        embeds = [discord.Embed(
+            title=f"⏰ Reminder: {title}",
+            description=f"Event starting in {reminder_time} minutes!",
+            color=discord.Color.orange()
+        )]
+    else:
+        # Merge everything due together into as few embeds as the 25-field limit allows
+        embeds = []
+        for start in range(0, len(reminders), 25):
+            embed = discord.Embed(title="⏰ Reminders", color=discord.Color.orange())
+            for _, _, title, _, reminder_time, fire_at in reminders[start:start + 25]:
+                starts_at = from_timestamp(fire_at + reminder_time * 60).strftime('%H:%M')
+                embed.add_field(name=title, value=f"Starting in {reminder_time} minutes ({starts_at})", inline=False)
+            embeds.append(embed)
+
+    # Ping each attendee once, splitting mentions to stay under the 2000-character message limit
+    mention_chunks = []
+    chunk = ""
+    for user_id in mentioned:
+        mention = f"<@{user_id}>"
+        if len(chunk) + len(mention) + 1 > 1900:
+            mention_chunks.append(chunk)
+            chunk = ""
+        chunk = f"{chunk} {mention}" if chunk else mention
+    if chunk:
+        mention_chunks.append(chunk)
+
+    messages = []
+    for i in range(max(len(embeds), len(mention_chunks))):
+        content = f"🔔 {mention_chunks[i]}" if i < len(mention_chunks) else None
+        messages.append((content, embeds[i] if i < len(embeds) else None))
+    return messages
+
+
+@telemetry.timed('send_reminders')
+async def send_reminders(due):
+    """Send the reminders the scheduler has just claimed, merged into one batch per channel"""
+    await rsvp_writer.flush()
+    attendees = await db.run(load_reminder_attendees, due)
+
+    by_channel = {}
+    for reminder in due:
+        by_channel.setdefault(reminder[3], []).append(reminder)
+
+    for channel_id, reminders in by_channel.items():
+        due_at = min(reminder[5] for reminder in reminders)
+        for content, embed in render_reminders(reminders, attendees):
+            outbox.send(channel_id, content, embed=embed, due_at=due_at)
+
+
+reminder_scheduler = ReminderScheduler(db, send_reminders, leases=shard_leases)
+shard_leases.on_change = reminder_scheduler.reload
+
+telemetry.gauge('outbox_queue_depth', outbox.depth)
+telemetry.gauge('rsvp_pending_writes', rsvp_writer.depth)
+telemetry.gauge('reminders_queued', reminder_scheduler.depth)
+telemetry.gauge('shard_leases_held', lambda: len(shard_leases.held))
+telemetry.gauge('upcoming_cached_events', lambda: len(upcoming))
+telemetry.gauge('commands_queued', admission.depth)
+telemetry.gauge('work_shed', lambda: sum(admission.shed.values()))
 
 
 @bot.event
+@telemetry.timed('on_raw_reaction_add')
 async def on_raw_reaction_add(payload):
     """Handle RSVP reactions"""
     if payload.user_id == bot.user.id:
         return
 
-    conn = sqlite3.connect('calendar_events.db')
-    c = conn.cursor()
-
     # Check if this is an event message
-    c.execute('SELECT id FROM events WHERE message_id = ?', (payload.message_id,))
-    event = c.fetchone()
+    event_id = await event_messages.lookup(payload.message_id)
 
-    if not event:
-        conn.close()
+    if not event_id:
         return
 
-    event_id = event[0]
-
-    # Map reactions to RSVP status
-    status_map = {
-        '👍': 'attending',
-        '❓': 'maybe',
-        '👎': 'not_attending'
-    }
-
     emoji = str(payload.emoji)
-    if emoji not in status_map:
-        conn.close()
+    if emoji not in STATUS_MAP:
+        return
+    if payload.guild_id is not None and not admission.admit_reaction(payload.guild_id):
+        # Not lost: the announcement's reactions are compared with stored RSVPs again shortly
+        reconciler.recheck(event_id, RECONCILE_AFTER_SHED)
         return
 
     # Update RSVP status
-    c.execute("""
-        INSERT OR REPLACE INTO rsvp (event_id, user_id, status)
-        VALUES (?, ?, ?)
-    """, (event_id, payload.user_id, status_map[emoji]))
-
-    conn.commit()
-    conn.close()
+    rsvp_writer.set(event_id, payload.user_id, STATUS_MAP[emoji])
 
 
 @bot.event
+@telemetry.timed('on_raw_reaction_remove')
 async def on_raw_reaction_remove(payload):
     """Handle RSVP reaction removals"""
-    conn = sqlite3.connect('calendar_events.db')
-    c = conn.cursor()
-
     # Check if this is an event message
-    c.execute('SELECT id FROM events WHERE message_id = ?', (payload.message_id,))
-    event = c.fetchone()
+    event_id = await event_messages.lookup(payload.message_id)
 
-    if event:
+    if event_id:
+        if payload.guild_id is not None and not admission.admit_reaction(payload.guild_id):
+            reconciler.recheck(event_id, RECONCILE_AFTER_SHED)
+            return
         # Remove RSVP entry
-        c.execute("""
-            DELETE FROM rsvp 
-            WHERE event_id = ? AND user_id = ?
-        """, (event[0], payload.user_id))
-        conn.commit()
-
-    conn.close()
+        rsvp_writer.remove(event_id, payload.user_id)
 
 
-bot.run(TOKEN)
\ No newline at end of file
+if __name__ == '__main__':
+    bot.run(TOKEN)
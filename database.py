@@ -0,0 +1,457 @@
+import asyncio
+import queue
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+RSVP_STATUSES = ('attending', 'maybe', 'not_attending')
+
+
+def to_timestamp(dt):
+    """Encode a local datetime as the integer epoch seconds stored in the database"""
+    return int(dt.timestamp())
+
+
+def from_timestamp(ts):
+    """Decode stored epoch seconds back into a local datetime"""
+    return datetime.fromtimestamp(ts)
+
+
+def _create_base_tables(conn):
+    # Original layout; a no-op for databases created before schema versioning
+    conn.execute('''CREATE TABLE IF NOT EXISTS events
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     guild_id INTEGER,
+                     channel_id INTEGER,
+                     creator_id INTEGER,
+                     title TEXT,
+                     description TEXT,
+                     event_time TIMESTAMP,
+                     message_id INTEGER,
+                     category TEXT DEFAULT 'general',
+                     is_cancelled BOOLEAN DEFAULT 0)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS rsvp
+                    (event_id INTEGER,
+                     user_id INTEGER,
+                     status TEXT,
+                     FOREIGN KEY(event_id) REFERENCES events(id))''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS reminders
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     event_id INTEGER,
+                     reminder_time INTEGER,
+                     notification_sent BOOLEAN DEFAULT 0,
+                     FOREIGN KEY(event_id) REFERENCES events(id))''')
+
+
+def _integer_event_times(conn):
+    # Rebuild events with epoch-second times; 'utc' makes strftime read the old text as local time
+    conn.execute('''CREATE TABLE events_new
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     guild_id INTEGER,
+                     channel_id INTEGER,
+                     creator_id INTEGER,
+                     title TEXT,
+                     description TEXT,
+                     event_time INTEGER,
+                     message_id INTEGER,
+                     category TEXT DEFAULT 'general',
+                     is_cancelled BOOLEAN DEFAULT 0)''')
+    conn.execute('''INSERT INTO events_new
+                    SELECT id, guild_id, channel_id, creator_id, title, description,
+                           CASE WHEN typeof(event_time) = 'integer' THEN event_time
+                                ELSE CAST(strftime('%s', event_time, 'utc') AS INTEGER) END,
+                           message_id, category, is_cancelled
+                    FROM events''')
+    conn.execute('DROP TABLE events')
+    conn.execute('ALTER TABLE events_new RENAME TO events')
+
+    # Precompute when each reminder is due so the scheduler can range-scan it
+    conn.execute('ALTER TABLE reminders ADD COLUMN fire_at INTEGER')
+    conn.execute('''UPDATE reminders
+                    SET fire_at = (SELECT e.event_time FROM events e WHERE e.id = reminders.event_id)
+                                  - reminder_time * 60''')
+
+    conn.execute('CREATE INDEX idx_events_guild_time ON events (guild_id, is_cancelled, event_time)')
+    conn.execute('CREATE INDEX idx_events_message ON events (message_id)')
+    conn.execute('CREATE INDEX idx_rsvp_event_status ON rsvp (event_id, status)')
+    conn.execute('CREATE INDEX idx_reminders_event ON reminders (event_id)')
+    conn.execute('CREATE INDEX idx_reminders_due ON reminders (fire_at) WHERE notification_sent = 0')
+
+
+def _unique_rsvp(conn):
+    # INSERT OR REPLACE had no key to replace on, so keep only the newest row per user and event
+    conn.execute('''DELETE FROM rsvp
+                    WHERE rowid NOT IN (SELECT MAX(rowid) FROM rsvp GROUP BY event_id, user_id)''')
+    conn.execute('CREATE UNIQUE INDEX idx_rsvp_event_user ON rsvp (event_id, user_id)')
+
+
+def _rsvp_counters(conn):
+    # Per-event tallies kept current by triggers, so listings never count rsvp rows
+    for status in RSVP_STATUSES:
+        conn.execute(f'ALTER TABLE events ADD COLUMN {status}_count INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''CREATE TRIGGER rsvp_count_insert AFTER INSERT ON rsvp BEGIN
+                        UPDATE events
+                        SET attending_count = attending_count + (NEW.status = 'attending'),
+                            maybe_count = maybe_count + (NEW.status = 'maybe'),
+                            not_attending_count = not_attending_count + (NEW.status = 'not_attending')
+                        WHERE id = NEW.event_id;
+                    END''')
+    conn.execute('''CREATE TRIGGER rsvp_count_delete AFTER DELETE ON rsvp BEGIN
+                        UPDATE events
+                        SET attending_count = attending_count - (OLD.status = 'attending'),
+                            maybe_count = maybe_count - (OLD.status = 'maybe'),
+                            not_attending_count = not_attending_count - (OLD.status = 'not_attending')
+                        WHERE id = OLD.event_id;
+                    END''')
+    conn.execute('''CREATE TRIGGER rsvp_count_update AFTER UPDATE OF event_id, status ON rsvp BEGIN
+                        UPDATE events
+                        SET attending_count = attending_count - (OLD.status = 'attending'),
+                            maybe_count = maybe_count - (OLD.status = 'maybe'),
+                            not_attending_count = not_attending_count - (OLD.status = 'not_attending')
+                        WHERE id = OLD.event_id;
+                        UPDATE events
+                        SET attending_count = attending_count + (NEW.status = 'attending'),
+                            maybe_count = maybe_count + (NEW.status = 'maybe'),
+                            not_attending_count = not_attending_count + (NEW.status = 'not_attending')
+                        WHERE id = NEW.event_id;
+                    END''')
+    conn.execute('''UPDATE events
+                    SET attending_count = (SELECT COUNT(*) FROM rsvp WHERE event_id = events.id AND status = 'attending'),
+                        maybe_count = (SELECT COUNT(*) FROM rsvp WHERE event_id = events.id AND status = 'maybe'),
+                        not_attending_count = (SELECT COUNT(*) FROM rsvp WHERE event_id = events.id AND status = 'not_attending')''')
+
+
+def rebuild_rsvp_counts(conn, guild_id=None):
+    """Recount series-level RSVPs for every event (or one guild's) and return the IDs whose counters had drifted"""
+    drifted = [row[0] for row in conn.execute('''
+        SELECT e.id
+        FROM events e
+        LEFT JOIN (SELECT event_id,
+                          SUM(status = 'attending') AS attending,
+                          SUM(status = 'maybe') AS maybe,
+                          SUM(status = 'not_attending') AS not_attending
+                   FROM rsvp
+                   WHERE occurrence = 0
+                   GROUP BY event_id) r ON r.event_id = e.id
+        WHERE (? IS NULL OR e.guild_id = ?)
+        AND (e.attending_count != COALESCE(r.attending, 0)
+             OR e.maybe_count != COALESCE(r.maybe, 0)
+             OR e.not_attending_count != COALESCE(r.not_attending, 0))
+    ''', (guild_id, guild_id))]
+    conn.executemany('''
+        UPDATE events
+        SET attending_count = (SELECT COUNT(*) FROM rsvp
+                               WHERE event_id = events.id AND occurrence = 0 AND status = 'attending'),
+            maybe_count = (SELECT COUNT(*) FROM rsvp
+                           WHERE event_id = events.id AND occurrence = 0 AND status = 'maybe'),
+            not_attending_count = (SELECT COUNT(*) FROM rsvp
+                                   WHERE event_id = events.id AND occurrence = 0 AND status = 'not_attending')
+        WHERE id = ?
+    ''', [(event_id,) for event_id in drifted])
+    return drifted
+
+
+def _event_durations(conn):
+    # Every event used to be treated as one hour long
+    conn.execute('ALTER TABLE events ADD COLUMN duration INTEGER NOT NULL DEFAULT 60')
+
+
+def _recurring_events(conn):
+    # A series is one events row with a rule; occurrences are expanded on demand, never stored
+    conn.execute('ALTER TABLE events ADD COLUMN recurrence TEXT')
+    conn.execute('ALTER TABLE events ADD COLUMN recurrence_end INTEGER')
+    conn.execute('''CREATE INDEX idx_events_series ON events (guild_id, is_cancelled, recurrence_end)
+                    WHERE recurrence IS NOT NULL''')
+
+    # Sparse per-occurrence overrides: single cancelled occurrences...
+    conn.execute('''CREATE TABLE event_exceptions
+                    (event_id INTEGER NOT NULL,
+                     occurrence INTEGER NOT NULL,
+                     PRIMARY KEY (event_id, occurrence),
+                     FOREIGN KEY(event_id) REFERENCES events(id)) WITHOUT ROWID''')
+
+    # ...and RSVPs for one occurrence, which take precedence over the series RSVP (occurrence 0)
+    conn.execute('ALTER TABLE rsvp ADD COLUMN occurrence INTEGER NOT NULL DEFAULT 0')
+    conn.execute('DROP INDEX idx_rsvp_event_user')
+    conn.execute('CREATE UNIQUE INDEX idx_rsvp_event_user ON rsvp (event_id, occurrence, user_id)')
+
+    # The event counters only track series-level RSVPs
+    for trigger in ('rsvp_count_insert', 'rsvp_count_delete', 'rsvp_count_update'):
+        conn.execute(f'DROP TRIGGER {trigger}')
+    conn.execute('''CREATE TRIGGER rsvp_count_insert AFTER INSERT ON rsvp WHEN NEW.occurrence = 0 BEGIN
+                        UPDATE events
+                        SET attending_count = attending_count + (NEW.status = 'attending'),
+                            maybe_count = maybe_count + (NEW.status = 'maybe'),
+                            not_attending_count = not_attending_count + (NEW.status = 'not_attending')
+                        WHERE id = NEW.event_id;
+                    END''')
+    conn.execute('''CREATE TRIGGER rsvp_count_delete AFTER DELETE ON rsvp WHEN OLD.occurrence = 0 BEGIN
+                        UPDATE events
+                        SET attending_count = attending_count - (OLD.status = 'attending'),
+                            maybe_count = maybe_count - (OLD.status = 'maybe'),
+                            not_attending_count = not_attending_count - (OLD.status = 'not_attending')
+                        WHERE id = OLD.event_id;
+                    END''')
+    conn.execute('''CREATE TRIGGER rsvp_count_update AFTER UPDATE OF event_id, occurrence, status ON rsvp BEGIN
+                        UPDATE events
+                        SET attending_count = attending_count - (OLD.status = 'attending'),
+                            maybe_count = maybe_count - (OLD.status = 'maybe'),
+                            not_attending_count = not_attending_count - (OLD.status = 'not_attending')
+                        WHERE id = OLD.event_id AND OLD.occurrence = 0;
+                        UPDATE events
+                        SET attending_count = attending_count + (NEW.status = 'attending'),
+                            maybe_count = maybe_count + (NEW.status = 'maybe'),
+                            not_attending_count = not_attending_count + (NEW.status = 'not_attending')
+                        WHERE id = NEW.event_id AND NEW.occurrence = 0;
+                    END''')
+
+
+def _shard_leases(conn):
+    # Which process currently owns each guild partition; see sharding.ShardLeases
+    conn.execute('''CREATE TABLE shard_leases
+                    (shard_id INTEGER PRIMARY KEY,
+                     shard_count INTEGER NOT NULL,
+                     owner TEXT NOT NULL,
+                     expires_at INTEGER NOT NULL)''')
+
+
+def _ics_uids(conn):
+    # Calendar UIDs of imported events, so importing the same file twice doesn't duplicate them
+    conn.execute('ALTER TABLE events ADD COLUMN ics_uid TEXT')
+    conn.execute('''CREATE UNIQUE INDEX idx_events_ics_uid ON events (guild_id, ics_uid)
+                    WHERE ics_uid IS NOT NULL''')
+
+
+def _archive_tables(conn):
+    # Cold copies of finished events and everything hanging off them; see archive.py
+    conn.execute('''CREATE TABLE archived_events
+                    (id INTEGER PRIMARY KEY,
+                     guild_id INTEGER,
+                     channel_id INTEGER,
+                     creator_id INTEGER,
+                     title TEXT,
+                     description TEXT,
+                     event_time INTEGER,
+                     message_id INTEGER,
+                     category TEXT,
+                     is_cancelled BOOLEAN,
+                     attending_count INTEGER,
+                     maybe_count INTEGER,
+                     not_attending_count INTEGER,
+                     duration INTEGER,
+                     recurrence TEXT,
+                     recurrence_end INTEGER,
+                     ics_uid TEXT,
+                     archived_at INTEGER NOT NULL)''')
+    conn.execute('CREATE INDEX idx_archived_events_guild_time ON archived_events (guild_id, event_time)')
+    conn.execute('''CREATE TABLE archived_rsvp
+                    (event_id INTEGER NOT NULL,
+                     occurrence INTEGER NOT NULL,
+                     user_id INTEGER NOT NULL,
+                     status TEXT,
+                     PRIMARY KEY (event_id, occurrence, user_id)) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE archived_reminders
+                    (id INTEGER PRIMARY KEY,
+                     event_id INTEGER,
+                     reminder_time INTEGER,
+                     fire_at INTEGER,
+                     notification_sent BOOLEAN)''')
+    conn.execute('CREATE INDEX idx_archived_reminders_event ON archived_reminders (event_id)')
+    conn.execute('''CREATE TABLE archived_event_exceptions
+                    (event_id INTEGER NOT NULL,
+                     occurrence INTEGER NOT NULL,
+                     PRIMARY KEY (event_id, occurrence)) WITHOUT ROWID''')
+
+
+def _reaction_checkpoints(conn):
+    # What the last reaction backfill saw on each announcement; see reconcile.Reconciler
+    conn.execute('''CREATE TABLE reaction_checkpoints
+                    (event_id INTEGER PRIMARY KEY,
+                     signature TEXT NOT NULL,
+                     checked_at INTEGER NOT NULL,
+                     FOREIGN KEY(event_id) REFERENCES events(id))''')
+    conn.execute('''CREATE TABLE reaction_users
+                    (event_id INTEGER NOT NULL,
+                     user_id INTEGER NOT NULL,
+                     status TEXT NOT NULL,
+                     PRIMARY KEY (event_id, user_id, status),
+                     FOREIGN KEY(event_id) REFERENCES events(id)) WITHOUT ROWID''')
+
+
+def _event_search(conn):
+    # Full-text index over titles and descriptions, keyed by event ID; see search.py. The guild ID is
+    # indexed too, so a search only ranks its own guild's matches. Triggers keep it in step with
+    # events, and archiving keeps an event's entry since archived events stay searchable
+    conn.execute('''CREATE VIRTUAL TABLE event_search
+                    USING fts5(title, description, guild, tokenize='porter unicode61 remove_diacritics 2')''')
+    # Title matches count for more, and the guild ID not at all
+    conn.execute("INSERT INTO event_search (event_search, rank) VALUES ('rank', 'bm25(4.0, 1.0, 0.0)')")
+    conn.execute('''CREATE TRIGGER event_search_insert AFTER INSERT ON events WHEN NOT NEW.is_cancelled BEGIN
+                        INSERT INTO event_search (rowid, title, description, guild)
+                        VALUES (NEW.id, NEW.title, NEW.description, NEW.guild_id);
+                    END''')
+    conn.execute('''CREATE TRIGGER event_search_update AFTER UPDATE OF title, description, is_cancelled ON events
+                    BEGIN
+                        DELETE FROM event_search WHERE rowid = OLD.id;
+                        INSERT INTO event_search (rowid, title, description, guild)
+                        SELECT NEW.id, NEW.title, NEW.description, NEW.guild_id WHERE NOT NEW.is_cancelled;
+                    END''')
+    conn.execute('''CREATE TRIGGER event_search_delete AFTER DELETE ON events
+                    WHEN NOT EXISTS (SELECT 1 FROM archived_events WHERE id = OLD.id) BEGIN
+                        DELETE FROM event_search WHERE rowid = OLD.id;
+                    END''')
+    conn.execute('''INSERT INTO event_search (rowid, title, description, guild)
+                    SELECT id, title, description, guild_id FROM events WHERE NOT is_cancelled
+                    UNION ALL
+                    SELECT id, title, description, guild_id FROM archived_events WHERE NOT is_cancelled''')
+
+
+def _digest_subscriptions(conn):
+    # Daily/weekly digests, posted to a channel (kind 'channel') or sent to a member by DM (kind 'user');
+    # last_sent is when the last digest was due, so each one goes out once; see digest.py
+    conn.execute('''CREATE TABLE digest_subscriptions
+                    (guild_id INTEGER NOT NULL,
+                     kind TEXT NOT NULL CHECK (kind IN ('channel', 'user')),
+                     target_id INTEGER NOT NULL,
+                     period TEXT NOT NULL CHECK (period IN ('daily', 'weekly')),
+                     last_sent INTEGER NOT NULL DEFAULT 0,
+                     PRIMARY KEY (guild_id, kind, target_id)) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX idx_digest_due ON digest_subscriptions (period, last_sent)')
+
+
+def _archive_indexes(conn):
+    # Lets the archiver find finished events and delivered reminders without scanning under its write lock
+    conn.execute('CREATE INDEX idx_events_cancelled ON events (id) WHERE is_cancelled = 1')
+    conn.execute('''CREATE INDEX idx_events_finished ON events (event_time)
+                    WHERE recurrence IS NULL AND is_cancelled = 0''')
+    conn.execute('''CREATE INDEX idx_events_series_end ON events (recurrence_end)
+                    WHERE recurrence IS NOT NULL AND is_cancelled = 0''')
+    conn.execute('CREATE INDEX idx_reminders_sent ON reminders (id) WHERE notification_sent = 1')
+
+
+# Schema migrations in order; the database's user_version is the number already applied
+MIGRATIONS = [
+    _create_base_tables,
+    _integer_event_times,
+    _unique_rsvp,
+    _rsvp_counters,
+    _event_durations,
+    _recurring_events,
+    _shard_leases,
+    _ics_uids,
+    _archive_tables,
+    _reaction_checkpoints,
+    _event_search,
+    _digest_subscriptions,
+    _archive_indexes,
+]
+
+
+def migrate(conn):
+    """Bring the schema up to date without touching existing data"""
+    # Foreign keys must be off while tables are rebuilt, and can only be toggled outside a transaction
+    conn.commit()
+    conn.execute('PRAGMA foreign_keys=OFF')
+    try:
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            conn.execute('BEGIN IMMEDIATE')
+            # Re-read inside the write lock in case another process migrated first
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            try:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    finally:
+        conn.execute('PRAGMA foreign_keys=ON')
+    return len(MIGRATIONS)
+
+
+def _label(sql):
+    """Short one-line name for an ad-hoc statement in query timings"""
+    return ' '.join(sql.split())[:60]
+
+
+class Database:
+    """Small pool of long-lived SQLite connections used off the event loop"""
+
+    def __init__(self, path, pool_size=4, observer=None):
+        self.path = path
+        self.pool_size = pool_size
+        # Called as observer(label, seconds, rows) after every transaction, from the worker thread
+        self.observer = observer
+        self._pool = queue.Queue()
+        self._connections = []
+        # One worker thread per pooled connection, so a query never waits on the loop
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='calendar-db')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=256)
+        # WAL lets readers run while a writer commits
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            if len(self._connections) < self.pool_size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+            return self._pool.get()
+
+    def _call(self, label, fn, *args):
+        conn = self._acquire()
+        start = time.perf_counter()
+        changes = conn.total_changes
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            if self.observer is not None:
+                # Rows returned for reads, rows written otherwise
+                rows = len(result) if isinstance(result, list) else conn.total_changes - changes
+                self.observer(label, time.perf_counter() - start, rows)
+            return result
+        finally:
+            self._pool.put(conn)
+
+    async def _run(self, label, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, label, fn, *args)
+
+    async def run(self, fn, *args):
+        """Run fn(conn, *args) in a single transaction on a pooled connection"""
+        return await self._run(fn.__name__, fn, *args)
+
+    async def fetchone(self, sql, params=()):
+        return await self._run(_label(sql), lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self._run(_label(sql), lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        """Execute a single statement and return the last inserted row id"""
+        return await self._run(_label(sql), lambda conn: conn.execute(sql, params).lastrowid)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self._run(_label(sql), lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
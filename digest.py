@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+import discord
+
+from database import from_timestamp, to_timestamp
+from recurrence import Recurrence
+from sharding import owned
+
+log = logging.getLogger(__name__)
+
+# Days each kind of digest looks ahead, counting the day it is sent
+PERIODS = {'daily': 1, 'weekly': 7}
+# Statuses that put an event in someone's personal digest
+DIGEST_STATUSES = ('attending', 'maybe')
+# Events listed per digest before the rest are only counted; keeps an embed within Discord's limits
+MAX_LINES = 30
+
+
+def load_digests(conn, period, due, start, end, leases=None):
+    """Claim the subscriptions due for a digest and read what they need, in five queries however many guilds
+
+    Subscriptions not yet sent for `due` are marked sent, so a restart or a second run never repeats
+    them. Returns (subscriptions, events, cancelled occurrences, RSVPs): subscriptions are (guild_id,
+    kind, target_id); events are those of the subscribed guilds with an occurrence in [start, end);
+    RSVPs are those of users subscribed to personal digests, for those events.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    now = time.time()
+
+    def due_filter(table):
+        # With shard leases, each process only sends digests for its own guilds
+        ownership, params = owned(leases, f'{table}.guild_id', now)
+        return f"{table}.period = ? AND {table}.last_sent < ? AND {ownership}", [period, due] + params
+
+    due_subscriptions, due_params = due_filter('s')
+    subscribed = f"e.guild_id IN (SELECT s.guild_id FROM digest_subscriptions s WHERE {due_subscriptions})"
+    in_window = """e.is_cancelled = 0 AND e.event_time < ?
+                   AND (e.recurrence IS NULL AND e.event_time >= ?
+                        OR e.recurrence IS NOT NULL AND (e.recurrence_end IS NULL OR e.recurrence_end >= ?))"""
+    window_params = [end, start, start]
+
+    subscriptions = conn.execute(f"""
+        SELECT s.guild_id, s.kind, s.target_id FROM digest_subscriptions s WHERE {due_subscriptions}
+    """, due_params).fetchall()
+    if not subscriptions:
+        return [], [], set(), []
+    events = conn.execute(f"""
+        SELECT e.guild_id, e.id, e.title, e.event_time, e.category, e.recurrence
+        FROM events e
+        WHERE {subscribed} AND {in_window}
+    """, due_params + window_params).fetchall()
+    cancelled = set(conn.execute(f"""
+        SELECT x.event_id, x.occurrence
+        FROM event_exceptions x
+        JOIN events e ON e.id = x.event_id
+        WHERE {subscribed} AND {in_window} AND x.occurrence >= ? AND x.occurrence < ?
+    """, due_params + window_params + [start, end]).fetchall())
+    rsvps = conn.execute(f"""
+        SELECT r.event_id, r.occurrence, r.user_id, r.status
+        FROM digest_subscriptions s
+        JOIN events e ON e.guild_id = s.guild_id
+        JOIN rsvp r ON r.event_id = e.id AND r.user_id = s.target_id
+        WHERE s.kind = 'user' AND {due_subscriptions} AND {in_window}
+        AND (r.occurrence = 0 OR (r.occurrence >= ? AND r.occurrence < ?))
+    """, due_params + window_params + [start, end]).fetchall()
+    claimed, claimed_params = due_filter('digest_subscriptions')
+    conn.execute(f"UPDATE digest_subscriptions SET last_sent = ? WHERE {claimed}", [due] + claimed_params)
+    return subscriptions, events, cancelled, rsvps
+
+
+def group_digests(subscriptions, events, cancelled, rsvps, start, end):
+    """{('channel', channel_id) or ('user', user_id): {guild_id: [(time, event_id, title, category), ...]}}
+
+    Series are expanded into their occurrences in [start, end). A channel gets every event of its
+    guild; a user gets the events they are attending or might attend, across all their guilds.
+    """
+    window_start, window_end = from_timestamp(start), from_timestamp(end)
+    by_guild = {}
+    for guild_id, event_id, title, event_time, category, recurrence in events:
+        if recurrence is None:
+            times = [event_time]
+        else:
+            times = [to_timestamp(occurrence) for occurrence in
+                     Recurrence.parse(recurrence).occurrences(from_timestamp(event_time), window_start, window_end)]
+        by_guild.setdefault(guild_id, []).extend((occurrence, event_id, title, category) for occurrence in times
+                                                 if (event_id, occurrence) not in cancelled)
+    for occurrences in by_guild.values():
+        occurrences.sort()
+
+    # A user's answer for one occurrence overrides their answer for the whole series
+    answers = {}
+    for event_id, occurrence, user_id, status in rsvps:
+        answers[event_id, occurrence, user_id] = status
+
+    groups = {}
+    for guild_id, kind, target_id in subscriptions:
+        occurrences = by_guild.get(guild_id, [])
+        if kind == 'user':
+            occurrences = [item for item in occurrences
+                           if answers.get((item[1], item[0], target_id),
+                                          answers.get((item[1], 0, target_id))) in DIGEST_STATUSES]
+        groups.setdefault((kind, target_id), {})[guild_id] = occurrences
+    return groups
+
+
+def render_digest(period, sections, guild_name):
+    """One digest embed; sections map guild IDs to their sorted occurrences, guild_name(guild_id) labels them"""
+    embed = discord.Embed(title="📅 Today's events" if period == 'daily' else "🗓️ This week's events",
+                          color=discord.Color.blue())
+    lines = []
+    total = sum(len(occurrences) for occurrences in sections.values())
+    shown = 0
+    for guild_id, occurrences in sections.items():
+        if not occurrences or shown >= MAX_LINES:
+            continue
+        if len(sections) > 1:
+            lines.append(f"__{guild_name(guild_id)}__")
+        day = None
+        for event_time, event_id, title, category in occurrences[:MAX_LINES - shown]:
+            when = from_timestamp(event_time)
+            if period != 'daily' and when.date() != day:
+                day = when.date()
+                lines.append(f"**{when.strftime('%A %d %B')}**")
+            lines.append(f"`{when.strftime('%H:%M')}` {title[:80]} (ID: {event_id}) · {category}")
+            shown += 1
+    if not total:
+        lines.append("Nothing scheduled.")
+    elif shown < total:
+        lines.append(f"…and {total - shown} more")
+    embed.description = '\n'.join(lines)
+    return embed
+
+
+class Digests:
+    """Sends daily and weekly digests at `hour` o'clock; weekly ones on `weekday` (0 is Monday)
+
+    Each run claims every due subscription across all guilds and reads what the digests need with a
+    fixed handful of queries, groups the results in memory, renders each channel's and each user's
+    digest once, and delivers them: channel posts through the outbox, DMs at most `concurrency` at a
+    time.
+    """
+
+    def __init__(self, bot, db, outbox, leases=None, hour=8, weekday=0, concurrency=8):
+        self.bot = bot
+        self.db = db
+        self.outbox = outbox
+        self.leases = leases
+        self.hour = hour
+        self.weekday = weekday
+        self._limit = asyncio.Semaphore(concurrency)
+        self._task = None
+
+    def due(self, period, now):
+        """When the most recent digest of this period was due, as of now"""
+        due = now.replace(hour=self.hour, minute=0, second=0, microsecond=0)
+        if period == 'weekly':
+            due -= timedelta(days=(due.weekday() - self.weekday) % 7)
+        if due > now:
+            due -= timedelta(days=PERIODS[period])
+        return due
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = datetime.now()
+            for period in PERIODS:
+                try:
+                    # Digests missed while the bot was down are sent late rather than skipped
+                    await self.run_once(period, self.due(period, now))
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception('Sending %s digests failed', period)
+            next_due = min(self.due(period, now) + timedelta(days=PERIODS[period]) for period in PERIODS)
+            await asyncio.sleep(max((next_due - datetime.now()).total_seconds(), 1))
+
+    async def run_once(self, period, due):
+        """Send every digest of this period still due; returns (channel posts, DMs)"""
+        started = time.perf_counter()
+        start = max(to_timestamp(due), int(time.time()))
+        end = to_timestamp(due.replace(hour=0) + timedelta(days=PERIODS[period]))
+        loaded = await self.db.run(load_digests, period, to_timestamp(due), start, end, self.leases)
+        if not loaded[0]:
+            return 0, 0
+        groups = group_digests(*loaded, start, end)
+
+        def guild_name(guild_id):
+            guild = self.bot.get_guild(guild_id)
+            return guild.name if guild is not None else str(guild_id)
+
+        channels = dms = 0
+        deliveries = []
+        for (kind, target_id), sections in groups.items():
+            # Nobody needs a DM saying they have nothing on
+            if kind == 'user' and not any(sections.values()):
+                continue
+            embed = render_digest(period, sections, guild_name)
+            if kind == 'channel':
+                self.outbox.send(target_id, embed=embed)
+                channels += 1
+            else:
+                deliveries.append(self._send_dm(target_id, embed))
+                dms += 1
+        log.info('Built %d %s digest(s) in %.2fs', channels + dms, period, time.perf_counter() - started)
+        await asyncio.gather(*deliveries)
+        return channels, dms
+
+    async def _send_dm(self, user_id, embed):
+        async with self._limit:
+            try:
+                user = self.bot.get_user(user_id) or await self.bot.fetch_user(user_id)
+                await user.send(embed=embed)
+            except (discord.Forbidden, discord.NotFound):
+                # DMs closed, or the account is gone
+                pass
+            except discord.HTTPException as e:
+                log.warning('Could not send a digest to user %s: %s', user_id, e)
@@ -0,0 +1,390 @@
+import re
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from database import from_timestamp, to_timestamp
+from recurrence import FREQUENCIES, WEEKDAYS, Recurrence
+
+PRODID = '-//Discord Calendar Bot//EN'
+DURATION_PATTERN = re.compile(r'^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+
+class IcsEvent:
+    """One VEVENT, reduced to what an events row can hold"""
+
+    __slots__ = ('uid', 'title', 'description', 'category', 'start', 'duration', 'rule', 'exdates', 'reminders')
+
+    def __init__(self, uid, title, description, category, start, duration, rule, exdates, reminders):
+        self.uid = uid
+        self.title = title
+        self.description = description
+        self.category = category
+        self.start = start
+        self.duration = duration
+        self.rule = rule
+        self.exdates = exdates
+        self.reminders = reminders
+
+
+class IcsParser:
+    """Incremental VEVENT parser: feed() it lines as they arrive and it returns each finished event
+
+    Only one event's properties are held at a time, so calendars of any size parse in constant memory.
+    Events are returned as {NAME: [(params, value), ...]} with VALARM triggers under 'ALARMS'.
+    """
+
+    def __init__(self):
+        self._line = None
+        self._event = None
+        self._alarm = None
+
+    def feed(self, line):
+        line = line.rstrip('\r\n')
+        # Folded lines continue the previous one after a single leading space or tab
+        if line[:1] in (' ', '\t') and self._line is not None:
+            self._line += line[1:]
+            return []
+        previous, self._line = self._line, line
+        return self._content_line(previous) if previous else []
+
+    def close(self):
+        previous, self._line = self._line, None
+        return self._content_line(previous) if previous else []
+
+    def _content_line(self, line):
+        name, params, value = _split_content_line(line)
+        if name == 'BEGIN':
+            if value == 'VEVENT':
+                self._event = {'ALARMS': []}
+            elif value == 'VALARM' and self._event is not None:
+                self._alarm = {}
+            return []
+        if name == 'END':
+            if value == 'VALARM' and self._alarm is not None:
+                if 'TRIGGER' in self._alarm:
+                    self._event['ALARMS'].append(self._alarm['TRIGGER'])
+                self._alarm = None
+            elif value == 'VEVENT' and self._event is not None:
+                event, self._event = self._event, None
+                return [event]
+            return []
+        if self._alarm is not None:
+            self._alarm.setdefault(name, (params, value))
+        elif self._event is not None:
+            self._event.setdefault(name, []).append((params, value))
+        return []
+
+
+def _split_content_line(line):
+    # NAME;PARAM=value;PARAM="quoted:value":property value
+    quoted = False
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ':' and not quoted:
+            head, value = line[:i], line[i + 1:]
+            break
+    else:
+        return line.upper(), {}, ''
+    name, *raw_params = head.split(';')
+    params = {}
+    for param in raw_params:
+        key, _, param_value = param.partition('=')
+        params[key.upper()] = param_value.strip('"')
+    return name.upper(), params, value
+
+
+def _unescape(value):
+    return re.sub(r'\\([\\;,nN])', lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _parse_datetime(value, params):
+    """Return (local naive datetime, is_all_day)"""
+    value = value.strip()
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return datetime.strptime(value, '%Y%m%d'), True
+    if value.endswith('Z'):
+        utc = datetime.strptime(value[:-1], '%Y%m%dT%H%M%S').replace(tzinfo=timezone.utc)
+        return utc.astimezone().replace(tzinfo=None), False
+    dt = datetime.strptime(value, '%Y%m%dT%H%M%S')
+    if 'TZID' in params:
+        try:
+            zone = ZoneInfo(params['TZID'])
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"unknown time zone {params['TZID']}")
+        dt = dt.replace(tzinfo=zone).astimezone().replace(tzinfo=None)
+    # Floating times are taken as the bot's local time, like everything else it stores
+    return dt, False
+
+
+def _parse_duration(value):
+    match = DURATION_PATTERN.match(value.strip())
+    if not match or not any(match.groups()[1:]):
+        raise ValueError(f"invalid duration {value}")
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    total = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0),
+                      minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -total if sign == '-' else total
+
+
+def _parse_rule(value):
+    fields = dict(part.split('=', 1) for part in value.upper().split(';') if '=' in part)
+    unsupported = set(fields) - {'FREQ', 'INTERVAL', 'BYDAY', 'COUNT', 'UNTIL', 'WKST'}
+    if fields.get('FREQ') not in FREQUENCIES or unsupported:
+        raise ValueError(f"unsupported repeat rule {value}")
+    byday = []
+    if 'BYDAY' in fields:
+        if fields['FREQ'] != 'WEEKLY' or any(day not in WEEKDAYS for day in fields['BYDAY'].split(',')):
+            raise ValueError(f"unsupported repeat rule {value}")
+        byday = [WEEKDAYS.index(day) for day in fields['BYDAY'].split(',')]
+    until = None
+    if 'UNTIL' in fields:
+        until, all_day = _parse_datetime(fields['UNTIL'], {})
+        if all_day:
+            until = until.replace(hour=23, minute=59, second=59)
+    return Recurrence(fields['FREQ'], interval=int(fields.get('INTERVAL', 1)), byday=byday,
+                      count=int(fields['COUNT']) if 'COUNT' in fields else None, until=until)
+
+
+def parse_event(props, default_category='general'):
+    """Turn a parsed VEVENT into an IcsEvent, raising ValueError for anything the bot can't store"""
+    def first(name, default=None):
+        values = props.get(name)
+        return values[0] if values else (None, default)
+
+    _, summary = first('SUMMARY')
+    if not summary:
+        raise ValueError("missing SUMMARY")
+    dtstart_params, dtstart = first('DTSTART')
+    if not dtstart:
+        raise ValueError(f"'{summary}' has no DTSTART")
+    if first('STATUS')[1] == 'CANCELLED':
+        raise ValueError(f"'{summary}' is cancelled")
+
+    start, all_day = _parse_datetime(dtstart, dtstart_params)
+    if 'DTEND' in props:
+        end, _ = _parse_datetime(props['DTEND'][0][1], props['DTEND'][0][0])
+        duration = end - start
+    elif 'DURATION' in props:
+        duration = _parse_duration(props['DURATION'][0][1])
+    else:
+        duration = timedelta(days=1) if all_day else timedelta(hours=1)
+    duration = max(int(duration.total_seconds() // 60), 1)
+
+    rule = _parse_rule(props['RRULE'][0][1]) if 'RRULE' in props else None
+    exdates = []
+    for params, value in props.get('EXDATE', ()):
+        for part in value.split(','):
+            exdate, _ = _parse_datetime(part, params)
+            # Date-only exceptions cancel that day's occurrence
+            exdates.append(exdate.replace(hour=start.hour, minute=start.minute, second=start.second)
+                           if len(part.strip()) == 8 else exdate)
+
+    reminders = []
+    for params, value in props['ALARMS']:
+        if params.get('VALUE', 'DURATION') != 'DURATION' or params.get('RELATED', 'START') != 'START':
+            continue
+        offset = _parse_duration(value)
+        if offset <= timedelta(0):
+            reminders.append(int(-offset.total_seconds() // 60))
+
+    _, uid = first('UID')
+    _, categories = first('CATEGORIES', default_category)
+    _, description = first('DESCRIPTION', 'No description provided')
+    return IcsEvent(
+        uid=uid.strip() if uid else None,
+        title=_unescape(summary)[:200],
+        description=_unescape(description)[:2000],
+        category=_unescape(categories).split(',')[0].strip() or default_category,
+        start=start,
+        duration=duration,
+        rule=rule,
+        exdates=exdates,
+        reminders=sorted(set(reminders)) or None,
+    )
+
+
+def existing_uids(conn, guild_id, uids):
+    """Which of these UIDs were already imported into the guild"""
+    found = set()
+    uids = list(uids)
+    for start in range(0, len(uids), 500):
+        chunk = uids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        # Archived events count too, so re-importing an old calendar doesn't bring them back
+        found.update(row[0] for row in conn.execute(f"""
+            SELECT ics_uid FROM events WHERE guild_id = ? AND ics_uid IN ({placeholders})
+            UNION ALL
+            SELECT ics_uid FROM archived_events WHERE guild_id = ? AND ics_uid IN ({placeholders})
+        """, [guild_id] + chunk + [guild_id] + chunk))
+    return found
+
+
+def insert_events(conn, events, exceptions, reminders):
+    """Insert a whole import in one transaction with batched statements
+
+    events are events-table tuples in (guild_id, channel_id, creator_id, title, description, event_time,
+    category, duration, recurrence, recurrence_end, ics_uid) order; exceptions and reminders refer to
+    them by position. Returns the new event IDs in order, and (fire_at, reminder_id, event_id) for
+    every reminder inserted.
+    """
+    # Holding the write lock from the start makes the ID range below ours alone
+    conn.execute('BEGIN IMMEDIATE')
+    base = conn.execute("""
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'events'), 0),
+                   COALESCE((SELECT MAX(id) FROM events), 0))
+    """).fetchone()[0]
+    event_ids = range(base + 1, base + 1 + len(events))
+    conn.executemany("""
+        INSERT INTO events (id, guild_id, channel_id, creator_id, title, description, event_time, category,
+                            duration, recurrence, recurrence_end, ics_uid)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(event_id,) + row for event_id, row in zip(event_ids, events)])
+    conn.executemany('INSERT OR IGNORE INTO event_exceptions (event_id, occurrence) VALUES (?, ?)',
+                     [(event_ids[index], occurrence) for index, occurrence in exceptions])
+    conn.executemany('INSERT INTO reminders (event_id, reminder_time, fire_at) VALUES (?, ?, ?)',
+                     [(event_ids[index], reminder, fire_at) for index, reminder, fire_at in reminders])
+    reminder_rows = conn.execute('SELECT fire_at, id, event_id FROM reminders WHERE event_id > ?',
+                                 (base,)).fetchall()
+    return list(event_ids), reminder_rows
+
+
+def _fold(line):
+    """Fold a content line at 75 octets without splitting a UTF-8 character"""
+    data = line.encode()
+    if len(data) <= 75:
+        return data + b'\r\n'
+    parts = []
+    limit = 75
+    while len(data) > limit:
+        cut = limit
+        while cut and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+        limit = 74  # continuation lines start with a space
+    parts.append(data)
+    return b'\r\n '.join(parts) + b'\r\n'
+
+
+def _utc(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _local(ts):
+    return from_timestamp(ts).strftime('%Y%m%dT%H%M%S')
+
+
+def _grouped(cursor):
+    """Yield (event_id, [values]) from a cursor of (event_id, value) rows ordered by event_id"""
+    current, values = None, []
+    for event_id, value in cursor:
+        if event_id != current:
+            if values:
+                yield current, values
+            current, values = event_id, []
+        values.append(value)
+    if values:
+        yield current, values
+
+
+def write_calendar(conn, fp, guild_id, category=None, start=None, end=None, archived=False):
+    """Write the guild's events as iCalendar to a binary file, streaming from the database
+
+    Events, exceptions and reminders are read by three cursors in event ID order and merged, so
+    memory use doesn't grow with the calendar. With archived, finished events moved to the archive
+    tables are written too. Returns the number of events written.
+    """
+    filters, params = "", []
+    if category:
+        filters += " AND category = ?"
+        params.append(category)
+    if start is not None:
+        filters += " AND (event_time >= ? OR (recurrence IS NOT NULL AND (recurrence_end IS NULL OR recurrence_end >= ?)))"
+        params += [start, start]
+    if end is not None:
+        filters += " AND event_time <= ?"
+        params.append(end)
+
+    stamp = _utc(to_timestamp(datetime.now()))
+    fp.write(b''.join(_fold(line) for line in ('BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}',
+                                               'CALSCALE:GREGORIAN')))
+    # Sent reminders of live events are archived ahead of the event itself; a reminder is in one
+    # table or the other, so the two are merged without comparing rows
+    reminders = conn.execute("""
+        SELECT r.event_id, r.reminder_time FROM reminders r JOIN events e ON e.id = r.event_id
+        WHERE e.guild_id = ?
+        UNION ALL
+        SELECT r.event_id, r.reminder_time FROM archived_reminders r JOIN events e ON e.id = r.event_id
+        WHERE e.guild_id = ?
+        ORDER BY 1
+    """, (guild_id, guild_id))
+    written = _write_events(conn, fp, guild_id, filters, params, stamp, 'events', 'event_exceptions', reminders)
+    if archived:
+        reminders = conn.execute("""
+            SELECT DISTINCT r.event_id, r.reminder_time
+            FROM archived_reminders r
+            JOIN archived_events e ON e.id = r.event_id
+            WHERE e.guild_id = ?
+            ORDER BY r.event_id
+        """, (guild_id,))
+        written += _write_events(conn, fp, guild_id, filters, params, stamp, 'archived_events',
+                                 'archived_event_exceptions', reminders)
+    fp.write(_fold('END:VCALENDAR'))
+    return written
+
+
+def _write_events(conn, fp, guild_id, filters, params, stamp, events_table, exceptions_table, reminders):
+    # reminders is a cursor of (event_id, reminder_time) ordered by event_id
+    events = conn.execute(f"""
+        SELECT id, title, description, category, event_time, duration, recurrence, ics_uid
+        FROM {events_table}
+        WHERE guild_id = ? AND is_cancelled = 0{filters}
+        ORDER BY id
+    """, [guild_id] + params)
+    exceptions = _grouped(conn.execute(f"""
+        SELECT x.event_id, x.occurrence
+        FROM {exceptions_table} x
+        JOIN {events_table} e ON e.id = x.event_id
+        WHERE e.guild_id = ?
+        ORDER BY x.event_id
+    """, (guild_id,)))
+    reminders = _grouped(reminders)
+    next_exceptions = next(exceptions, None)
+    next_reminders = next(reminders, None)
+    written = 0
+
+    for event_id, title, description, event_category, event_time, duration, recurrence, uid in events:
+        while next_exceptions and next_exceptions[0] < event_id:
+            next_exceptions = next(exceptions, None)
+        while next_reminders and next_reminders[0] < event_id:
+            next_reminders = next(reminders, None)
+
+        lines = ['BEGIN:VEVENT', f"UID:{uid or f'event-{event_id}-{guild_id}@discord-calendar-bot'}",
+                 f'DTSTAMP:{stamp}', f'SUMMARY:{_escape(title or "")}']
+        if recurrence:
+            # Series repeat in local time, so they are written as floating times to keep the
+            # same wall-clock time across daylight saving changes
+            lines.append(f'DTSTART:{_local(event_time)}')
+            lines.append(f'RRULE:{recurrence}')
+            if next_exceptions and next_exceptions[0] == event_id:
+                lines.append('EXDATE:' + ','.join(_local(ts) for ts in sorted(next_exceptions[1])))
+        else:
+            lines.append(f'DTSTART:{_utc(event_time)}')
+        lines.append(f'DURATION:PT{duration}M')
+        lines.append(f'CATEGORIES:{_escape(event_category or "general")}')
+        if description:
+            lines.append(f'DESCRIPTION:{_escape(description)}')
+        if next_reminders and next_reminders[0] == event_id:
+            # Two reminders at the same offset would only show up twice
+            for reminder in sorted(set(next_reminders[1])):
+                lines += ['BEGIN:VALARM', 'ACTION:DISPLAY', f'DESCRIPTION:{_escape(title or "")}',
+                          f'TRIGGER:-PT{reminder}M', 'END:VALARM']
+        lines.append('END:VEVENT')
+        fp.write(b''.join(_fold(line) for line in lines))
+        written += 1
+    return written
@@ -0,0 +1,298 @@
+import asyncio
+import time
+from bisect import bisect_left
+from datetime import timedelta
+
+from database import from_timestamp, to_timestamp
+from recurrence import Recurrence
+from sharding import owned
+
+
+class GuildIntervals:
+    """One guild's upcoming events, bucketed by length and sorted by start time"""
+
+    def __init__(self):
+        self._events = {}
+        # tier -> (starts, ids): parallel arrays of events whose length in seconds has bit_length == tier,
+        # so every event in a tier is shorter than 2 ** tier and a search only has to look back that far
+        self._tiers = {}
+        # Recurring series are expanded over the query window instead of being stored per occurrence
+        self._series = {}
+
+    def __len__(self):
+        return len(self._events) + len(self._series)
+
+    def _locate(self, event_id, start, end):
+        starts, ids = self._tiers[(end - start).bit_length()]
+        i = bisect_left(starts, start)
+        while ids[i] != event_id:
+            i += 1
+        return starts, ids, i
+
+    def add(self, event_id, title, start, end):
+        if event_id in self._events:
+            self.remove(event_id)
+        self._events[event_id] = (title, start, end)
+        starts, ids = self._tiers.setdefault((end - start).bit_length(), ([], []))
+        i = bisect_left(starts, start)
+        starts.insert(i, start)
+        ids.insert(i, event_id)
+
+    def add_series(self, event_id, title, rule, dtstart, length, exceptions=()):
+        self._series[event_id] = (title, rule, dtstart, length, set(exceptions))
+
+    def add_exception(self, event_id, occurrence):
+        if event_id in self._series:
+            self._series[event_id][4].add(occurrence)
+
+    def remove(self, event_id):
+        if self._series.pop(event_id, None) is not None:
+            return
+        event = self._events.pop(event_id, None)
+        if event is None:
+            return
+        _, start, end = event
+        starts, ids, i = self._locate(event_id, start, end)
+        del starts[i]
+        del ids[i]
+
+    def overlapping(self, start, end):
+        """Return (event_id, title, start, end) for every event overlapping [start, end), by start time"""
+        found = []
+        for tier, (starts, ids) in self._tiers.items():
+            lo = bisect_left(starts, start - (1 << tier))
+            hi = bisect_left(starts, end)
+            for i in range(lo, hi):
+                title, event_start, event_end = self._events[ids[i]]
+                if event_end > start:
+                    found.append((ids[i], title, event_start, event_end))
+        for event_id, (title, rule, dtstart, length, exceptions) in self._series.items():
+            # Occurrences starting after start - length are the ones still running at start
+            for occurrence in rule.occurrences(dtstart, from_timestamp(start - length + 1), from_timestamp(end)):
+                occurrence_start = to_timestamp(occurrence)
+                if occurrence_start not in exceptions:
+                    found.append((event_id, title, occurrence_start, occurrence_start + length))
+        found.sort(key=lambda event: event[2])
+        return found
+
+    def prune(self, now):
+        """Forget events that have already finished"""
+        for tier, (starts, ids) in self._tiers.items():
+            cutoff = bisect_left(starts, now - (1 << tier))
+            if cutoff:
+                for event_id in ids[:cutoff]:
+                    del self._events[event_id]
+                del starts[:cutoff]
+                del ids[:cutoff]
+
+
+def merge_busy(intervals):
+    """Merge (start, end) pairs sorted by start into disjoint busy intervals"""
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def daily_windows(start, end, day_start, day_end, weekdays=None):
+    """Epoch (start, end) of the daily local-time window [day_start, day_end) on each day in [start, end)
+
+    day_start and day_end are minutes after midnight; a window ending at or before it starts runs past
+    midnight. weekdays limits the days windows open on (0 is Monday).
+    """
+    windows = []
+    day = from_timestamp(start).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    while to_timestamp(day) < end:
+        if weekdays is None or day.weekday() in weekdays:
+            opens = day + timedelta(minutes=day_start)
+            closes = day + timedelta(days=1 if day_end <= day_start else 0, minutes=day_end)
+            window = max(to_timestamp(opens), start), min(to_timestamp(closes), end)
+            if windows and window[0] <= windows[-1][1]:
+                # Back-to-back windows (a whole day, or one past midnight) form one stretch
+                windows[-1] = (windows[-1][0], max(windows[-1][1], window[1]))
+            elif window[0] < window[1]:
+                windows.append(window)
+        day += timedelta(days=1)
+    return windows
+
+
+def free_slots(busy, windows, length, limit):
+    """The first `limit` gaps of at least `length` seconds inside windows, avoiding merged busy intervals
+
+    busy and windows are both sorted and disjoint, so this is one linear sweep over the two.
+    """
+    found = []
+    i = 0
+    for window_start, window_end in windows:
+        cursor = window_start
+        # Skip busy intervals that ended before this window
+        while i < len(busy) and busy[i][1] <= cursor:
+            i += 1
+        j = i
+        while j < len(busy) and busy[j][0] < window_end:
+            if busy[j][0] - cursor >= length:
+                found.append((cursor, busy[j][0]))
+                if len(found) == limit:
+                    return found
+            cursor = max(cursor, busy[j][1])
+            j += 1
+        if window_end - cursor >= length:
+            found.append((cursor, window_end))
+            if len(found) == limit:
+                return found
+    return found
+
+
+def _load_guild(conn, guild_id, now):
+    rows = conn.execute("""
+        SELECT id, title, event_time, event_time + duration * 60
+        FROM events
+        WHERE guild_id = ?
+        AND is_cancelled = 0
+        AND recurrence IS NULL
+        AND event_time + duration * 60 > ?
+    """, (guild_id, now)).fetchall()
+    series = conn.execute("""
+        SELECT id, title, recurrence, event_time, duration
+        FROM events
+        WHERE guild_id = ?
+        AND is_cancelled = 0
+        AND recurrence IS NOT NULL
+        AND (recurrence_end IS NULL OR recurrence_end + duration * 60 > ?)
+    """, (guild_id, now)).fetchall()
+    exceptions = {}
+    for event_id, occurrence in conn.execute("""
+        SELECT x.event_id, x.occurrence
+        FROM event_exceptions x
+        JOIN events e ON e.id = x.event_id
+        WHERE e.guild_id = ?
+        AND e.is_cancelled = 0
+    """, (guild_id,)):
+        exceptions.setdefault(event_id, []).append(occurrence)
+    return rows, series, exceptions
+
+
+def _load_all(conn, now, shards=None):
+    # The same reads as _load_guild, for every guild in these shards at once
+    ownership, params = owned(shards, 'guild_id')
+    rows = conn.execute(f"""
+        SELECT guild_id, id, title, event_time, event_time + duration * 60
+        FROM events
+        WHERE is_cancelled = 0
+        AND recurrence IS NULL
+        AND event_time + duration * 60 > ?
+        AND {ownership}
+    """, [now] + params).fetchall()
+    series = conn.execute(f"""
+        SELECT guild_id, id, title, recurrence, event_time, duration
+        FROM events
+        WHERE is_cancelled = 0
+        AND recurrence IS NOT NULL
+        AND (recurrence_end IS NULL OR recurrence_end + duration * 60 > ?)
+        AND {ownership}
+    """, [now] + params).fetchall()
+    ownership, params = owned(shards, 'e.guild_id')
+    exceptions = {}
+    for event_id, occurrence in conn.execute(f"""
+        SELECT x.event_id, x.occurrence
+        FROM event_exceptions x
+        JOIN events e ON e.id = x.event_id
+        WHERE e.is_cancelled = 0
+        AND e.recurrence IS NOT NULL
+        AND {ownership}
+    """, params):
+        exceptions.setdefault(event_id, []).append(occurrence)
+    return rows, series, exceptions
+
+
+class ConflictIndex:
+    """Lazily loaded per-guild interval indexes used for conflict detection"""
+
+    def __init__(self, db):
+        self.db = db
+        self._guilds = {}
+        self._loads = {}
+        # Changes that arrive while a guild is loading, replayed once the load finishes
+        self._pending = {}
+
+    async def _load(self, guild_id):
+        try:
+            rows, series, exceptions = await self.db.run(_load_guild, guild_id, int(time.time()))
+            intervals = GuildIntervals()
+            for event_id, title, start, end in rows:
+                intervals.add(event_id, title, start, end)
+            for event_id, title, recurrence, start, duration in series:
+                intervals.add_series(event_id, title, Recurrence.parse(recurrence), from_timestamp(start),
+                                     duration * 60, exceptions.get(event_id, ()))
+            for op, args in self._pending[guild_id]:
+                getattr(intervals, op)(*args)
+            self._guilds[guild_id] = intervals
+            return intervals
+        finally:
+            del self._pending[guild_id]
+            del self._loads[guild_id]
+
+    async def hydrate(self, shards=None):
+        """Build the index for every guild up front with three bulk reads; returns (guilds, events)"""
+        rows, series, exceptions = await self.db.run(_load_all, int(time.time()), shards)
+        guilds = {}
+        for guild_id, event_id, title, start, end in rows:
+            guilds.setdefault(guild_id, GuildIntervals()).add(event_id, title, start, end)
+        for guild_id, event_id, title, recurrence, start, duration in series:
+            guilds.setdefault(guild_id, GuildIntervals()).add_series(
+                event_id, title, Recurrence.parse(recurrence), from_timestamp(start), duration * 60,
+                exceptions.get(event_id, ()))
+        # Guilds already loaded, or loading, keep their own copy
+        for guild_id, intervals in guilds.items():
+            if guild_id not in self._guilds and guild_id not in self._loads:
+                self._guilds[guild_id] = intervals
+        return len(guilds), len(rows) + len(series)
+
+    async def _get(self, guild_id):
+        intervals = self._guilds.get(guild_id)
+        if intervals is not None:
+            return intervals
+        if guild_id not in self._loads:
+            self._pending[guild_id] = []
+            self._loads[guild_id] = asyncio.create_task(self._load(guild_id))
+        return await asyncio.shield(self._loads[guild_id])
+
+    def add(self, guild_id, event_id, title, start, end):
+        if guild_id in self._pending:
+            self._pending[guild_id].append(('add', (event_id, title, start, end)))
+        elif guild_id in self._guilds:
+            self._guilds[guild_id].add(event_id, title, start, end)
+
+    def add_series(self, guild_id, event_id, title, rule, dtstart, length):
+        if guild_id in self._pending:
+            self._pending[guild_id].append(('add_series', (event_id, title, rule, dtstart, length)))
+        elif guild_id in self._guilds:
+            self._guilds[guild_id].add_series(event_id, title, rule, dtstart, length)
+
+    def add_exception(self, guild_id, event_id, occurrence):
+        if guild_id in self._pending:
+            self._pending[guild_id].append(('add_exception', (event_id, occurrence)))
+        elif guild_id in self._guilds:
+            self._guilds[guild_id].add_exception(event_id, occurrence)
+
+    def remove(self, guild_id, event_id):
+        if guild_id in self._pending:
+            self._pending[guild_id].append(('remove', (event_id,)))
+        elif guild_id in self._guilds:
+            self._guilds[guild_id].remove(event_id)
+
+    async def overlapping(self, guild_id, start, end):
+        """Events in the guild overlapping [start, end), as (event_id, title, start, end)"""
+        intervals = await self._get(guild_id)
+        intervals.prune(time.time())
+        return intervals.overlapping(start, end)
+
+    async def overlapping_many(self, guild_id, slots):
+        """Check a batch of proposed (start, end) slots; returns one conflict list per slot"""
+        intervals = await self._get(guild_id)
+        intervals.prune(time.time())
+        return [intervals.overlapping(start, end) for start, end in slots]
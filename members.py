@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import discord
+
+log = logging.getLogger(__name__)
+
+# Discord answers member queries for at most 100 user IDs at a time
+QUERY_CHUNK = 100
+
+
+class MemberNames:
+    """Display names by (guild_id, user_id), kept for `ttl` seconds and capped at `max_entries`
+
+    Names come from the member cache when they can; the rest are fetched with one gateway member
+    query per 100 IDs instead of one request per user.
+    """
+
+    def __init__(self, ttl=600, max_entries=50000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (guild_id, user_id) -> (display name or None for someone no longer in the guild, expiry)
+        self._names = OrderedDict()
+
+    def _get(self, key, now):
+        entry = self._names.get(key)
+        if entry is None or entry[1] <= now:
+            return False, None
+        self._names.move_to_end(key)
+        return True, entry[0]
+
+    def _put(self, key, name, now):
+        self._names[key] = (name, now + self.ttl)
+        self._names.move_to_end(key)
+        while len(self._names) > self.max_entries:
+            self._names.popitem(last=False)
+
+    async def resolve(self, guild, user_ids):
+        """{user_id: display name}; users who can't be resolved are left out"""
+        now = time.monotonic()
+        names, missing = {}, []
+        for user_id in user_ids:
+            found, name = self._get((guild.id, user_id), now)
+            if not found:
+                member = guild.get_member(user_id)
+                if member is None:
+                    missing.append(user_id)
+                    continue
+                name = member.display_name
+                self._put((guild.id, user_id), name, now)
+            if name is not None:
+                names[user_id] = name
+
+        for start in range(0, len(missing), QUERY_CHUNK):
+            chunk = missing[start:start + QUERY_CHUNK]
+            try:
+                members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False)
+            except (asyncio.TimeoutError, discord.ClientException) as e:
+                # Not cached either way, so the next view tries again
+                log.warning('Could not look up %d member(s) of guild %s: %s', len(chunk), guild.id, e)
+                continue
+            found = {member.id: member.display_name for member in members}
+            for user_id in chunk:
+                self._put((guild.id, user_id), found.get(user_id), now)
+            names.update(found)
+        return names
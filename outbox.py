@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+import discord
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` sends per `per` seconds, sleeping callers until a token is free"""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self._tokens = rate
+        self._updated = time.monotonic()
+
+    def take(self, tokens=1):
+        """Spend tokens if there are enough and return 0, else return the seconds until there will be"""
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+        self._updated = now
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0
+        return (tokens - self._tokens) * self.per / self.rate
+
+    async def acquire(self):
+        while wait := self.take():
+            await asyncio.sleep(wait)
+
+
+class Outbox:
+    """Per-channel outbound message queues, sent concurrently across channels and paced within each
+
+    Pacing uses fixed budgets rather than Discord's rate-limit headers, which discord.py reads but
+    doesn't pass on: by default 5 messages per 5 seconds per channel and 45 per second overall, just
+    under Discord's per-channel and global limits. discord.py itself waits out any 429 that still
+    happens, so only server errors and dropped connections are retried here.
+    """
+
+    def __init__(self, get_channel, channel_rate=5, channel_per=5.0, global_rate=45, global_per=1.0,
+                 max_retries=4, lag_threshold=5.0, on_lag=None):
+        self.get_channel = get_channel
+        self.channel_rate = channel_rate
+        self.channel_per = channel_per
+        self.max_retries = max_retries
+        self.lag_threshold = lag_threshold
+        self._global = TokenBucket(global_rate, global_per)
+        self._queues = {}
+        self._buckets = {}
+        self._workers = {}
+        # Seconds between when a message was due and when Discord accepted it
+        self.lag = deque(maxlen=1000)
+        self.on_lag = on_lag
+
+    def send(self, channel_id, content=None, embed=None, due_at=None):
+        """Queue a message for a channel; due_at (epoch seconds) makes its delivery lag recorded"""
+        self._queues.setdefault(channel_id, deque()).append((content, embed, due_at))
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._drain(channel_id))
+
+    def depth(self):
+        """Number of messages waiting to be sent"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def lag_percentiles(self):
+        """p50/p95/p99/max delivery lag in seconds over the most recent messages"""
+        samples = sorted(self.lag)
+        if not samples:
+            return {}
+        return {
+            'p50': samples[int(0.50 * (len(samples) - 1))],
+            'p95': samples[int(0.95 * (len(samples) - 1))],
+            'p99': samples[int(0.99 * (len(samples) - 1))],
+            'max': samples[-1],
+        }
+
+    async def join(self):
+        """Wait until every queued message has been sent or dropped"""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    async def _drain(self, channel_id):
+        queue = self._queues[channel_id]
+        bucket = self._buckets.setdefault(channel_id, TokenBucket(self.channel_rate, self.channel_per))
+        try:
+            while queue:
+                content, embed, due_at = queue.popleft()
+                await self._deliver(channel_id, bucket, content, embed)
+                if due_at is not None:
+                    lag = time.time() - due_at
+                    self.lag.append(lag)
+                    if self.on_lag is not None:
+                        self.on_lag(lag)
+                    if lag > self.lag_threshold:
+                        log.warning('Message for channel %s went out %.1fs after it was due', channel_id, lag)
+        finally:
+            # Idle channels don't keep a task around
+            del self._workers[channel_id]
+            if not queue:
+                del self._queues[channel_id]
+
+    async def _deliver(self, channel_id, bucket, content, embed):
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            log.warning('Dropping message for unknown channel %s', channel_id)
+            return
+
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                await channel.send(content, embed=embed)
+                return
+            except (discord.Forbidden, discord.NotFound):
+                log.warning('Dropping message for channel %s: no access', channel_id)
+                return
+            except (discord.HTTPException, OSError) as e:
+                status = getattr(e, 'status', None)
+                if attempt == self.max_retries or (status is not None and status < 500):
+                    log.exception('Giving up on message for channel %s', channel_id)
+                    return
+                # Exponential backoff with jitter
+                await asyncio.sleep(2 ** attempt + random.random())
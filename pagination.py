@@ -0,0 +1,143 @@
+import asyncio
+from collections import OrderedDict
+
+import discord
+
+
+class PageCache:
+    """LRU cache of rendered pages keyed by (guild_id, ...), dropped per guild when its events change"""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._pages = OrderedDict()
+        self._by_guild = {}
+        # Pages being built, shared by everyone who asks for them meanwhile
+        self._loading = {}
+        # Bumped per guild on invalidation, so a page built from older data isn't cached
+        self._generations = {}
+
+    def get(self, key):
+        page = self._pages.get(key)
+        if page is not None:
+            self._pages.move_to_end(key)
+        return page
+
+    def put(self, key, page):
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+        self._by_guild.setdefault(key[0], set()).add(key)
+        while len(self._pages) > self.max_entries:
+            old_key, _ = self._pages.popitem(last=False)
+            self._discard_key(old_key)
+
+    def _discard_key(self, key):
+        keys = self._by_guild.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_guild[key[0]]
+
+    async def load(self, key, build):
+        """The cached page for key, or the result of awaiting build(); concurrent loads of a key share one build"""
+        page = self.get(key)
+        if page is not None:
+            return page
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.create_task(self._build(key, build))
+        return await asyncio.shield(task)
+
+    async def _build(self, key, build):
+        generation = self._generations.get(key[0], 0)
+        try:
+            page = await build()
+        finally:
+            if self._loading.get(key) is asyncio.current_task():
+                del self._loading[key]
+        if self._generations.get(key[0], 0) == generation:
+            self.put(key, page)
+        return page
+
+    def invalidate(self, guild_id):
+        for key in self._by_guild.pop(guild_id, ()):
+            self._pages.pop(key, None)
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+        # Builds already running finish for whoever is waiting, but later requests start afresh
+        for key in [key for key in self._loading if key[0] == guild_id]:
+            del self._loading[key]
+
+
+class KeysetPages:
+    """Fixed-size pages fetched by keyset cursor, remembering where each visited page starts
+
+    fetch(after, limit) returns rows ordered by cursor(row) strictly after `after`; render(rows, page,
+    has_next) turns one page of rows into whatever gets sent. Rendered pages are cached under
+    cache_key + (page,).
+    """
+
+    def __init__(self, fetch, render, cursor, page_size, cache, cache_key):
+        self.fetch = fetch
+        self.render = render
+        self.cursor = cursor
+        self.page_size = page_size
+        self.cache = cache
+        self.cache_key = cache_key
+        self._starts = [None]
+
+    async def page(self, number):
+        """Render page `number`; only pages already reached by paging forward can be requested"""
+        # Identical requests arriving together, e.g. several people running !agenda at once, share one fetch
+        rendered, next_start = await self.cache.load(self.cache_key + (number,), lambda: self._build(number))
+        if next_start is not None and len(self._starts) == number + 1:
+            self._starts.append(next_start)
+        return rendered, next_start is not None
+
+    async def _build(self, number):
+        # One extra row tells us whether there is a next page without counting the rest
+        rows = await self.fetch(self._starts[number], self.page_size + 1)
+        has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        next_start = self.cursor(rows[-1]) if has_next else None
+        return self.render(rows, number, has_next), next_start
+
+    async def pages(self):
+        """Yield every rendered page in order, fetching each only when the previous one is consumed"""
+        number = 0
+        while True:
+            rendered, has_next = await self.page(number)
+            yield rendered
+            if not has_next:
+                return
+            number += 1
+
+
+class PageView(discord.ui.View):
+    """Previous/next buttons that fetch and render only the requested page"""
+
+    def __init__(self, pages, author_id, has_next, timeout=180):
+        super().__init__(timeout=timeout)
+        self.pages = pages
+        self.author_id = author_id
+        self.number = 0
+        self._update_buttons(has_next)
+
+    def _update_buttons(self, has_next):
+        self.previous_page.disabled = self.number == 0
+        self.next_page.disabled = not has_next
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author_id
+
+    async def _show(self, interaction, number):
+        (content, embed), has_next = await self.pages.page(number)
+        self.number = number
+        self._update_buttons(has_next)
+        await interaction.response.edit_message(content=content, embed=embed, view=self)
+
+    @discord.ui.button(label='◀ Previous', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._show(interaction, self.number - 1)
+
+    @discord.ui.button(label='Next ▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._show(interaction, self.number + 1)
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+from rsvp import STATUS_MAP
+from sharding import owned
+
+log = logging.getLogger(__name__)
+
+
+def _load_targets(conn, now, ownership, params, event_ids=None):
+    # Announcements of events that haven't finished yet, soonest first, with their last checkpoint
+    if event_ids is not None:
+        targets = []
+        for start in range(0, len(event_ids), 500):
+            chunk = event_ids[start:start + 500]
+            targets += _load_targets(conn, now, f"e.id IN ({','.join('?' * len(chunk))}) AND {ownership}",
+                                     chunk + params)
+        return sorted(targets, key=lambda target: target[5])
+    return conn.execute(f"""
+        SELECT e.id, e.channel_id, e.message_id, c.signature, c.checked_at, e.event_time
+        FROM events e
+        LEFT JOIN reaction_checkpoints c ON c.event_id = e.id
+        WHERE e.message_id IS NOT NULL
+        AND e.is_cancelled = 0
+        AND CASE WHEN e.recurrence IS NULL THEN e.event_time ELSE COALESCE(e.recurrence_end, ?) END
+            + e.duration * 60 > ?
+        AND {ownership}
+        ORDER BY e.event_time
+    """, [now, now] + params).fetchall()
+
+
+def _load_state(conn, event_id):
+    """Stored series RSVPs and the reactions seen at the last checkpoint, per user"""
+    stored = dict(conn.execute('SELECT user_id, status FROM rsvp WHERE event_id = ? AND occurrence = 0',
+                               (event_id,)))
+    seen = {}
+    for user_id, status in conn.execute('SELECT user_id, status FROM reaction_users WHERE event_id = ?',
+                                        (event_id,)):
+        seen.setdefault(user_id, set()).add(status)
+    return stored, seen
+
+
+def _save_checkpoints(conn, checkpoints, now):
+    # Events archived since they were read are skipped rather than failing the batch
+    event_ids = [(event_id,) for event_id, _, _ in checkpoints]
+    conn.executemany('DELETE FROM reaction_users WHERE event_id = ?', event_ids)
+    conn.executemany("""
+        INSERT INTO reaction_users (event_id, user_id, status)
+        SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM events WHERE id = ?)
+    """, [(event_id, user_id, status, event_id)
+          for event_id, _, reactions in checkpoints
+          for user_id, statuses in reactions.items()
+          for status in statuses])
+    conn.executemany("""
+        INSERT INTO reaction_checkpoints (event_id, signature, checked_at)
+        SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM events WHERE id = ?)
+        ON CONFLICT (event_id) DO UPDATE SET signature = excluded.signature, checked_at = excluded.checked_at
+    """, [(event_id, signature, now, event_id) for event_id, signature, _ in checkpoints])
+
+
+def _pick(statuses):
+    # A user reacting with several RSVP emoji gets the first, in STATUS_MAP order
+    return next(status for status in STATUS_MAP.values() if status in statuses)
+
+
+def rsvp_changes(reactions, seen, stored):
+    """The RSVP changes that replay what happened to the reactions since the last checkpoint
+
+    reactions and seen map user IDs to their set of RSVP statuses now and at the checkpoint; stored
+    maps user IDs to their current RSVP. Users whose reactions didn't change keep their RSVP, so one
+    made with !rsvp is never overridden by an older reaction. Returns {user_id: status or None}.
+    """
+    changes = {}
+    for user_id in reactions.keys() | seen.keys():
+        now, before = reactions.get(user_id, set()), seen.get(user_id, set())
+        if now == before:
+            continue
+        current = stored.get(user_id)
+        if not now:
+            # Removing a reaction removes the RSVP, as on_raw_reaction_remove does
+            target = None
+        elif now - before:
+            target = _pick(now - before)
+        else:
+            target = current if current in now else _pick(now)
+        if target != current:
+            changes[user_id] = target
+    return changes
+
+
+class Reconciler:
+    """Backfills RSVP reactions that were added or removed while the bot wasn't connected
+
+    Each run fetches the announcement of every upcoming event and compares its reaction counts, not
+    counting the bot's own, with the previous run's checkpoint; only announcements whose counts
+    changed have their reaction users paged through. Equal counts can hide one member's reaction
+    replacing another's, so a checkpoint older than `recheck_after` seconds is re-read regardless.
+    At most `concurrency` announcements are read at once, and the resulting changes go through the
+    RSVP write-behind queue, so a run doesn't compete with commands for long. recheck() reads back
+    just the announcements whose reactions were shed under load.
+    """
+
+    def __init__(self, bot, db, writer, shards=None, concurrency=4, batch_size=50, recheck_after=86400):
+        self.bot = bot
+        self.db = db
+        self.writer = writer
+        self.shards = shards
+        self.batch_size = batch_size
+        self.recheck_after = recheck_after
+        self._limit = asyncio.Semaphore(concurrency)
+        self._task = None
+        self._running = False
+        self._again = False
+        # Events whose reactions were shed, waiting for the next recheck
+        self._rechecks = set()
+        self._recheck_task = None
+
+    def start(self, delay=0):
+        """Run once in the background after `delay` seconds
+
+        Calling it again before a pending run starts is a no-op; calling it during a run queues one more
+        right after, since reactions may have been missed after that run read them.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(delay))
+        elif self._running:
+            self._again = True
+
+    def recheck(self, event_id, delay=0):
+        """Reconcile one event's announcement in the background after `delay` seconds
+
+        Events passed in before then are read in the same pass; later ones wait for the next.
+        """
+        self._rechecks.add(event_id)
+        if self._recheck_task is None or self._recheck_task.done():
+            self._recheck_task = asyncio.create_task(self._run_rechecks(delay))
+
+    def stop(self):
+        for task in (self._task, self._recheck_task):
+            if task is not None:
+                task.cancel()
+        self._task = self._recheck_task = None
+
+    async def _run(self, delay):
+        await asyncio.sleep(delay)
+        self._again = True
+        while self._again:
+            self._again = False
+            self._running = True
+            try:
+                started = time.perf_counter()
+                checked, paged, changed = await self.run()
+                log.info('Reconciled reactions on %d announcement(s) in %.1fs: %d re-read, %d RSVP change(s)',
+                         checked, time.perf_counter() - started, paged, changed)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Reaction reconciliation failed')
+            finally:
+                self._running = False
+
+    async def _run_rechecks(self, delay):
+        while self._rechecks:
+            await asyncio.sleep(delay)
+            event_ids, self._rechecks = sorted(self._rechecks), set()
+            try:
+                checked, paged, changed = await self.run(event_ids)
+                log.info('Rechecked reactions on %d announcement(s): %d re-read, %d RSVP change(s)',
+                         checked, paged, changed)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Reaction recheck failed')
+
+    async def run(self, event_ids=None):
+        """Reconcile every upcoming event, or just these; returns (announcements checked, re-read, RSVPs changed)"""
+        ownership, params = owned(self.shards, 'e.guild_id')
+        now = int(time.time())
+        targets = await self.db.run(_load_targets, now, ownership, params, event_ids)
+        # Changes from before the run must be in the database before it's compared with Discord
+        await self.writer.flush()
+        checked = paged = changed = 0
+        for start in range(0, len(targets), self.batch_size):
+            results = await asyncio.gather(*(self._reconcile(*target[:5], now)
+                                             for target in targets[start:start + self.batch_size]))
+            results = [result for result in results if result is not None]
+            checkpoints = [checkpoint for checkpoint, _, _ in results if checkpoint is not None]
+            checked += len(results)
+            paged += sum(reread for _, _, reread in results)
+            changed += sum(applied for _, applied, _ in results)
+            # Write this batch's RSVPs before its checkpoints, so a crash in between only means re-reading
+            await self.writer.flush()
+            if checkpoints:
+                await self.db.run(_save_checkpoints, checkpoints, int(time.time()))
+        return checked, paged, changed
+
+    async def _reconcile(self, event_id, channel_id, message_id, checkpoint, checked_at, now):
+        # Returns None if the announcement can't be read, else (new checkpoint, RSVP changes queued,
+        # whether its users were read); the checkpoint is None when the counts still match a recent one
+        async with self._limit:
+            channel = self.bot.get_channel(channel_id) or self.bot.get_partial_messageable(channel_id)
+            try:
+                message = await channel.fetch_message(message_id)
+            except (discord.NotFound, discord.Forbidden):
+                return None
+            except discord.HTTPException as e:
+                log.warning('Could not fetch announcement %s of event %s: %s', message_id, event_id, e)
+                return None
+
+            reactions = {str(reaction.emoji): reaction for reaction in message.reactions
+                         if str(reaction.emoji) in STATUS_MAP}
+            counts = {emoji: reaction.count - reaction.me for emoji, reaction in reactions.items()}
+            signature = ','.join(str(counts.get(emoji, 0)) for emoji in STATUS_MAP)
+            if signature == checkpoint and checked_at is not None and now - checked_at < self.recheck_after:
+                return None, 0, False
+
+            # Changes arriving live from here on are newer than what we read, so they win
+            touched = self.writer.watch(event_id)
+            try:
+                users = {}
+                for emoji, reaction in reactions.items():
+                    if not counts[emoji]:
+                        continue
+                    async for user in reaction.users(limit=None):
+                        if user.id != self.bot.user.id:
+                            users.setdefault(user.id, set()).add(STATUS_MAP[emoji])
+                stored, seen = await self.db.run(_load_state, event_id)
+                changes = rsvp_changes(users, seen, stored)
+            finally:
+                self.writer.unwatch(event_id)
+            applied = 0
+            for user_id, status in changes.items():
+                if user_id in touched:
+                    continue
+                if status is None:
+                    self.writer.remove(event_id, user_id)
+                else:
+                    self.writer.set(event_id, user_id, status)
+                applied += 1
+            return (event_id, signature, users), applied, True
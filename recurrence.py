@@ -0,0 +1,149 @@
+import calendar
+from datetime import datetime, timedelta
+
+WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+WEEKDAY_NAMES = {'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6}
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY')
+
+
+class Recurrence:
+    """Repeat rule for a series, stored as a compact RRULE-style string"""
+
+    __slots__ = ('freq', 'interval', 'byday', 'count', 'until')
+
+    def __init__(self, freq, interval=1, byday=(), count=None, until=None):
+        if freq not in FREQUENCIES:
+            raise ValueError(f"Unknown frequency: {freq}")
+        if interval < 1 or (count is not None and count < 1):
+            raise ValueError("Interval and count must be positive")
+        self.freq = freq
+        self.interval = interval
+        self.byday = tuple(sorted(set(byday)))
+        self.count = count
+        self.until = until
+
+    @classmethod
+    def parse(cls, text):
+        """Parse the stored form, e.g. FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE;UNTIL=20250601T235959"""
+        fields = dict(part.split('=', 1) for part in text.split(';') if part)
+        return cls(
+            fields['FREQ'],
+            interval=int(fields.get('INTERVAL', 1)),
+            byday=[WEEKDAYS.index(day) for day in fields['BYDAY'].split(',')] if 'BYDAY' in fields else (),
+            count=int(fields['COUNT']) if 'COUNT' in fields else None,
+            until=datetime.strptime(fields['UNTIL'], '%Y%m%dT%H%M%S') if 'UNTIL' in fields else None,
+        )
+
+    def __str__(self):
+        parts = [f'FREQ={self.freq}']
+        if self.interval != 1:
+            parts.append(f'INTERVAL={self.interval}')
+        if self.byday:
+            parts.append('BYDAY=' + ','.join(WEEKDAYS[day] for day in self.byday))
+        if self.count is not None:
+            parts.append(f'COUNT={self.count}')
+        if self.until is not None:
+            parts.append(f"UNTIL={self.until.strftime('%Y%m%dT%H%M%S')}")
+        return ';'.join(parts)
+
+    def describe(self):
+        """Human-readable summary for embeds"""
+        unit = {'DAILY': 'day', 'WEEKLY': 'week', 'MONTHLY': 'month'}[self.freq]
+        text = f"every {unit}" if self.interval == 1 else f"every {self.interval} {unit}s"
+        if self.byday:
+            text += " on " + ', '.join(calendar.day_abbr[day] for day in self.byday)
+        if self.count is not None:
+            text += f", {self.count} times"
+        if self.until is not None:
+            text += f" until {self.until.strftime('%Y-%m-%d')}"
+        return text
+
+    def occurrences(self, dtstart, start=None, end=None):
+        """Yield occurrence datetimes in [start, end), jumping straight to start where the rule allows"""
+        if self.freq == 'DAILY':
+            periods = self._daily(dtstart, start)
+        elif self.freq == 'WEEKLY':
+            periods = self._weekly(dtstart, start)
+        else:
+            periods = self._monthly(dtstart, start)
+
+        for number, occurrence in periods:
+            if self.count is not None and number >= self.count:
+                return
+            if self.until is not None and occurrence > self.until:
+                return
+            if end is not None and occurrence >= end:
+                return
+            if start is None or occurrence >= start:
+                yield occurrence
+
+    def _daily(self, dtstart, start):
+        step = timedelta(days=self.interval)
+        number = max((start - dtstart) // step, 0) if start else 0
+        while True:
+            yield number, dtstart + number * step
+            number += 1
+
+    def _weekly(self, dtstart, start):
+        days = self.byday or (dtstart.weekday(),)
+        week0 = dtstart - timedelta(days=dtstart.weekday())
+        # Weekdays earlier in the first week than dtstart are not occurrences
+        skipped = sum(1 for day in days if day < dtstart.weekday())
+        period = timedelta(weeks=self.interval)
+        first = max((start - week0) // period, 0) if start else 0
+        number = first * len(days) - (skipped if first else 0)
+        while True:
+            week = week0 + first * period
+            for day in days:
+                occurrence = week + timedelta(days=day)
+                if occurrence >= dtstart:
+                    yield number, occurrence
+                    number += 1
+            first += 1
+
+    def _monthly(self, dtstart, start):
+        # Months without the day (e.g. the 31st) are skipped, so numbering needs a walk from dtstart
+        # when a count applies; open-ended rules can jump directly
+        months = 0
+        if start and self.count is None:
+            months = max((start.year - dtstart.year) * 12 + start.month - dtstart.month, 0)
+            months -= months % self.interval
+        number = 0
+        while True:
+            year, month = divmod(dtstart.month - 1 + months, 12)
+            year += dtstart.year
+            if dtstart.day <= calendar.monthrange(year, month + 1)[1]:
+                yield number, dtstart.replace(year=year, month=month + 1)
+                number += 1
+            months += self.interval
+
+    def first(self, dtstart, start=None):
+        """The first occurrence at or after start, or None once the series has ended"""
+        return next(self.occurrences(dtstart, start), None)
+
+    def last(self, dtstart):
+        """The final occurrence, or None if the series repeats forever"""
+        if self.count is None and self.until is None:
+            return None
+        last = None
+        for last in self.occurrences(dtstart):
+            pass
+        return last
+
+
+def parse_repeat(freq, every=1, on=None, until=None, count=None):
+    """Build a Recurrence from create_event's --repeat/--every/--on/--until/--count options"""
+    freq = freq.strip().lower()
+    byday = []
+    if freq == 'weekdays':
+        freq, byday = 'weekly', [0, 1, 2, 3, 4]
+    if on:
+        byday = [WEEKDAY_NAMES[day.strip().lower()[:3]] for day in on.split(',')]
+    rule_freq = {'daily': 'DAILY', 'weekly': 'WEEKLY', 'monthly': 'MONTHLY'}.get(freq)
+    if rule_freq is None:
+        raise ValueError(f"Unknown repeat frequency: {freq}")
+    if byday and rule_freq != 'WEEKLY':
+        raise ValueError("--on can only be used with weekly repeats")
+    if until:
+        until = datetime.strptime(until, "%Y-%m-%d").replace(hour=23, minute=59, second=59)
+    return Recurrence(rule_freq, interval=every, byday=byday, count=count, until=until)
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+
+from database import RSVP_STATUSES
+from sharding import owned
+
+log = logging.getLogger(__name__)
+
+# Map reactions to RSVP status
+STATUS_MAP = {
+    '👍': 'attending',
+    '❓': 'maybe',
+    '👎': 'not_attending'
+}
+
+
+class EventMessageCache:
+    """In-memory map of announcement message IDs to event IDs"""
+
+    def __init__(self, db, shards=None):
+        self.db = db
+        # Only announcements in this process's guilds are kept; reactions elsewhere never reach it
+        self.shards = shards
+        self._events = {}
+        self.loaded = False
+
+    async def load(self):
+        """Read every announcement in these shards in one query; returns how many were loaded"""
+        ownership, params = owned(self.shards, 'guild_id')
+        rows = await self.db.fetchall(f"""
+            SELECT message_id, id
+            FROM events
+            WHERE message_id IS NOT NULL
+            AND is_cancelled = 0
+            AND {ownership}
+        """, params)
+        self._events = dict(rows)
+        self.loaded = True
+        return len(self._events)
+
+    async def lookup(self, message_id):
+        """Return the event ID for a message, or None if it isn't an event announcement"""
+        if self.loaded:
+            return self._events.get(message_id)
+        # Only reached before the cache is hydrated at startup
+        row = await self.db.fetchone('SELECT id FROM events WHERE message_id = ? AND is_cancelled = 0', (message_id,))
+        return row[0] if row else None
+
+    def add(self, message_id, event_id):
+        self._events[message_id] = event_id
+
+    def discard(self, message_id):
+        self._events.pop(message_id, None)
+
+
+def _effective(archived):
+    # An occurrence's own RSVPs take precedence over the series RSVPs (occurrence 0)
+    table = 'archived_rsvp' if archived else 'rsvp'
+    return f"""
+        FROM {table} r
+        WHERE r.event_id = ?
+        AND (r.occurrence = ?
+             OR (r.occurrence = 0
+                 AND NOT EXISTS (SELECT 1 FROM {table} o
+                                 WHERE o.event_id = r.event_id AND o.occurrence = ? AND o.user_id = r.user_id)))"""
+
+
+def effective_rsvps(conn, event_id, occurrence=0, archived=False):
+    """(user_id, status) for one event, applying an occurrence's overrides on top of the series RSVPs"""
+    return conn.execute(f"SELECT r.user_id, r.status {_effective(archived)}",
+                        (event_id, occurrence, occurrence)).fetchall()
+
+
+# Orders statuses as RSVP_STATUSES does
+_STATUS_RANK = f"CASE r.status {' '.join(f'WHEN {status!r} THEN {i}' for i, status in enumerate(RSVP_STATUSES))} END"
+
+
+def rsvp_counts(conn, event_id, occurrence=0, archived=False):
+    """{status: count} for one event in a single grouped query"""
+    return dict(conn.execute(f"SELECT r.status, COUNT(*) {_effective(archived)} GROUP BY r.status",
+                             (event_id, occurrence, occurrence)))
+
+
+def rsvp_page(conn, event_id, occurrence=0, archived=False, after=None, limit=50):
+    """(status rank, user_id, status) for one page of an event's RSVPs, ordered by status then user
+
+    after is the (status rank, user_id) of the previous page's last row.
+    """
+    keyset, params = "", [event_id, occurrence, occurrence]
+    if after is not None:
+        keyset = f" AND ({_STATUS_RANK}, r.user_id) > (?, ?)"
+        params += list(after)
+    return conn.execute(f"""
+        SELECT {_STATUS_RANK}, r.user_id, r.status {_effective(archived)}{keyset}
+        ORDER BY 1, r.user_id
+        LIMIT ?
+    """, params + [limit]).fetchall()
+
+
+def _apply_changes(conn, changes):
+    upserts = [key + (status, key[0]) for key, status in changes.items() if status]
+    deletes = [key for key, status in changes.items() if not status]
+    # Reactions can still arrive for an event that was archived since; those are dropped
+    conn.executemany("""
+        INSERT INTO rsvp (event_id, occurrence, user_id, status)
+        SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM events WHERE id = ?)
+        ON CONFLICT (event_id, occurrence, user_id) DO UPDATE SET status = excluded.status
+    """, upserts)
+    conn.executemany('DELETE FROM rsvp WHERE event_id = ? AND occurrence = ? AND user_id = ?', deletes)
+
+
+class RsvpWriter:
+    """Write-behind queue that coalesces RSVP changes and flushes them in batches"""
+
+    def __init__(self, db, delay=0.5, max_batch=500, on_flush=None):
+        self.db = db
+        # Awaited with each batch of changes once it is written, so caches can catch up
+        self.on_flush = on_flush
+        self.delay = delay
+        self.max_batch = max_batch
+        # Latest requested status per (event_id, occurrence, user_id); None means the RSVP is removed
+        self._pending = {}
+        # event_id -> users whose RSVP changed while a reaction backfill was reading that event
+        self._watched = {}
+        self._flush_task = None
+        self._batch_tasks = set()
+        self._lock = asyncio.Lock()
+
+    def set(self, event_id, user_id, status, occurrence=0):
+        self._pending[(event_id, occurrence, user_id)] = status
+        self._touch(event_id, user_id)
+        self._schedule()
+
+    def remove(self, event_id, user_id, occurrence=0):
+        self._pending[(event_id, occurrence, user_id)] = None
+        self._touch(event_id, user_id)
+        self._schedule()
+
+    def watch(self, event_id):
+        """Collect the users whose RSVP to event_id changes until unwatch(); returns the live set"""
+        return self._watched.setdefault(event_id, set())
+
+    def unwatch(self, event_id):
+        self._watched.pop(event_id, None)
+
+    def _touch(self, event_id, user_id):
+        watched = self._watched.get(event_id)
+        if watched is not None:
+            watched.add(user_id)
+
+    def depth(self):
+        """Number of RSVP changes waiting to be written"""
+        return len(self._pending)
+
+    def _schedule(self):
+        if len(self._pending) >= self.max_batch and not self._batch_tasks:
+            task = asyncio.create_task(self.flush())
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Write every pending change in one transaction"""
+        async with self._lock:
+            if not self._pending:
+                return
+            changes, self._pending = self._pending, {}
+            try:
+                await self.db.run(_apply_changes, changes)
+            except Exception:
+                log.exception('Failed to write %d RSVP changes; retrying', len(changes))
+                # Keep anything that changed again since, then try the rest later
+                changes.update(self._pending)
+                self._pending = changes
+                self._schedule()
+                return
+            if self.on_flush is not None:
+                await self.on_flush(changes)
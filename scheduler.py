@@ -0,0 +1,198 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from database import from_timestamp, to_timestamp
+from recurrence import Recurrence
+from sharding import owned
+
+log = logging.getLogger(__name__)
+
+# How late a reminder may still go out; older ones, e.g. after downtime, are dropped unsent
+LATE_GRACE = 300
+
+
+def _load_window(conn, horizon, leases=None):
+    # Only reminders for guilds whose shard lease this process holds
+    ownership, params = owned(leases, 'e.guild_id', time.time())
+    return conn.execute(f"""
+        SELECT r.fire_at, r.id, r.event_id
+        FROM reminders r
+        JOIN events e ON e.id = r.event_id
+        WHERE r.notification_sent = 0
+        AND r.fire_at <= ?
+        AND e.is_cancelled = 0
+        AND {ownership}
+    """, [horizon] + params).fetchall()
+
+
+def _claim(conn, reminder_ids, now, leases=None, grace=LATE_GRACE):
+    # Mark as sent (or move on to the next occurrence) before delivery, so a restart
+    # can never send the same reminder twice
+    due, sent, advanced = [], [], []
+    stale = 0
+    ownership, ownership_params = owned(leases, 'e.guild_id', now)
+    for start in range(0, len(reminder_ids), 500):
+        chunk = reminder_ids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        rows = conn.execute(f"""
+            SELECT r.id, r.event_id, e.title, e.channel_id, r.reminder_time, r.fire_at, e.event_time, e.recurrence
+            FROM reminders r
+            JOIN events e ON e.id = r.event_id
+            WHERE r.id IN ({placeholders})
+            AND r.notification_sent = 0
+            AND e.is_cancelled = 0
+            AND {ownership}
+        """, chunk + ownership_params).fetchall()
+
+        for row in rows:
+            reminder_id, event_id, _, _, reminder_time, fire_at, event_time, recurrence = row
+            occurrence = fire_at + reminder_time * 60
+            # "Starting in N minutes" is wrong once the event has started or the reminder is long overdue
+            late = occurrence <= now or fire_at < now - grace
+            stale += late
+            if recurrence is None:
+                if not late:
+                    due.append(row[:6])
+                sent.append((reminder_id,))
+                continue
+
+            if not late and not conn.execute('SELECT 1 FROM event_exceptions WHERE event_id = ? AND occurrence = ?',
+                                             (event_id, occurrence)).fetchone():
+                due.append(row[:6])
+
+            # A series keeps one reminder row per offset; point it at the next occurrence still ahead,
+            # skipping any that were missed while the bot was offline
+            after = from_timestamp(max(occurrence, int(now) + reminder_time * 60) + 1)
+            next_occurrence = Recurrence.parse(recurrence).first(from_timestamp(event_time), after)
+            if next_occurrence is None:
+                sent.append((reminder_id,))
+            else:
+                advanced.append((to_timestamp(next_occurrence) - reminder_time * 60, reminder_id, event_id))
+
+    conn.executemany('UPDATE reminders SET notification_sent = 1 WHERE id = ?', sent)
+    conn.executemany('UPDATE reminders SET fire_at = ? WHERE id = ?', [entry[:2] for entry in advanced])
+    if stale:
+        log.info('Dropped %d overdue reminder(s) unsent', stale)
+    return due, advanced
+
+
+class ReminderScheduler:
+    """Sleeps until the next due reminder instead of polling the database"""
+
+    def __init__(self, db, deliver, lookahead=3600, coalesce=1.0, leases=None, grace=LATE_GRACE):
+        self.db = db
+        self.deliver = deliver
+        # With shard leases, only reminders for guilds in currently held shards are loaded and claimed
+        self.leases = leases
+        self.lookahead = lookahead
+        # Reminders due this close behind the first one are delivered in the same batch
+        self.coalesce = coalesce
+        # Reminders claimed more than this many seconds after they were due are dropped unsent
+        self.grace = grace
+        # Min-heap of (fire_at, reminder_id, event_id) for every pending reminder up to _horizon
+        self._heap = []
+        self._queued = set()
+        self._horizon = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def hydrate(self):
+        """Load the look-ahead window now, so start() begins with a warm queue; returns its size"""
+        await self._refill(time.time())
+        return len(self._heap)
+
+    def start(self):
+        """Start the scheduler task; calling it again while it runs is a no-op"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Reminders may have been claimed elsewhere meanwhile; a restart reads the window again
+        self._horizon = 0
+
+    def reload(self):
+        """Drop the queued window and read it again, e.g. after shard ownership changed"""
+        self._heap = []
+        self._queued = set()
+        self._horizon = 0
+        self._wakeup.set()
+
+    def depth(self):
+        """Number of reminders queued in the look-ahead window"""
+        return len(self._heap)
+
+    def _push(self, fire_at, reminder_id, event_id):
+        if reminder_id not in self._queued:
+            self._queued.add(reminder_id)
+            heapq.heappush(self._heap, (fire_at, reminder_id, event_id))
+
+    def add(self, event_id, reminders):
+        """Queue newly created (reminder_id, fire_at) pairs that fall inside the look-ahead window"""
+        self.add_many([(fire_at, reminder_id, event_id) for reminder_id, fire_at in reminders])
+
+    def add_many(self, entries):
+        """Queue (fire_at, reminder_id, event_id) entries that fall inside the look-ahead window"""
+        # Compare against the target window rather than _horizon so a refill in flight can't miss them
+        horizon = time.time() + self.lookahead
+        for fire_at, reminder_id, event_id in entries:
+            if fire_at <= horizon:
+                self._push(fire_at, reminder_id, event_id)
+        self._wakeup.set()
+
+    def discard_event(self, event_id):
+        """Drop every queued reminder for a cancelled event"""
+        kept = [entry for entry in self._heap if entry[2] != event_id]
+        if len(kept) != len(self._heap):
+            self._queued = {entry[1] for entry in kept}
+            heapq.heapify(kept)
+            self._heap = kept
+            self._wakeup.set()
+
+    async def _refill(self, now):
+        horizon = int(now) + self.lookahead
+        for fire_at, reminder_id, event_id in await self.db.run(_load_window, horizon, self.leases):
+            self._push(fire_at, reminder_id, event_id)
+        self._horizon = horizon
+
+    async def _fire_due(self, now):
+        due_ids = []
+        while self._heap and self._heap[0][0] <= now + self.coalesce:
+            _, reminder_id, _ = heapq.heappop(self._heap)
+            self._queued.discard(reminder_id)
+            due_ids.append(reminder_id)
+
+        due, advanced = await self.db.run(_claim, due_ids, now, self.leases, self.grace)
+        self.add_many(advanced)
+        if due:
+            await self.deliver(due)
+
+    async def _run(self):
+        while True:
+            try:
+                now = time.time()
+                if now >= self._horizon:
+                    await self._refill(now)
+
+                if self._heap and self._heap[0][0] <= now:
+                    await self._fire_due(now)
+                    continue
+
+                # Sleep until the next reminder, or until the window has to be extended
+                next_at = min(self._heap[0][0], self._horizon) if self._heap else self._horizon
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_at - time.time(), 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Reminder scheduler iteration failed')
+                # Reload the window from the database, which still has anything left unsent
+                self._horizon = 0
+                await asyncio.sleep(5)
@@ -0,0 +1,57 @@
+import re
+
+# When an event's last occurrence starts; a series without an end never stops
+_LAST_START = "CASE WHEN t.recurrence IS NULL THEN t.event_time ELSE COALESCE(t.recurrence_end, 1 << 62) END"
+
+
+def search_expression(text):
+    """FTS5 query matching every word of free text; None if there are no words
+
+    Words are quoted so nothing a user types is read as FTS5 syntax. They aren't prefix-matched: a short
+    prefix expands to every indexed term it starts, and the index stems words anyway.
+    """
+    words = re.findall(r'\w+', text.lower())
+    return ' '.join(f'"{word}"' for word in words) or None
+
+
+def _matches(table, scope):
+    # One table's matches; the same FTS index covers live and archived events, which never share an ID
+    return f"""
+        SELECT s.rank AS rank, t.id AS id, t.title AS title, t.event_time AS event_time, t.category AS category,
+               snippet(event_search, 1, '**', '**', '…', 12) AS snippet, t.recurrence AS recurrence
+        FROM event_search s
+        JOIN {table} t ON t.id = s.rowid
+        WHERE event_search MATCH 'guild:' || :guild_id || ' AND (' || :expression || ')'
+        AND t.guild_id = :guild_id
+        AND t.is_cancelled = 0
+        AND {scope}
+        AND (:category IS NULL OR t.category = :category)
+        AND (:start IS NULL OR {_LAST_START} >= :start)
+        AND (:end IS NULL OR t.event_time < :end)
+    """
+
+
+def search_events(conn, guild_id, expression, now, archived=False, category=None, start=None, end=None, after=None,
+                  limit=None):
+    """One guild's events matching an FTS5 expression, best match first
+
+    Searches events that haven't finished by `now`, or with archived=True those that have, including
+    the archive tables. start/end keep events with an occurrence in [start, end). Rows are (rank,
+    event_id, title, event_time, category, description snippet, recurrence); after=(rank, event_id)
+    and limit select one keyset page.
+    """
+    finished = f"{_LAST_START} + t.duration * 60 <= :now"
+    if archived:
+        matches = _matches('events', finished) + " UNION ALL " + _matches('archived_events', "1")
+    else:
+        matches = _matches('events', f"NOT ({finished})")
+    keyset = "WHERE rank > :rank OR (rank = :rank AND id > :id)" if after is not None else ""
+    return conn.execute(f"""
+        SELECT rank, id, title, event_time, category, snippet, recurrence
+        FROM ({matches})
+        {keyset}
+        ORDER BY rank, id
+        LIMIT :limit
+    """, {'expression': expression, 'guild_id': guild_id, 'now': now, 'category': category, 'start': start,
+          'end': end, 'rank': after[0] if after else None, 'id': after[1] if after else None,
+          'limit': -1 if limit is None else limit}).fetchall()
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+def parse_shard_ids(text):
+    """Parse a shard list such as '0-3,8' into sorted shard IDs"""
+    shard_ids = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            shard_ids.update(range(int(first), int(last) + 1))
+        else:
+            shard_ids.add(int(part))
+    return sorted(shard_ids)
+
+
+def owned(owner, column, now=None):
+    """SQL condition (and parameters) that `column`, a guild ID, belongs to `owner`
+
+    owner is a Shards, a ShardLeases or None for every guild; see their filter() methods.
+    """
+    if owner is None:
+        return "1", []
+    return owner.filter(column, now)
+
+
+class Shards:
+    """The guild partitions this process is responsible for
+
+    Guilds are partitioned the way Discord assigns them to gateway shards, so a process owns exactly
+    the guilds whose events its own shards deliver.
+    """
+
+    def __init__(self, count=1, ids=None):
+        self.count = count
+        self.ids = list(range(count)) if ids is None else list(ids)
+        if not self.ids or any(not 0 <= shard_id < count for shard_id in self.ids):
+            raise ValueError(f"Shard IDs must be between 0 and {count - 1}")
+
+    def shard_for(self, guild_id):
+        return (guild_id >> 22) % self.count
+
+    def owns(self, guild_id):
+        return self.shard_for(guild_id) in self.ids
+
+    def filter(self, column, now=None):
+        """SQL condition (and parameters) restricting `column` (a guild ID) to these shards"""
+        if len(self.ids) == self.count:
+            return "1", []
+        return f"({column} >> 22) % ? IN ({','.join('?' * len(self.ids))})", [self.count] + self.ids
+
+
+def _renew(conn, shards, owner, now, ttl):
+    # Take each shard whose lease is free, expired or already ours, then report which ones we hold
+    conn.executemany("""
+        INSERT INTO shard_leases (shard_id, shard_count, owner, expires_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (shard_id) DO UPDATE
+        SET shard_count = excluded.shard_count, owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE shard_leases.owner = excluded.owner OR shard_leases.expires_at <= ?
+    """, [(shard_id, shards.count, owner, now + ttl, now) for shard_id in shards.ids])
+    held = [row[0] for row in conn.execute(f"""
+        SELECT shard_id FROM shard_leases
+        WHERE owner = ? AND shard_id IN ({','.join('?' * len(shards.ids))})
+    """, [owner] + shards.ids)]
+    mismatched = conn.execute('SELECT COUNT(*) FROM shard_leases WHERE shard_count != ? AND expires_at > ?',
+                              (shards.count, now)).fetchone()[0]
+    return held, mismatched
+
+
+def _release(conn, owner):
+    conn.execute('DELETE FROM shard_leases WHERE owner = ?', (owner,))
+
+
+class ShardLeases:
+    """Time-limited ownership of this process's shards in the shared database
+
+    Reminders are only claimed for shards whose lease is held, so two processes configured with
+    overlapping shards can't both send them. A process that stops without releasing its leases
+    blocks its shards until they expire; reminders due in the meantime are sent late, not dropped.
+    """
+
+    def __init__(self, db, shards, ttl=60, renew_every=15, on_change=None):
+        self.db = db
+        self.shards = shards
+        self.ttl = ttl
+        self.renew_every = renew_every
+        self.on_change = on_change
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = frozenset()
+        self._task = None
+
+    def filter(self, column, now):
+        """SQL condition (and parameters) that `column`, a guild ID, is in a shard this process holds at `now`"""
+        return f"""EXISTS (SELECT 1 FROM shard_leases l
+                           WHERE l.shard_id = ({column} >> 22) % ?
+                           AND l.owner = ?
+                           AND l.expires_at > ?)""", [self.shards.count, self.owner, int(now)]
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def renew(self):
+        held, mismatched = await self.db.run(_renew, self.shards, self.owner, int(time.time()), self.ttl)
+        if mismatched:
+            log.error('%d live shard lease(s) use a different shard count; every process must share SHARD_COUNT',
+                      mismatched)
+        held = frozenset(held)
+        if held != self.held:
+            gained, lost = held - self.held, self.held - held
+            self.held = held
+            if gained:
+                log.info('Acquired shard lease(s) %s', sorted(gained))
+            if lost:
+                log.warning('Lost shard lease(s) %s', sorted(lost))
+            if self.on_change is not None:
+                self.on_change()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.renew()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Failed to renew shard leases')
+            await asyncio.sleep(self.renew_every)
+
+    async def release(self):
+        """Give up every lease so a replacement process can take over immediately"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.db.run(_release, self.owner)
+        self.held = frozenset()
@@ -0,0 +1,251 @@
+import asyncio
+import cProfile
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds; one more implicit bucket catches everything above the last
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram, cheap enough to update on every call"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (the max for the overflow bucket)"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+
+class _Profile:
+    def __init__(self, command, invocations, path, on_done):
+        self.command = command
+        self.remaining = invocations
+        self.path = path
+        self.on_done = on_done
+        self.profiler = cProfile.Profile()
+        # Invocations of the command currently running; the profiler stays on while any are
+        self.active = 0
+
+
+class Telemetry:
+    """Latency histograms, SQL timings, event-loop lag and queue depths for the running bot"""
+
+    def __init__(self, loop_interval=0.5):
+        self.loop_interval = loop_interval
+        self.commands = {}
+        self.command_failures = {}
+        self.sql = {}
+        self.sql_rows = {}
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.reminder_lag = Histogram(LAG_BUCKETS)
+        self.gauges = {}
+        # Seconds spent in each startup step, in the order they ran
+        self.startup = {}
+        self.started_at = time.time()
+        self._profile = None
+        # Database observations arrive from the pool's worker threads
+        self._sql_lock = threading.Lock()
+        self._monitor = None
+        self._server = None
+
+    def gauge(self, name, read):
+        """Report read() as the current value of `name`, e.g. a queue's depth"""
+        self.gauges[name] = read
+
+    @contextmanager
+    def track(self, name):
+        """Time one invocation of a command or handler"""
+        profile = self._profile if self._profile is not None and self._profile.command == name else None
+        if profile is not None:
+            if not profile.active:
+                profile.profiler.enable()
+            profile.active += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.commands.setdefault(name, Histogram()).observe(time.perf_counter() - start)
+            if profile is not None:
+                self._profile_done(profile)
+
+    @contextmanager
+    def phase(self, name):
+        """Time one step of startup"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup[name] = time.perf_counter() - start
+
+    def timed(self, name):
+        """Decorator that tracks every call of a coroutine function under `name`"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.track(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def failed(self, name):
+        self.command_failures[name] = self.command_failures.get(name, 0) + 1
+
+    def observe_sql(self, label, seconds, rows):
+        with self._sql_lock:
+            self.sql.setdefault(label, Histogram()).observe(seconds)
+            self.sql_rows[label] = self.sql_rows.get(label, 0) + rows
+
+    def profile(self, command, invocations, directory, on_done=None):
+        """Capture a cProfile of the next `invocations` calls of `command`, saved under `directory`
+
+        on_done(path) is called once the profile has been written. Only one profile can be armed at
+        a time, and it covers everything the loop runs while the command is in flight.
+        """
+        if self._profile is not None:
+            raise RuntimeError(f"Already profiling {self._profile.command}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{command}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.prof")
+        self._profile = _Profile(command, invocations, path, on_done)
+        return path
+
+    def _profile_done(self, profile):
+        profile.active -= 1
+        profile.remaining -= 1
+        if profile.active:
+            return
+        profile.profiler.disable()
+        if profile.remaining <= 0 and self._profile is profile:
+            self._profile = None
+            profile.profiler.dump_stats(profile.path)
+            log.info('Saved profile of %s to %s', profile.command, profile.path)
+            if profile.on_done is not None:
+                profile.on_done(profile.path)
+
+    async def _watch_loop(self):
+        # A sleep that wakes up late means something held the event loop for the difference
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.loop_interval)
+            self.loop_lag.observe(max(time.perf_counter() - start - self.loop_interval, 0.0))
+
+    def start(self, port=None, host='127.0.0.1'):
+        """Start sampling event-loop lag and, given a port, serve /metrics; safe to call again"""
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.create_task(self._watch_loop())
+        if port and self._server is None:
+            self._server = asyncio.create_task(self._serve(host, port))
+
+    async def _serve(self, host, port):
+        try:
+            server = await asyncio.start_server(self._handle, host, port)
+        except OSError:
+            log.exception('Could not serve metrics on %s:%s', host, port)
+            return
+        log.info('Serving metrics on http://%s:%s/metrics', host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Skip the headers; nothing in them matters here
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render_prometheus().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def histogram(name, help_text, series):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, hist in series:
+                cumulative = 0
+                for bound, count in zip(hist.bounds + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+                suffix = f'{{{labels.rstrip(",")}}}' if labels else ''
+                lines.append(f'{name}_sum{suffix} {hist.sum}')
+                lines.append(f'{name}_count{suffix} {hist.count}')
+
+        histogram('calendar_command_seconds', 'Command and handler latency',
+                  [(f'command="{name}",', hist) for name, hist in sorted(self.commands.items())])
+        lines.append('# HELP calendar_command_failures_total Commands that raised an error')
+        lines.append('# TYPE calendar_command_failures_total counter')
+        for name, count in sorted(self.command_failures.items()):
+            lines.append(f'calendar_command_failures_total{{command="{name}"}} {count}')
+
+        with self._sql_lock:
+            sql = sorted((label, hist, self.sql_rows[label]) for label, hist in self.sql.items())
+        histogram('calendar_sql_seconds', 'Database transaction time on the pool threads',
+                  [(f'query="{_escape(label)}",', hist) for label, hist, _ in sql])
+        lines.append('# HELP calendar_sql_rows_total Rows returned or written per query')
+        lines.append('# TYPE calendar_sql_rows_total counter')
+        for label, _, rows in sql:
+            lines.append(f'calendar_sql_rows_total{{query="{_escape(label)}"}} {rows}')
+
+        histogram('calendar_event_loop_lag_seconds', 'How late the event loop woke a sleeping task',
+                  [('', self.loop_lag)])
+        histogram('calendar_reminder_lag_seconds', 'Reminder send time minus due time', [('', self.reminder_lag)])
+
+        lines.append('# HELP calendar_startup_seconds Time spent in each startup step')
+        lines.append('# TYPE calendar_startup_seconds gauge')
+        for name, seconds in self.startup.items():
+            lines.append(f'calendar_startup_seconds{{phase="{name}"}} {seconds}')
+
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f'# TYPE calendar_{name} gauge')
+            lines.append(f'calendar_{name} {read()}')
+        lines.append('# TYPE calendar_uptime_seconds gauge')
+        lines.append(f'calendar_uptime_seconds {time.time() - self.started_at:.0f}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
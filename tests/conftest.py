@@ -0,0 +1,43 @@
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+import pytest
+
+# The bot's modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database, migrate, to_timestamp  # noqa: E402
+
+
+@pytest.fixture
+def conn(tmp_path):
+    """A connection to a freshly migrated database file"""
+    conn = sqlite3.connect(str(tmp_path / 'calendar.db'))
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def add_event(conn):
+    """Insert an event and return its ID; event_time is epoch seconds or a local datetime"""
+    def add_event(guild_id=1, title='Event', description='', event_time=1_800_000_000, category='general',
+                  recurrence=None, duration=60, channel_id=10, creator_id=5, message_id=None):
+        if isinstance(event_time, datetime):
+            event_time = to_timestamp(event_time)
+        return conn.execute('''INSERT INTO events (guild_id, channel_id, creator_id, title, description, event_time,
+                                                   category, duration, recurrence, message_id)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (guild_id, channel_id, creator_id, title, description, event_time, category, duration,
+                             recurrence, message_id)).lastrowid
+    return add_event
+
+
+@pytest.fixture
+def db(conn, tmp_path):
+    """A connection pool on the same database as conn; commit conn's writes for it to see them"""
+    db = Database(str(tmp_path / 'calendar.db'), pool_size=2)
+    yield db
+    db.close()
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from admission import COMMAND, LISTING, REACTION, Admission, Overloaded
+
+
+async def noop():
+    pass
+
+
+async def backlog(admission, count, guilds=10):
+    """Occupy every slot and queue `count` commands behind it; returns a function that lets them all run"""
+    gate = asyncio.Event()
+    tasks = [asyncio.create_task(admission.run(guild_id % guilds, gate.wait)) for guild_id in range(count + 1)]
+    await asyncio.sleep(0)
+
+    async def finish():
+        gate.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return finish
+
+
+def test_listings_then_reactions_are_shed_as_the_backlog_grows():
+    async def scenario():
+        admission = Admission(concurrency=1, guild_concurrency=1, max_backlog=10, rate=100)
+        finish = await backlog(admission, 5)
+        assert admission.depth() == 5
+
+        with pytest.raises(Overloaded):
+            await admission.run(99, noop, LISTING)
+        assert admission.admit_reaction(99)
+
+        commands = [asyncio.create_task(admission.run(guild_id, noop, COMMAND)) for guild_id in range(5)]
+        await asyncio.sleep(0)
+        assert admission.depth() == 10
+        assert not admission.admit_reaction(99)
+        assert admission.shed == {LISTING: 1, REACTION: 1, COMMAND: 0}
+        await finish()
+        await asyncio.gather(*commands)
+    asyncio.run(scenario())
+
+
+def test_full_guild_queue_drops_its_least_important_job():
+    async def scenario():
+        admission = Admission(concurrency=1, guild_concurrency=1, queue_size=2, rate=100)
+        finish = await backlog(admission, 0)
+        listing = asyncio.create_task(admission.run(1, noop, LISTING, cost=0))
+        command = asyncio.create_task(admission.run(1, noop, COMMAND, cost=0))
+        await asyncio.sleep(0)
+
+        # A command pushes out the queued listing; another listing is turned away outright
+        pushed = asyncio.create_task(admission.run(1, noop, COMMAND, cost=0))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await listing
+        with pytest.raises(Overloaded):
+            await admission.run(1, noop, LISTING)
+
+        await finish()
+        await asyncio.gather(command, pushed)
+        assert admission.depth() == 0
+    asyncio.run(scenario())
+
+
+def test_guilds_take_turns():
+    async def scenario():
+        admission = Admission(concurrency=1, guild_concurrency=1, rate=100)
+        order = []
+
+        def job(guild_id):
+            async def work():
+                order.append(guild_id)
+            return work
+        finish = await backlog(admission, 0)
+        tasks = [asyncio.create_task(admission.run(guild_id, job(guild_id)))
+                 for guild_id in (1, 1, 1, 2, 3)]
+        await asyncio.sleep(0)
+        await finish()
+        await asyncio.gather(*tasks)
+        assert order == [1, 2, 3, 1, 1]
+    asyncio.run(scenario())
+
+
+def test_detach_frees_the_slot_and_on_wait_runs_while_queued():
+    async def scenario():
+        admission = Admission(concurrency=1, guild_concurrency=1, rate=100)
+        waiting = asyncio.Event()
+        answered = asyncio.Event()
+        deferred = []
+
+        async def confirm():
+            admission.detach()
+            waiting.set()
+            await answered.wait()
+
+        async def defer():
+            deferred.append(True)
+
+        confirming = asyncio.create_task(admission.run(1, confirm))
+        await waiting.wait()
+        # The other command runs while the first waits on a user, without being deferred
+        await asyncio.wait_for(admission.run(1, noop, on_wait=defer), 1)
+        assert deferred == []
+
+        finish = await backlog(admission, 0)
+        queued = asyncio.create_task(admission.run(1, noop, on_wait=defer))
+        await asyncio.sleep(0)
+        assert deferred == [True]
+
+        answered.set()
+        await finish()
+        await asyncio.gather(confirming, queued)
+    asyncio.run(scenario())
+
+
+def test_commands_wait_for_guild_tokens():
+    async def scenario():
+        admission = Admission(rate=2, per=0.2)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.gather(*(admission.run(1, noop) for _ in range(4)))
+        # Two commands fit the initial burst, the other two wait for a token each
+        assert loop.time() - started >= 0.15
+    asyncio.run(scenario())
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+from database import to_timestamp
+from digest import MAX_LINES, Digests, group_digests, load_digests, render_digest
+
+DUE = datetime(2026, 10, 19, 8, 0)  # a Monday
+START, END = to_timestamp(DUE), to_timestamp(datetime(2026, 10, 26))
+
+
+def subscribe(conn, guild_id, kind, target_id, period='weekly'):
+    conn.execute('INSERT INTO digest_subscriptions (guild_id, kind, target_id, period) VALUES (?, ?, ?, ?)',
+                 (guild_id, kind, target_id, period))
+
+
+def load(conn, period='weekly'):
+    # load_digests takes the write lock itself, as it does on a pooled connection
+    conn.commit()
+    loaded = load_digests(conn, period, START, START, END)
+    conn.commit()
+    return loaded
+
+
+def test_query_count_does_not_grow_with_guilds(conn, add_event):
+    statements = []
+    conn.set_trace_callback(statements.append)
+    for guild_id in range(1, 51):
+        subscribe(conn, guild_id, 'channel', 1000 + guild_id)
+        subscribe(conn, guild_id, 'user', guild_id)
+        add_event(guild_id=guild_id, event_time=DUE + timedelta(days=1))
+    statements.clear()
+
+    subscriptions, events, _, _ = load(conn)
+
+    assert len(subscriptions) == 100 and len(events) == 50
+    assert len([sql for sql in statements if not sql.startswith(('BEGIN', 'COMMIT'))]) == 5
+
+
+def test_each_digest_is_claimed_once(conn):
+    subscribe(conn, 1, 'channel', 1000)
+    subscribe(conn, 1, 'user', 7, period='daily')
+
+    assert len(load(conn)[0]) == 1
+    assert load(conn)[0] == []
+    assert len(load(conn, 'daily')[0]) == 1
+
+
+def test_groups_channels_and_users(conn, add_event):
+    meeting = add_event(title='Meeting', event_time=DUE + timedelta(days=1))
+    add_event(title='Last week', event_time=DUE - timedelta(days=1))
+    standup = add_event(title='Standup', event_time=datetime(2026, 10, 1, 9, 0), recurrence='FREQ=DAILY')
+    raid = add_event(guild_id=2, title='Raid', event_time=DUE + timedelta(days=2))
+    conn.execute('INSERT INTO event_exceptions VALUES (?, ?)', (standup, to_timestamp(datetime(2026, 10, 20, 9, 0))))
+    conn.executemany('INSERT INTO rsvp (event_id, user_id, status, occurrence) VALUES (?, ?, ?, ?)', [
+        (meeting, 7, 'maybe', 0),
+        (raid, 7, 'attending', 0),
+        (standup, 7, 'attending', 0),
+        # Answering for one date overrides the answer for the series
+        (standup, 7, 'not_attending', to_timestamp(datetime(2026, 10, 21, 9, 0))),
+        (meeting, 8, 'not_attending', 0),
+    ])
+    for guild_id in (1, 2):
+        subscribe(conn, guild_id, 'user', 7)
+    subscribe(conn, 1, 'user', 8)
+    subscribe(conn, 1, 'channel', 1000)
+
+    groups = group_digests(*load(conn), START, END)
+
+    channel = groups['channel', 1000][1]
+    assert [title for _, _, title, _ in channel].count('Standup') == 6
+    assert 'Last week' not in [title for _, _, title, _ in channel]
+    assert set(groups['user', 7]) == {1, 2}
+    assert [(title, time) for time, _, title, _ in groups['user', 7][1] if title == 'Standup'] == [
+        ('Standup', to_timestamp(datetime(2026, 10, day, 9, 0))) for day in (19, 22, 23, 24, 25)]
+    assert 'Meeting' in [title for _, _, title, _ in groups['user', 7][1]]
+    assert groups['user', 8] == {1: []}
+
+
+def test_render_caps_lines():
+    occurrences = [(START + hour * 3600, hour, f'Event {hour}', 'general') for hour in range(MAX_LINES + 5)]
+
+    embed = render_digest('daily', {1: occurrences}, str)
+
+    lines = embed.description.split('\n')
+    assert len(lines) == MAX_LINES + 1
+    assert lines[-1] == '…and 5 more'
+    assert render_digest('weekly', {1: []}, str).description == 'Nothing scheduled.'
+
+
+def test_due_times():
+    digests = Digests(None, None, None, hour=8, weekday=0)
+
+    assert digests.due('daily', datetime(2026, 10, 16, 9, 0)) == datetime(2026, 10, 16, 8, 0)
+    assert digests.due('daily', datetime(2026, 10, 16, 7, 0)) == datetime(2026, 10, 15, 8, 0)
+    assert digests.due('weekly', datetime(2026, 10, 16, 9, 0)) == datetime(2026, 10, 12, 8, 0)
+    assert digests.due('weekly', datetime(2026, 10, 19, 7, 59)) == datetime(2026, 10, 12, 8, 0)
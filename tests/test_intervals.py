@@ -0,0 +1,79 @@
+from datetime import datetime
+
+from database import to_timestamp
+from intervals import GuildIntervals, daily_windows, free_slots, merge_busy
+from recurrence import Recurrence
+
+HOUR = 3600
+
+
+def test_merge_busy_joins_overlapping_and_touching_intervals():
+    assert merge_busy([(0, 10), (5, 8), (10, 20), (25, 30), (26, 40)]) == [[0, 20], [25, 40]]
+    assert merge_busy([]) == []
+
+
+def test_free_slots_between_and_after_busy_intervals():
+    busy = merge_busy([(10, 20), (15, 30), (50, 60)])
+
+    assert free_slots(busy, [(0, 100)], 10, 5) == [(0, 10), (30, 50), (60, 100)]
+    assert free_slots(busy, [(0, 100)], 25, 5) == [(60, 100)]
+    assert free_slots(busy, [(0, 100)], 10, 2) == [(0, 10), (30, 50)]
+
+
+def test_free_slots_respects_window_edges():
+    busy = [[3, 15], [18, 105]]
+
+    # The busy interval running across both windows trims the end of one and the start of the next
+    assert free_slots(busy, [(0, 20), (100, 140)], 3, 5) == [(0, 3), (15, 18), (105, 140)]
+    assert free_slots(busy, [(0, 20), (100, 140)], 5, 5) == [(105, 140)]
+
+
+def test_daily_windows_past_midnight_and_on_weekdays():
+    start = to_timestamp(datetime(2026, 10, 16))  # a Friday
+    end = to_timestamp(datetime(2026, 10, 19))
+
+    evenings = daily_windows(start, end, 22 * 60, 2 * 60)
+    weekdays = daily_windows(start, end, 9 * 60, 17 * 60, weekdays={0, 1, 2, 3, 4})
+
+    assert evenings[0] == (start, start + 2 * HOUR)
+    assert evenings[1] == (start + 22 * HOUR, start + 26 * HOUR)
+    assert evenings[-1] == (start + 70 * HOUR, end)
+    assert weekdays == [(start + 9 * HOUR, start + 17 * HOUR)]
+
+
+def test_whole_days_form_one_window():
+    start = to_timestamp(datetime(2026, 10, 16, 12, 0))
+    end = to_timestamp(datetime(2026, 10, 19))
+
+    assert daily_windows(start, end, 0, 0) == [(start, end)]
+
+
+def test_overlapping_finds_long_events_and_series():
+    intervals = GuildIntervals()
+    intervals.add(1, 'Short', 100, 200)
+    intervals.add(2, 'Long', 0, 100000)
+    intervals.add(3, 'Later', 5000, 6000)
+    dtstart = datetime(2026, 10, 1, 18, 0)
+    intervals.add_series(4, 'Daily', Recurrence('DAILY'), dtstart, HOUR,
+                         exceptions=[to_timestamp(datetime(2026, 10, 3, 18, 0))])
+
+    assert [event[0] for event in intervals.overlapping(150, 160)] == [2, 1]
+    assert [event[0] for event in intervals.overlapping(200, 5000)] == [2]
+
+    window = to_timestamp(datetime(2026, 10, 2, 18, 30)), to_timestamp(datetime(2026, 10, 4, 18, 30))
+    assert [event[2] for event in intervals.overlapping(*window)] == [
+        to_timestamp(datetime(2026, 10, 2, 18, 0)), to_timestamp(datetime(2026, 10, 4, 18, 0))]
+
+
+def test_remove_and_prune():
+    intervals = GuildIntervals()
+    intervals.add(1, 'A', 100, 200)
+    intervals.add(2, 'B', 100, 200)
+    intervals.add(3, 'C', 1000, 2000)
+
+    intervals.remove(1)
+    assert [event[0] for event in intervals.overlapping(0, 5000)] == [2, 3]
+
+    intervals.prune(500)
+    assert len(intervals) == 1
+    assert [event[0] for event in intervals.overlapping(0, 5000)] == [3]
@@ -0,0 +1,54 @@
+import asyncio
+
+from pagination import KeysetPages, PageCache
+
+
+def make_pages(rows, page_size=2):
+    # Rows are (id, title, event_time), paged by (event_time, id) as the listing commands do
+    fetches = []
+
+    async def fetch(after, limit):
+        fetches.append(after)
+        ordered = sorted(rows, key=lambda row: (row[2], row[0]))
+        return [row for row in ordered if after is None or (row[2], row[0]) > after][:limit]
+
+    def render(rows, page, has_next):
+        return [row[0] for row in rows]
+
+    pages = KeysetPages(fetch, render, lambda row: (row[2], row[0]), page_size, PageCache(), (1, 'list'))
+    return pages, fetches
+
+
+def test_rows_sharing_a_start_time_are_split_across_pages_exactly_once():
+    rows = [(3, 'C', 100), (1, 'A', 100), (2, 'B', 100), (5, 'E', 200), (4, 'D', 100)]
+    pages, _ = make_pages(rows)
+
+    async def scenario():
+        return [page async for page in pages.pages()]
+    assert asyncio.run(scenario()) == [[1, 2], [3, 4], [5]]
+
+
+def test_a_full_last_page_has_no_empty_page_after_it():
+    pages, fetches = make_pages([(1, 'A', 100), (2, 'B', 100), (3, 'C', 200), (4, 'D', 300)])
+
+    async def scenario():
+        assert await pages.page(0) == ([1, 2], True)
+        assert await pages.page(1) == ([3, 4], False)
+    asyncio.run(scenario())
+    assert len(fetches) == 2
+
+    pages, _ = make_pages([])
+    assert asyncio.run(pages.page(0)) == ([], False)
+
+
+def test_paging_backward_reuses_the_pages_already_built():
+    pages, fetches = make_pages([(1, 'A', 100), (2, 'B', 100), (3, 'C', 100), (4, 'D', 200), (5, 'E', 300)])
+
+    async def scenario():
+        for number in (0, 1, 2):
+            await pages.page(number)
+        assert await pages.page(1) == ([3, 4], True)
+        assert await pages.page(0) == ([1, 2], True)
+        assert await pages.page(2) == ([5], False)
+    asyncio.run(scenario())
+    assert fetches == [None, (100, 2), (200, 4)]
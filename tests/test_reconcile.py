@@ -0,0 +1,66 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from reconcile import Reconciler
+from rsvp import RsvpWriter
+
+BOT_ID = 1000
+
+
+class FakeReaction:
+    def __init__(self, emoji, user_ids):
+        self.emoji = emoji
+        self.user_ids = user_ids
+        self.reads = 0
+
+    @property
+    def count(self):
+        return len(self.user_ids)
+
+    @property
+    def me(self):
+        return BOT_ID in self.user_ids
+
+    async def users(self, limit=None):
+        self.reads += 1
+        for user_id in self.user_ids:
+            yield SimpleNamespace(id=user_id)
+
+
+class FakeChannel:
+    def __init__(self, reactions):
+        self.message = SimpleNamespace(reactions=reactions)
+
+    async def fetch_message(self, message_id):
+        return self.message
+
+
+def test_unchanged_counts_are_not_reread(conn, db, add_event):
+    event_id = add_event(event_time=int(time.time()) + 86400, message_id=77)
+    conn.commit()
+    # The bot's own reactions on every announcement don't stop the counts from matching
+    reactions = [FakeReaction('👍', [BOT_ID, 1]), FakeReaction('❓', [BOT_ID]), FakeReaction('👎', [BOT_ID])]
+    channel = FakeChannel(reactions)
+    bot = SimpleNamespace(user=SimpleNamespace(id=BOT_ID), get_channel=lambda channel_id: channel)
+
+    async def scenario():
+        reconciler = Reconciler(bot, db, RsvpWriter(db, delay=0))
+        assert await reconciler.run() == (1, 1, 1)
+        assert [reaction.reads for reaction in reactions] == [1, 0, 0]
+
+        assert await reconciler.run() == (1, 0, 0)
+        assert [reaction.reads for reaction in reactions] == [1, 0, 0]
+
+        # Another member joining changes the counts, so the announcement is read again
+        reactions[2].user_ids.append(2)
+        assert await reconciler.run() == (1, 1, 1)
+        assert [reaction.reads for reaction in reactions] == [2, 0, 1]
+
+        # Past recheck_after, equal counts are read anyway
+        reconciler.recheck_after = 0
+        assert await reconciler.run() == (1, 1, 0)
+    asyncio.run(scenario())
+
+    assert sorted(conn.execute('SELECT user_id, status FROM rsvp WHERE event_id = ?', (event_id,))) == [
+        (1, 'attending'), (2, 'not_attending')]
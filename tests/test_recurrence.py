@@ -0,0 +1,87 @@
+from datetime import datetime
+
+import pytest
+
+from recurrence import Recurrence, parse_repeat
+
+
+def test_monthly_skips_months_without_the_day():
+    rule = Recurrence('MONTHLY')
+    dtstart = datetime(2026, 1, 31, 18, 0)
+
+    dates = [occurrence.date() for occurrence in rule.occurrences(dtstart, end=datetime(2026, 9, 1))]
+
+    assert [(date.month, date.day) for date in dates] == [(1, 31), (3, 31), (5, 31), (7, 31), (8, 31)]
+
+
+def test_monthly_count_only_counts_real_occurrences():
+    rule = Recurrence('MONTHLY', count=3)
+    dtstart = datetime(2026, 1, 30, 9, 0)
+
+    assert [occurrence.month for occurrence in rule.occurrences(dtstart)] == [1, 3, 4]
+    assert rule.last(dtstart) == datetime(2026, 4, 30, 9, 0)
+
+
+def test_monthly_jump_matches_walk_from_the_start():
+    rule = Recurrence('MONTHLY', interval=5)
+    dtstart = datetime(2025, 3, 29, 12, 0)
+    start = datetime(2027, 1, 1)
+
+    walked = [occurrence for occurrence in rule.occurrences(dtstart, end=datetime(2029, 1, 1)) if occurrence >= start]
+
+    assert list(rule.occurrences(dtstart, start, datetime(2029, 1, 1))) == walked
+
+
+def test_weekly_count_ignores_days_before_dtstart():
+    # Starts on a Wednesday, so the Monday of the first week is not an occurrence
+    rule = Recurrence('WEEKLY', byday=[0, 2], count=4)
+    dtstart = datetime(2026, 10, 14, 19, 0)
+
+    assert list(rule.occurrences(dtstart)) == [datetime(2026, 10, 14, 19, 0), datetime(2026, 10, 19, 19, 0),
+                                               datetime(2026, 10, 21, 19, 0), datetime(2026, 10, 26, 19, 0)]
+    # Jumping ahead keeps the numbering, so the count still ends the series in the same place
+    assert list(rule.occurrences(dtstart, datetime(2026, 10, 20))) == [datetime(2026, 10, 21, 19, 0),
+                                                                       datetime(2026, 10, 26, 19, 0)]
+
+
+def test_until_is_inclusive():
+    rule = parse_repeat('daily', until='2026-10-20')
+    dtstart = datetime(2026, 10, 18, 23, 0)
+
+    assert [occurrence.day for occurrence in rule.occurrences(dtstart)] == [18, 19, 20]
+    assert rule.last(dtstart) == datetime(2026, 10, 20, 23, 0)
+
+
+def test_daily_interval_window():
+    rule = Recurrence('DAILY', interval=3)
+    dtstart = datetime(2026, 10, 1, 8, 0)
+
+    occurrences = rule.occurrences(dtstart, datetime(2026, 10, 8), datetime(2026, 10, 14))
+
+    assert [occurrence.day for occurrence in occurrences] == [10, 13]
+
+
+def test_first_and_last():
+    dtstart = datetime(2026, 10, 1, 8, 0)
+
+    assert Recurrence('DAILY').first(dtstart, datetime(2026, 10, 5, 8, 0)) == datetime(2026, 10, 5, 8, 0)
+    assert Recurrence('DAILY', count=2).first(dtstart, datetime(2026, 10, 5)) is None
+    assert Recurrence('DAILY').last(dtstart) is None
+
+
+def test_round_trips_through_the_stored_form():
+    rule = Recurrence('WEEKLY', interval=2, byday=[2, 0], count=10, until=datetime(2027, 6, 1, 23, 59, 59))
+
+    assert str(rule) == 'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE;COUNT=10;UNTIL=20270601T235959'
+    assert str(Recurrence.parse(str(rule))) == str(rule)
+
+
+@pytest.mark.parametrize('args', [
+    ('yearly',),
+    ('monthly', 1, 'mon'),
+    ('daily', 0),
+    ('daily', 1, None, None, 0),
+])
+def test_rejects_invalid_repeats(args):
+    with pytest.raises(ValueError):
+        parse_repeat(*args)
@@ -0,0 +1,31 @@
+import asyncio
+
+from database import rebuild_rsvp_counts
+from rsvp import RsvpWriter
+
+
+def test_changes_for_one_user_collapse_into_one_row(conn, db, add_event):
+    event_id = add_event()
+    conn.commit()
+
+    async def scenario():
+        writer = RsvpWriter(db, delay=60)
+        writer.set(event_id, 1, 'attending')
+        writer.set(event_id, 1, 'maybe')
+        writer.remove(event_id, 1)
+        writer.set(event_id, 1, 'not_attending')
+        writer.set(event_id, 2, 'attending')
+        writer.set(event_id, 3, 'maybe')
+        writer.remove(event_id, 3)
+        assert writer.depth() == 3
+        await writer.flush()
+        assert writer.depth() == 0
+    asyncio.run(scenario())
+
+    assert sorted(conn.execute('SELECT user_id, status FROM rsvp WHERE event_id = ?', (event_id,))) == [
+        (1, 'not_attending'), (2, 'attending')]
+    counts = conn.execute('SELECT attending_count, maybe_count, not_attending_count FROM events WHERE id = ?',
+                          (event_id,)).fetchone()
+    # The counters kept up to date by each write agree with a full recount
+    assert rebuild_rsvp_counts(conn) == []
+    assert counts == (1, 0, 1)
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+from database import to_timestamp
+from recurrence import Recurrence
+from scheduler import _claim
+
+NOW = to_timestamp(datetime(2026, 10, 16, 12, 0))
+
+
+def add_reminder(conn, event_id, minutes, fire_at):
+    return conn.execute('INSERT INTO reminders (event_id, reminder_time, fire_at) VALUES (?, ?, ?)',
+                        (event_id, minutes, fire_at)).lastrowid
+
+
+def reminder(conn, reminder_id):
+    return conn.execute('SELECT notification_sent, fire_at FROM reminders WHERE id = ?', (reminder_id,)).fetchone()
+
+
+def test_claims_reminder_due_now(conn, add_event):
+    event_id = add_event(event_time=NOW + 14 * 60)
+    reminder_id = add_reminder(conn, event_id, 15, NOW - 60)
+
+    due, advanced = _claim(conn, [reminder_id], NOW)
+
+    assert [row[0] for row in due] == [reminder_id]
+    assert advanced == []
+    assert reminder(conn, reminder_id)[0] == 1
+
+
+def test_drops_reminder_for_event_that_already_happened(conn, add_event):
+    event_time = NOW - 2 * 86400
+    event_id = add_event(event_time=event_time)
+    reminder_id = add_reminder(conn, event_id, 15, event_time - 15 * 60)
+
+    due, advanced = _claim(conn, [reminder_id], NOW)
+
+    assert due == [] and advanced == []
+    assert reminder(conn, reminder_id)[0] == 1
+
+
+def test_drops_reminder_past_grace_before_event_starts(conn, add_event):
+    event_id = add_event(event_time=NOW + 5 * 60)
+    reminder_id = add_reminder(conn, event_id, 60, NOW - 55 * 60)
+
+    due, _ = _claim(conn, [reminder_id], NOW, grace=300)
+
+    assert due == []
+    assert reminder(conn, reminder_id)[0] == 1
+
+
+def test_moves_stale_series_reminder_to_next_occurrence(conn, add_event):
+    first = datetime(2026, 10, 1, 18, 0)
+    event_id = add_event(event_time=first, recurrence='FREQ=DAILY')
+    missed = to_timestamp(first + timedelta(days=12))
+    reminder_id = add_reminder(conn, event_id, 15, missed - 15 * 60)
+
+    due, advanced = _claim(conn, [reminder_id], NOW)
+
+    next_occurrence = to_timestamp(Recurrence.parse('FREQ=DAILY').first(first, datetime(2026, 10, 16, 12, 16)))
+    assert due == []
+    assert advanced == [(next_occurrence - 15 * 60, reminder_id, event_id)]
+    assert reminder(conn, reminder_id) == (0, next_occurrence - 15 * 60)
@@ -0,0 +1,56 @@
+from search import search_events, search_expression
+
+NOW = 1_800_000_000
+DAY = 86400
+
+
+def ids(rows):
+    return [row[1] for row in rows]
+
+
+def test_expression_quotes_words():
+    assert search_expression('Board "meeting" OR NEAR(x*') == '"board" "meeting" "or" "near" "x"'
+    assert search_expression(' -- ') is None
+
+
+def test_matches_every_word_in_one_guild_only(conn, add_event):
+    planning = add_event(title='Quarterly planning meeting', description='Budget review', event_time=NOW + DAY)
+    add_event(title='Planning lunch', event_time=NOW + DAY)
+    add_event(guild_id=2, title='Quarterly planning meeting', event_time=NOW + DAY)
+
+    assert ids(search_events(conn, 1, search_expression('planning budget'), NOW)) == [planning]
+    # Stemmed, so other forms of a word match too
+    assert ids(search_events(conn, 1, search_expression('meetings'), NOW)) == [planning]
+
+
+def test_title_matches_rank_first(conn, add_event):
+    in_description = add_event(title='Lunch', description='Talk about the roadmap', event_time=NOW + DAY)
+    in_title = add_event(title='Roadmap', event_time=NOW + DAY)
+
+    assert ids(search_events(conn, 1, search_expression('roadmap'), NOW)) == [in_title, in_description]
+
+
+def test_keyset_pages(conn, add_event):
+    for day in range(5):
+        add_event(title='Standup', event_time=NOW + day * DAY)
+    expression = search_expression('standup')
+
+    everything = search_events(conn, 1, expression, NOW)
+    first = search_events(conn, 1, expression, NOW, limit=2)
+    rest = search_events(conn, 1, expression, NOW, after=(first[-1][0], first[-1][1]))
+
+    assert ids(first + rest) == ids(everything)
+    assert len(everything) == 5
+
+
+def test_filters_and_archived_scope(conn, add_event):
+    upcoming = add_event(title='Raid night', event_time=NOW + DAY, category='games')
+    add_event(title='Raid planning', event_time=NOW + DAY, category='admin')
+    finished = add_event(title='Raid night', event_time=NOW - DAY, category='games')
+    cancelled = add_event(title='Raid night', event_time=NOW + DAY, category='games')
+    conn.execute('UPDATE events SET is_cancelled = 1 WHERE id = ?', (cancelled,))
+    expression = search_expression('raid')
+
+    assert ids(search_events(conn, 1, expression, NOW, category='games')) == [upcoming]
+    assert ids(search_events(conn, 1, expression, NOW, archived=True)) == [finished]
+    assert ids(search_events(conn, 1, expression, NOW, start=NOW + 2 * DAY)) == []
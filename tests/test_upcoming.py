@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+from upcoming import UpcomingIndex
+
+DAY = 86400
+
+
+def test_changes_made_while_a_guild_loads_are_applied(conn, db, add_event):
+    now = int(time.time())
+    kept = add_event(title='Kept', event_time=now + DAY)
+    cancelled = add_event(title='Cancelled', event_time=now + 2 * DAY)
+    conn.commit()
+
+    async def scenario():
+        index = UpcomingIndex(db)
+        loading = asyncio.create_task(index.upcoming(1, now))
+        await asyncio.sleep(0)
+        assert 1 in index._pending
+        index.add(1, 99, 'Created', now + 3 * DAY, 'general', '')
+        index.remove(1, cancelled)
+
+        rows = await asyncio.wait_for(loading, 5)
+        assert [row[0] for row in rows] == [kept, 99]
+        assert len(index) == 2
+        # Later changes go straight to the loaded guild
+        index.remove(1, 99)
+        assert [row[0] for row in await index.upcoming(1, now)] == [kept]
+    asyncio.run(scenario())
+
+
+def test_series_are_expanded_and_guilds_evicted_by_size(conn, db, add_event):
+    now = int(time.time())
+
+    async def scenario():
+        index = UpcomingIndex(db, max_events=1)
+        await index.upcoming(1, now)
+        index.add(1, 1, 'Daily', now + 60, 'general', '', 'FREQ=DAILY', exceptions=[now + 60 + DAY])
+
+        rows = await index.upcoming(1, now, now + 3 * DAY)
+        assert [row[2] for row in rows] == [now + 60, now + 60 + 2 * DAY]
+
+        add_event(guild_id=2, event_time=now + DAY)
+        conn.commit()
+        await index.upcoming(2, now)
+        # Over max_events, the guild read longest ago is dropped and read from the database again
+        assert 1 not in index._guilds
+        assert await index.upcoming(1, now) == []
+    asyncio.run(scenario())
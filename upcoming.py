@@ -0,0 +1,314 @@
+import asyncio
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+
+from database import from_timestamp, to_timestamp
+from recurrence import Recurrence
+
+# Sorts after every event ID at the same time, for inclusive bisect bounds
+_LAST_ID = float('inf')
+
+
+class _Event:
+    __slots__ = ('title', 'time', 'category', 'description', 'attending', 'recurrence', 'rule', 'recurrence_end',
+                 'exceptions', 'deltas')
+
+    def __init__(self, title, time, category, description, attending, recurrence, recurrence_end):
+        self.title = title
+        self.time = time
+        self.category = category
+        self.description = description
+        self.attending = attending
+        self.recurrence = recurrence
+        self.rule = Recurrence.parse(recurrence) if recurrence else None
+        self.recurrence_end = recurrence_end
+        # Series only: cancelled occurrences, and attending-count changes of single occurrences
+        self.exceptions = set()
+        self.deltas = {}
+
+
+class _GuildCalendar:
+    """One guild's upcoming events: (time, id) keys sorted by time, overall and per category"""
+
+    __slots__ = ('keys', 'by_category', 'events', 'series')
+
+    def __init__(self):
+        self.keys = []
+        self.by_category = {}
+        self.events = {}
+        self.series = {}
+
+    def __len__(self):
+        return len(self.events) + len(self.series)
+
+    def add(self, event_id, event):
+        self.remove(event_id)
+        if event.rule is not None:
+            self.series[event_id] = event
+            return
+        self.events[event_id] = event
+        insort(self.keys, (event.time, event_id))
+        insort(self.by_category.setdefault(event.category, []), (event.time, event_id))
+
+    def remove(self, event_id):
+        if self.series.pop(event_id, None) is not None:
+            return
+        event = self.events.pop(event_id, None)
+        if event is None:
+            return
+        for keys in (self.keys, self.by_category[event.category]):
+            del keys[bisect_left(keys, (event.time, event_id))]
+
+    def prune(self, now):
+        """Forget one-off events that have started, which no listing shows any more; returns their IDs"""
+        cut = bisect_left(self.keys, (now,))
+        if not cut:
+            return []
+        pruned = [event_id for _, event_id in self.keys[:cut]]
+        for event_id in pruned:
+            del self.events[event_id]
+        del self.keys[:cut]
+        for category, keys in list(self.by_category.items()):
+            del keys[:bisect_left(keys, (now,))]
+            if not keys:
+                del self.by_category[category]
+        return pruned
+
+    def upcoming(self, start, end=None, category=None, per_series=None, after=None, limit=None):
+        keys = self.by_category.get(category, []) if category else self.keys
+        lo = bisect_left(keys, (start,))
+        if after is not None:
+            lo = max(lo, bisect_right(keys, after))
+        hi = bisect_right(keys, (end, _LAST_ID)) if end is not None else len(keys)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        rows = []
+        for event_time, event_id in keys[lo:hi]:
+            event = self.events[event_id]
+            rows.append((event_id, event.title, event_time, event.category, event.description, event.attending, None))
+        if not self.series:
+            return rows
+
+        window_end = from_timestamp(end + 1) if end is not None else None
+        for event_id, event in self.series.items():
+            if category and event.category != category:
+                continue
+            if event.recurrence_end is not None and event.recurrence_end < (max(start, after[0]) if after else start):
+                continue
+            # per_series counts from the window start, so later pages must not skip ahead to the cursor
+            window_start = from_timestamp(max(start, after[0]) if after and per_series is None else start)
+            found = taken = 0
+            for occurrence in event.rule.occurrences(from_timestamp(event.time), window_start, window_end):
+                occurrence = to_timestamp(occurrence)
+                if occurrence in event.exceptions:
+                    continue
+                found += 1
+                if after is None or (occurrence, event_id) > after:
+                    rows.append((event_id, event.title, occurrence, event.category, event.description,
+                                 event.attending + event.deltas.get(occurrence, 0), event.recurrence))
+                    taken += 1
+                # No more than `limit` occurrences of one series can land on a page
+                if (per_series is not None and found >= per_series) or (limit is not None and taken >= limit):
+                    break
+
+        rows.sort(key=lambda row: (row[2], row[0]))
+        return rows[:limit]
+
+
+def _series_deltas(conn, series_ids, now):
+    """{(event_id, occurrence): attending change} from RSVPs for single occurrences of these series"""
+    deltas = {}
+    for start in range(0, len(series_ids), 500):
+        chunk = series_ids[start:start + 500]
+        for event_id, occurrence, status, series_status in conn.execute(f"""
+            SELECT o.event_id, o.occurrence, o.status, s.status
+            FROM rsvp o
+            LEFT JOIN rsvp s ON s.event_id = o.event_id AND s.occurrence = 0 AND s.user_id = o.user_id
+            WHERE o.event_id IN ({','.join('?' * len(chunk))}) AND o.occurrence >= ?
+        """, chunk + [now]):
+            key = (event_id, occurrence)
+            deltas[key] = deltas.get(key, 0) + (status == 'attending') - (series_status == 'attending')
+    return deltas
+
+
+def _load_guild(conn, guild_id, now):
+    events = conn.execute("""
+        SELECT id, title, event_time, category, description, attending_count, recurrence, recurrence_end
+        FROM events
+        WHERE guild_id = ?
+        AND is_cancelled = 0
+        AND (event_time >= ? OR (recurrence IS NOT NULL AND (recurrence_end IS NULL OR recurrence_end >= ?)))
+    """, (guild_id, now, now)).fetchall()
+    series_ids = [row[0] for row in events if row[6] is not None]
+    exceptions = []
+    for start in range(0, len(series_ids), 500):
+        chunk = series_ids[start:start + 500]
+        exceptions += conn.execute(f"""
+            SELECT event_id, occurrence FROM event_exceptions
+            WHERE event_id IN ({','.join('?' * len(chunk))}) AND occurrence >= ?
+        """, chunk + [now]).fetchall()
+    return events, exceptions, _series_deltas(conn, series_ids, now)
+
+
+def _load_counts(conn, event_ids, series_ids, now):
+    counts = []
+    for start in range(0, len(event_ids), 500):
+        chunk = event_ids[start:start + 500]
+        counts += conn.execute(f"SELECT id, attending_count FROM events WHERE id IN ({','.join('?' * len(chunk))})",
+                               chunk).fetchall()
+    return counts, _series_deltas(conn, series_ids, now)
+
+
+class UpcomingIndex:
+    """Read-through per-guild cache of upcoming events that serves agenda and list queries from memory
+
+    A guild is loaded on its first read and kept up to date by the code that creates, cancels and
+    archives events and writes RSVPs. Guilds that haven't been read for the longest are evicted once
+    more than `max_events` events are held in total.
+    """
+
+    def __init__(self, db, max_events=200000):
+        self.db = db
+        self.max_events = max_events
+        self._guilds = OrderedDict()
+        self._guild_of = {}
+        self._loads = {}
+        # Changes that arrive while a guild is loading, replayed once the load finishes
+        self._pending = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    async def _load(self, guild_id):
+        try:
+            # Listings start at the current minute; the slack keeps events a caller's start still includes
+            now = int(time.time()) - 3600
+            events, exceptions, deltas = await self.db.run(_load_guild, guild_id, now)
+            calendar = _GuildCalendar()
+            for event_id, title, event_time, category, description, attending, recurrence, recurrence_end in events:
+                calendar.add(event_id, _Event(title, event_time, category, description, attending, recurrence,
+                                              recurrence_end))
+            for event_id, occurrence in exceptions:
+                calendar.series[event_id].exceptions.add(occurrence)
+            for (event_id, occurrence), delta in deltas.items():
+                calendar.series[event_id].deltas[occurrence] = delta
+            self._guilds[guild_id] = calendar
+            for event_id in calendar.events.keys() | calendar.series.keys():
+                self._guild_of[event_id] = guild_id
+            self._size += len(calendar)
+            # Taken off first, so the replayed changes apply to the calendar instead of queueing again
+            for op, args in self._pending.pop(guild_id):
+                getattr(self, op)(guild_id, *args)
+            return calendar
+        finally:
+            self._pending.pop(guild_id, None)
+            del self._loads[guild_id]
+
+    def _evict(self, keep):
+        while self._size > self.max_events and len(self._guilds) > 1:
+            guild_id = next(iter(self._guilds))
+            if guild_id == keep:
+                self._guilds.move_to_end(guild_id)
+                continue
+            self.invalidate(guild_id)
+
+    async def _get(self, guild_id):
+        calendar = self._guilds.get(guild_id)
+        if calendar is not None:
+            self._guilds.move_to_end(guild_id)
+            return calendar
+        if guild_id not in self._loads:
+            self._pending[guild_id] = []
+            self._loads[guild_id] = asyncio.create_task(self._load(guild_id))
+        return await asyncio.shield(self._loads[guild_id])
+
+    def invalidate(self, guild_id):
+        """Drop a guild; its next read loads it again"""
+        calendar = self._guilds.pop(guild_id, None)
+        if calendar is not None:
+            self._size -= len(calendar)
+            for event_id in calendar.events.keys() | calendar.series.keys():
+                self._guild_of.pop(event_id, None)
+
+    def add(self, guild_id, event_id, title, event_time, category, description, recurrence=None,
+            recurrence_end=None, exceptions=()):
+        if guild_id in self._pending:
+            self._pending[guild_id].append(('add', (event_id, title, event_time, category, description, recurrence,
+                                                    recurrence_end, exceptions)))
+            return
+        calendar = self._guilds.get(guild_id)
+        if calendar is None:
+            return
+        event = _Event(title, event_time, category, description, 0, recurrence, recurrence_end)
+        event.exceptions.update(exceptions)
+        self._size -= len(calendar)
+        calendar.add(event_id, event)
+        self._size += len(calendar)
+        self._guild_of[event_id] = guild_id
+
+    def add_exception(self, guild_id, event_id, occurrence):
+        if guild_id in self._pending:
+            self._pending[guild_id].append(('add_exception', (event_id, occurrence)))
+        elif guild_id in self._guilds and event_id in self._guilds[guild_id].series:
+            self._guilds[guild_id].series[event_id].exceptions.add(occurrence)
+
+    def remove(self, guild_id, event_id):
+        if guild_id in self._pending:
+            self._pending[guild_id].append(('remove', (event_id,)))
+            return
+        calendar = self._guilds.get(guild_id)
+        if calendar is not None:
+            self._size -= len(calendar)
+            calendar.remove(event_id)
+            self._size += len(calendar)
+        self._guild_of.pop(event_id, None)
+
+    def discard(self, event_ids):
+        """Remove events whose guild isn't known to the caller, e.g. after archiving"""
+        for event_id in event_ids:
+            guild_id = self._guild_of.get(event_id)
+            if guild_id is not None:
+                self.remove(guild_id, event_id)
+
+    async def refresh_rsvps(self, changes):
+        """Re-read attending counts of cached events after a batch of RSVP changes was written"""
+        event_ids = sorted({event_id for event_id, _, _ in changes if event_id in self._guild_of})
+        # Guilds still loading read the new counts themselves
+        if not event_ids:
+            return
+        series_ids = [event_id for event_id in event_ids if self._find(event_id).rule is not None]
+        counts, deltas = await self.db.run(_load_counts, event_ids, series_ids, int(time.time()))
+        for event_id, attending in counts:
+            event = self._find(event_id)
+            if event is not None:
+                event.attending = attending
+        for event_id in series_ids:
+            event = self._find(event_id)
+            if event is not None:
+                event.deltas = {}
+        for (event_id, occurrence), delta in deltas.items():
+            event = self._find(event_id)
+            if event is not None:
+                event.deltas[occurrence] = delta
+
+    def _find(self, event_id):
+        calendar = self._guilds.get(self._guild_of.get(event_id))
+        if calendar is None:
+            return None
+        return calendar.events.get(event_id) or calendar.series.get(event_id)
+
+    async def upcoming(self, guild_id, start, end=None, category=None, per_series=None, after=None, limit=None):
+        """Upcoming events and expanded series occurrences in [start, end], ordered by (time, id)
+
+        Rows are (event_id, title, time, category, description, attending_count, recurrence); per_series
+        caps how many occurrences of each series are returned. after=(time, id) and limit select one
+        keyset page.
+        """
+        calendar = await self._get(guild_id)
+        for event_id in calendar.prune(min(start, int(time.time()))):
+            self._guild_of.pop(event_id, None)
+            self._size -= 1
+        self._evict(keep=guild_id)
+        return calendar.upcoming(start, end, category, per_series, after, limit)